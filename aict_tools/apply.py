@@ -1,26 +1,17 @@
 import numpy as np
 import logging
-from operator import le, lt, eq, ne, ge, gt
 import h5py
 from tqdm import tqdm
 
-from .preprocessing import convert_to_float32, check_valid_rows
-from .feature_generation import feature_generation
-from fact.io import h5py_get_n_rows
+from .preprocessing import features_to_float32
+from .parallel import run_concurrently
+from .ensemble import predict_proba_thresholded
+from .io import read_array_events_sorted, join_keys_array, keys_array
+from .selection import OPERATORS, SelectionEvaluator, CutFlow, n_rows_group, read_rows
 
 log = logging.getLogger(__name__)
 
 
-OPERATORS = {
-    '<': lt, 'lt': lt,
-    '<=': le, 'le': le,
-    '==': eq, 'eq': eq,
-    '=': eq,
-    '!=': ne, 'ne': ne,
-    '>': gt, 'gt': gt,
-    '>=': ge, 'ge': ge,
-}
-
 text2symbol = {
     'lt': '<',
     'le': '<=',
@@ -44,12 +35,23 @@ def build_query(selection_config):
     return query
 
 
-def predict_energy(df, model, log_target=False):
-    df_features = convert_to_float32(df)
-    valid = check_valid_rows(df_features)
+def valid_rows(X, valid):
+    '''
+    Rows of X where valid is True, without copying if all rows are valid
+    '''
+    return X if valid.all() else X[valid]
+
+
+def predict_energy(df, model, log_target=False, mask=None):
+    X, valid = features_to_float32(df)
+    if mask is not None:
+        valid &= mask
 
-    energy_prediction = np.full(len(df_features), np.nan)
-    energy_prediction[valid] = model.predict(df_features.loc[valid].values)
+    energy_prediction = np.full(len(X), np.nan)
+    # scikit-learn refuses to predict for zero events
+    if not valid.any():
+        return energy_prediction
+    energy_prediction[valid] = model.predict(valid_rows(X, valid))
 
     if log_target:
         energy_prediction[valid] = np.exp(energy_prediction[valid])
@@ -57,65 +59,186 @@ def predict_energy(df, model, log_target=False):
     return energy_prediction
 
 
-def predict_disp(df, abs_model, sign_model):
-    df_features = convert_to_float32(df)
-    valid = check_valid_rows(df_features)
+def predict_disp(df, abs_model, sign_model, mask=None):
+    X, valid = features_to_float32(df)
+    if mask is not None:
+        valid &= mask
+    disp_prediction = np.full(len(X), np.nan)
+    if not valid.any():
+        return disp_prediction
+    X_valid = valid_rows(X, valid)
 
-    disp_abs = abs_model.predict(df_features.loc[valid].values)
-    disp_sign = sign_model.predict(df_features.loc[valid].values)
+    # both models only read X_valid
+    disp_abs, disp_sign = run_concurrently(
+        (abs_model.predict, X_valid),
+        (sign_model.predict, X_valid),
+    )
 
-    disp_prediction = np.full(len(df_features), np.nan)
     disp_prediction[valid] = disp_abs * disp_sign
 
     return disp_prediction
 
 
-def predict_separator(df, model):
-    df_features = convert_to_float32(df)
-    valid = check_valid_rows(df_features)
+def predict_separator(df, model, threshold=None):
+    '''
+    Predict the gamma score.
 
-    score = np.full(len(df_features), np.nan)
-    score[valid] = model.predict_proba(df_features.loc[valid].values)[:, 1]
+    If a threshold is given, returns score, passed and early,
+    see predict_proba_thresholded: the forest evaluation stops early
+    for events whose decision is already fixed, their score is nan.
+    Invalid events get nan and do not pass.
+    '''
+    X, valid = features_to_float32(df)
+
+    score = np.full(len(X), np.nan)
+    if threshold is None:
+        if valid.any():
+            score[valid] = model.predict_proba(valid_rows(X, valid))[:, 1]
+        return score
+
+    passed = np.zeros(len(X), dtype=bool)
+    early = np.zeros(len(X), dtype=bool)
+    if valid.any():
+        score[valid], passed[valid], early[valid] = predict_proba_thresholded(
+            model, valid_rows(X, valid), threshold,
+        )
 
-    return score
+    return score, passed, early
 
 
-def predict_x_max(df, model, log_target=False):
-    df_features = convert_to_float32(df)
-    valid = check_valid_rows(df_features)
+def predict_x_max(df, model, log_target=False, mask=None):
+    X, valid = features_to_float32(df)
+    if mask is not None:
+        valid &= mask
 
-    x_max_prediction = np.full(len(df_features), np.nan)
-    x_max_prediction[valid] = model.predict(df_features.loc[valid].values)
+    x_max_prediction = np.full(len(X), np.nan)
+    if not valid.any():
+        return x_max_prediction
+    x_max_prediction[valid] = model.predict(valid_rows(X, valid))
 
     if log_target:
         x_max_prediction[valid] = np.exp(x_max_prediction[valid])
 
     return x_max_prediction
-    
 
-def create_mask_h5py(input_path, selection_config, key='telescope_events', start=None, end=None, mode="r"):
 
-    with h5py.File(input_path) as infile:
+class GammaCascade:
+    '''
+    Gamma score threshold for the cascade mode of the apply scripts:
+    the energy and disp models only predict for events with a gamma score
+    above the threshold, all other events get nan.
+
+    The threshold is either constant or given in bins of a column,
+    e.g. of the estimated energy, which then has to be predicted first.
+    Configured in the "gamma_cascade" section of the config:
+
+        gamma_cascade:
+          threshold: 0.5
+
+    or
+
+        gamma_cascade:
+          column: gamma_energy_prediction
+          bins: [0, 1000, 5000, .inf]
+          threshold: [0.7, 0.5, 0.3]
+    '''
+    def __init__(self, threshold, column=None, bins=None):
+        self.column = column
+        self.threshold = np.asarray(threshold, dtype=float)
+        self.bins = None if bins is None else np.asarray(bins, dtype=float)
+
+        if (self.column is None) != (self.bins is None):
+            raise ValueError('column and bins have to be given together')
+        if self.bins is None and self.threshold.ndim != 0:
+            raise ValueError('A single threshold is needed without bins')
+        if self.bins is not None and len(self.threshold) != len(self.bins) - 1:
+            raise ValueError('Need one threshold per bin')
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['threshold'], column=config.get('column'), bins=config.get('bins'))
+
+    def mask(self, gamma_score, values=None):
+        '''
+        Boolean mask of the events passed on to the following models.
+        values are the values of column, needed for binned thresholds.
+        Values outside of the bins use the threshold of the closest bin.
+        '''
+        if self.bins is None:
+            threshold = self.threshold
+        else:
+            idx = np.digitize(values, self.bins) - 1
+            threshold = self.threshold[np.clip(idx, 0, len(self.threshold) - 1)]
+
+        with np.errstate(invalid='ignore'):
+            return np.asarray(gamma_score >= threshold)
+
+
+def create_mask_h5py(
+        input_path,
+        selection_config,
+        key='telescope_events',
+        start=None,
+        end=None,
+        mode="r",
+        cut_flow=None,
+        ):
+    with h5py.File(input_path, mode) as infile:
+        group = infile[key]
 
-        n_events = h5py_get_n_rows(input_path, key=key, mode=mode)
+        n_events = n_rows_group(group)
         start = start or 0
         end = min(n_events, end) if end else n_events
 
-        n_selected = end - start
-        mask = np.ones(n_selected, dtype=bool)
+        return SelectionEvaluator(selection_config).mask(group, start, end, cut_flow=cut_flow)
 
-        for name, (operator, value) in selection_config.items():
 
-            before = mask.sum()
-            mask = np.logical_and(
-                mask, OPERATORS[operator](infile[key][name][start:end], value)
-            )
-            after = mask.sum()
-            log.debug('Cut "{} {} {}" removed {} events'.format(
-                name, operator, value, before - after
-            ))
+def copy_rows_h5py_chunked(ingroup, outgroup, get_mask, chunksize=100000, progress=True):
+    '''
+    Copy the rows selected by get_mask of all datasets in ingroup to outgroup,
+    chunksize rows at a time.
+
+    get_mask(start, end, data) has to return the boolean mask for rows [start:end],
+    it can read columns and put them into the dict data, so they are
+    not read a second time for copying.
+    '''
+    n_rows = n_rows_group(ingroup)
+    n_chunks = int(np.ceil(n_rows / chunksize))
+    log.debug('Using {} chunks of size {}'.format(n_chunks, chunksize))
+
+    for name, dataset in ingroup.items():
+        outgroup.create_dataset(
+            name,
+            shape=(0, ) + dataset.shape[1:],
+            maxshape=(None, ) + dataset.shape[1:],
+            dtype=dataset.dtype,
+            chunks=dataset.chunks,
+        )
+
+    n_selected = 0
+    for chunk in tqdm(range(n_chunks), disable=not progress):
+        start = chunk * chunksize
+        end = min(n_rows, (chunk + 1) * chunksize)
+
+        data = {}
+        mask = get_mask(start, end, data)
+        n_new = np.count_nonzero(mask)
+        if n_new == 0:
+            continue
+
+        # for sparse masks, only the storage chunks containing selected rows are read
+        rows = np.flatnonzero(mask)
+        for name, dataset in ingroup.items():
+            if name in data:
+                values = data[name][rows]
+            else:
+                values = read_rows(dataset, start, end, rows)
+            outgroup[name].resize(n_selected + n_new, axis=0)
+            outgroup[name][n_selected:n_selected + n_new] = values
 
-    return mask
+        n_selected += n_new
+
+    return n_selected
 
 
 def apply_cuts_h5py_chunked(
@@ -125,47 +248,234 @@ def apply_cuts_h5py_chunked(
         key='telescope_events',
         chunksize=100000,
         progress=True,
+        cut_flow=None,
+        array_events_key=None,
+        key_columns=('run_id', 'array_event_id'),
         ):
     '''
     Apply cuts defined in selection config to input_path and write result to
     outputpath. Apply cuts to chunksize events at a time.
+    If a CutFlow is given, it is filled while applying the cuts.
+
+    If array_events_key is given, also the array events with at least
+    one selected telescope event are written. Only the sorted key_columns
+    of the array events and a mask of the selected array events are kept
+    in memory for this.
     '''
 
-    n_events = h5py_get_n_rows(input_path, key=key, mode="r")
-    n_chunks = int(np.ceil(n_events / chunksize))
-    log.debug('Using {} chunks of size {}'.format(n_chunks, chunksize))
+    selection = SelectionEvaluator(selection_config)
+    need_keys = array_events_key is not None or (
+        cut_flow is not None and cut_flow.key_columns is not None
+    )
 
     with h5py.File(input_path, 'r') as infile, h5py.File(output_path, 'w') as outfile:
-        group = outfile.create_group(key)
+        ingroup = infile[key]
+
+        if array_events_key is not None:
+            array_keys = keys_array(*(infile[array_events_key][c][:] for c in key_columns))
+            array_order = np.argsort(array_keys, kind='mergesort')
+            array_keys = array_keys[array_order]
+            array_selected = np.zeros(len(array_keys), dtype=bool)
+
+        def get_mask(start, end, data):
+            keys = None
+            if need_keys:
+                # the key columns are read only once, they are copied as well
+                keys = [ingroup[c][start:end] for c in key_columns]
+                data.update(zip(key_columns, keys))
+
+            mask = selection.mask(ingroup, start, end, cut_flow=cut_flow, keys=keys)
+
+            if array_events_key is not None:
+                selected_keys = np.unique(keys_array(*(k[mask] for k in keys)))
+                idx = np.searchsorted(array_keys, selected_keys)
+                found = idx < len(array_keys)
+                found[found] = array_keys[idx[found]] == selected_keys[found]
+                if not found.all():
+                    raise ValueError(
+                        'Found {} telescope events without corresponding array event'
+                        .format(np.count_nonzero(~found))
+                    )
+                array_selected[array_order[idx]] = True
+
+            return mask
+
+        n_selected = copy_rows_h5py_chunked(
+            ingroup, outfile.create_group(key), get_mask, chunksize, progress,
+        )
+        log.info('Selected {} of {} rows of {}'.format(n_selected, n_rows_group(ingroup), key))
+
+        if array_events_key is not None:
+            n_selected = copy_rows_h5py_chunked(
+                infile[array_events_key],
+                outfile.create_group(array_events_key),
+                lambda start, end, data: array_selected[start:end],
+                chunksize,
+                progress,
+            )
+            log.info('Selected {} of {} rows of {}'.format(
+                n_selected, len(array_selected), array_events_key
+            ))
 
-        for chunk in tqdm(range(n_chunks), disable=not progress):
-            start = chunk * chunksize
-            end = min(n_events, (chunk + 1) * chunksize)
 
-            mask = create_mask_h5py(
-                input_path, selection_config, key=key, start=start, end=end
+class ArrayEventAggregator:
+    '''
+    Streaming mean and standard deviation of telescope event predictions
+    for each array event.
+
+    The count, mean and sum of squared deviations of each array event are
+    accumulated, so telescope events can come in any order.
+    Only the telescope events of the last, possibly incomplete, array event
+    of a chunk are kept until the next chunk.
+
+    `update` and `finish` return blocks (start, end, columns) of the
+    aggregated columns for the array events in rows [start:end], so they
+    can be written incrementally. Array events without telescope events are nan.
+    As long as the telescope events of the same array event are consecutive
+    and in the same order as the array events, which is how the files are
+    written, each chunk completes a block of array events.
+    Otherwise, all array events are returned by `finish`.
+    '''
+    def __init__(self, path, config, columns):
+        self.config = config
+        self.columns = list(columns)
+        self.output_columns = [
+            column + suffix for column in self.columns for suffix in ('_mean', '_std')
+        ]
+
+        join_columns = [config.run_id_column, config.array_event_id_column]
+        self.array_keys, array_events = read_array_events_sorted(
+            path, config, columns=join_columns
+        )
+        self.array_rows = array_events.index.values
+        self.n_array_events = len(self.array_keys)
+
+        self.n = {c: np.zeros(self.n_array_events, dtype=np.int64) for c in self.columns}
+        self.mean = {c: np.zeros(self.n_array_events) for c in self.columns}
+        self.m2 = {c: np.zeros(self.n_array_events) for c in self.columns}
+
+        self.next_row = 0
+        self.in_order = True
+        self.keys = None
+        self.values = None
+
+    def update(self, df, predictions):
+        '''
+        Add the predictions for the telescope events in df.
+        Returns the block of array events completed by this chunk
+        '''
+        keys = join_keys_array(df, self.config)
+        values = {c: np.asarray(predictions[c], dtype=float) for c in self.columns}
+
+        if self.keys is not None:
+            keys = np.concatenate([self.keys, keys])
+            values = {c: np.concatenate([self.values[c], values[c]]) for c in self.columns}
+
+        if len(keys) == 0:
+            return self.next_row, self.next_row, self._empty_block(0)
+
+        group_starts = np.append(0, np.flatnonzero(keys[1:] != keys[:-1]) + 1)
+
+        # keep the last group, it might continue in the next chunk
+        last = group_starts[-1]
+        self.keys = keys[last:]
+        self.values = {c: v[last:] for c, v in values.items()}
+
+        return self._aggregate(keys[:last], {c: v[:last] for c, v in values.items()}, group_starts[:-1])
+
+    def finish(self):
+        '''
+        Aggregate the last array event and return the
+        block of all remaining array events
+        '''
+        start = self.next_row
+        if self.keys is not None and len(self.keys) > 0:
+            self._aggregate(self.keys, self.values, np.array([0]))
+        self.keys = self.values = None
+
+        if not self.in_order:
+            start = 0
+        end = self.n_array_events
+        block = self._block(start, end)
+        self.next_row = end
+        return start, end, block
+
+    def _empty_block(self, n_rows):
+        return {c: np.full(n_rows, np.nan) for c in self.output_columns}
+
+    def _block(self, start, end):
+        block = {}
+        for column in self.columns:
+            n = self.n[column][start:end]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                block[column + '_mean'] = np.where(n > 0, self.mean[column][start:end], np.nan)
+                block[column + '_std'] = np.where(
+                    n > 1, np.sqrt(self.m2[column][start:end] / (n - 1)), np.nan
+                )
+        return block
+
+    def _merge(self, column, rows, n, mean, m2):
+        '''
+        Add the count, mean and sum of squared deviations of groups
+        of telescope events to those of the array events in rows
+        '''
+        # array events appearing more than once are added one after another
+        while len(rows) > 0:
+            _, first = np.unique(rows, return_index=True)
+            r = rows[first]
+            n_a, mean_a, m2_a = self.n[column][r], self.mean[column][r], self.m2[column][r]
+            n_b, mean_b, m2_b = n[first], mean[first], m2[first]
+
+            n_ab = n_a + n_b
+            with np.errstate(invalid='ignore', divide='ignore'):
+                delta = mean_b - mean_a
+                merged_mean = mean_a + delta * n_b / n_ab
+                merged_m2 = m2_a + m2_b + delta**2 * n_a * n_b / n_ab
+
+            self.mean[column][r] = np.where(
+                n_b == 0, mean_a, np.where(n_a == 0, mean_b, merged_mean)
             )
-
-            for name, dataset in infile[key].items():
-                if chunk == 0:
-                    if dataset.ndim == 1:
-                        group.create_dataset(name, data=dataset[start:end][mask], maxshape=(None, ))
-                    elif dataset.ndim == 2:
-                        group.create_dataset(
-                            name, data=dataset[start:end, :][mask, :], maxshape=(None, 2)
-                        )
-                    else:
-                        log.warning('Skipping not 1d or 2d column {}'.format(name))
-
-                else:
-
-                    n_old = group[name].shape[0]
-                    n_new = mask.sum()
-                    group[name].resize(n_old + n_new, axis=0)
-
-                    if dataset.ndim == 1:
-                        group[name][n_old:n_old + n_new] = dataset[start:end][mask]
-                    elif dataset.ndim == 2:
-                        group[name][n_old:n_old + n_new, :] = dataset[start:end][mask, :]
-                    else:
-                        log.warning('Skipping not 1d or 2d column {}'.format(name))
+            self.m2[column][r] = np.where(n_b == 0, m2_a, np.where(n_a == 0, m2_b, merged_m2))
+            self.n[column][r] = n_ab
+
+            rest = np.ones(len(rows), dtype=bool)
+            rest[first] = False
+            rows, n, mean, m2 = rows[rest], n[rest], mean[rest], m2[rest]
+
+    def _aggregate(self, keys, values, group_starts):
+        start = self.next_row
+        if len(group_starts) == 0:
+            return start, start, self._empty_block(0)
+
+        group_keys = keys[group_starts]
+        idx = np.searchsorted(self.array_keys, group_keys)
+        found = idx < self.n_array_events
+        found[found] = self.array_keys[idx[found]] == group_keys[found]
+        if not found.all():
+            raise ValueError('Found telescope events without corresponding array event')
+
+        rows = self.array_rows[idx]
+        if self.in_order and (rows[0] < start or np.any(np.diff(rows) <= 0)):
+            log.debug('Telescope events are not ordered like the array events')
+            self.in_order = False
+
+        group_sizes = np.diff(np.append(group_starts, len(keys)))
+        for column in self.columns:
+            value = values[column]
+            valid = ~np.isnan(value)
+            n = np.add.reduceat(valid.astype(np.int64), group_starts)
+            total = np.add.reduceat(np.where(valid, value, 0), group_starts)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = total / n
+                deviation = np.where(valid, value - np.repeat(mean, group_sizes), 0)
+                m2 = np.add.reduceat(deviation**2, group_starts)
+
+            self._merge(column, rows, n, mean, m2)
+
+        if not self.in_order:
+            return start, start, self._empty_block(0)
+
+        end = rows[-1] + 1
+        self.next_row = end
+        return start, end, self._block(start, end)
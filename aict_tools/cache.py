@@ -0,0 +1,213 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import h5py
+import numpy as np
+from sklearn.base import BaseEstimator
+
+from .io import sample_rows_seeded
+from .selection import read_rows, n_rows_group
+
+
+log = logging.getLogger(__name__)
+
+# increase when the layout of the cached arrays changes
+CACHE_VERSION = 2
+
+# model config attributes that do not change the training data
+NOT_DATA_ATTRIBUTES = {'n_cross_validations', 'calibrate_classifier'}
+
+# model config attributes built from sets, their order depends on the hash seed.
+# The read columns are part of the key as the sorted columns argument.
+COLUMN_ATTRIBUTES = {'columns_to_read_apply', 'columns_to_read_train'}
+
+
+def file_identity(path):
+    '''
+    Identify the file at path by its location, device and inode.
+    The modification time and size are not used, as the training scripts
+    add their prediction columns to the input files.
+    '''
+    stat = os.stat(path)
+    return [os.path.realpath(path), stat.st_dev, stat.st_ino]
+
+
+def column_fingerprint(path, key, columns=None, rows=None):
+    '''
+    Identify the columns of group key in the hdf5 file at path
+    by their shape, dtype and storage layout, which is cheap as no data is read.
+    If rows is given, a checksum of these rows is added, so for sampled
+    training data exactly the values that are read for training are hashed.
+    Changing the values of not sampled rows in place is not detected,
+    replacing the file is.
+    '''
+    with h5py.File(path, 'r') as f:
+        group = f[key]
+        if columns is None:
+            columns = group.keys()
+
+        fingerprint = []
+        for column in sorted(set(columns) & set(group.keys())):
+            dataset = group[column]
+            item = [
+                column,
+                list(dataset.shape),
+                dataset.dtype.str,
+                dataset.id.get_offset(),
+                dataset.id.get_storage_size(),
+            ]
+            if rows is not None:
+                values = read_rows(dataset, 0, len(dataset), rows)
+                item.append(hashlib.sha256(np.ascontiguousarray(values).tobytes()).hexdigest())
+            fingerprint.append(item)
+    return fingerprint
+
+
+def sampled_rows(path, key, n_sample):
+    '''
+    The rows of group key `read_telescope_data_sample` reads for n_sample events,
+    None if all rows are read.
+    '''
+    if n_sample is None:
+        return None
+
+    with h5py.File(path, 'r') as f:
+        n_rows = n_rows_group(f[key])
+
+    # the training script fails for too large samples, nothing gets cached
+    if n_sample > n_rows:
+        return None
+    return sample_rows_seeded(n_rows, n_sample)
+
+
+def model_config_items(model_config):
+    '''
+    The attributes of a model config that determine the training data,
+    the estimators and cross validation settings are not included,
+    so changing hyperparameters keeps the cache valid.
+    '''
+    items = {}
+    for name in model_config.__slots__:
+        value = getattr(model_config, name, None)
+        if name in NOT_DATA_ATTRIBUTES or name in COLUMN_ATTRIBUTES:
+            continue
+        if isinstance(value, BaseEstimator):
+            continue
+        items[name] = value
+    return items
+
+
+def training_cache_key(name, config, model_config, paths, columns, n_samples=None):
+    '''
+    Hash of everything the preprocessed training data of the training script
+    name depends on: the data related parts of the config, the seed,
+    the identity of the input files and their read columns and n_signal / n_background,
+    which are part of the model config.
+    n_samples gives the number of sampled events for each of paths, None
+    to read all events. The sampled telescope event rows are hashed.
+    '''
+    if n_samples is None:
+        n_samples = [None] * len(paths)
+
+    inputs = []
+    for path, n_sample in zip(paths, n_samples):
+        rows = sampled_rows(path, config.telescope_events_key, n_sample)
+        inputs.append([
+            file_identity(path),
+            column_fingerprint(path, config.telescope_events_key, columns, rows),
+            column_fingerprint(path, config.array_events_key, columns),
+        ])
+
+    key = {
+        'version': CACHE_VERSION,
+        'name': name,
+        'seed': config.seed,
+        'keys': [
+            config.telescope_events_key,
+            config.array_events_key,
+            config.run_id_column,
+            config.array_event_id_column,
+        ],
+        'model_config': model_config_items(model_config),
+        'columns': sorted(columns),
+        'inputs': inputs,
+    }
+    return hashlib.sha256(
+        json.dumps(key, sort_keys=True, default=str).encode('utf-8')
+    ).hexdigest()
+
+
+class TrainingCache:
+    '''
+    Directory of cached training arrays, one sub directory per key
+    containing one .npy file per array.
+    Cached arrays are returned as read only memory maps.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        '''
+        Return the dict of cached arrays for key or None if not cached
+        '''
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return None
+
+        return {
+            name[:-len('.npy')]: np.load(os.path.join(path, name), mmap_mode='r')
+            for name in os.listdir(path)
+            if name.endswith('.npy')
+        }
+
+    def store(self, key, arrays):
+        '''
+        Store a dict of arrays for key and return them as memory maps.
+        The arrays are written to a temporary directory first, which is
+        renamed at the end, so a cache entry is never incomplete.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp_')
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), np.asarray(array))
+            os.rename(tmp, self.path(key))
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            # another process stored the same key at the same time
+            if not os.path.isdir(self.path(key)):
+                raise
+        return self.load(key)
+
+    def get(self, key, compute):
+        '''
+        Return the cached arrays for key, calling compute to create
+        the dict of arrays if they are not cached yet.
+        '''
+        arrays = self.load(key)
+        if arrays is not None:
+            log.info('Using cached training data {}'.format(self.path(key)))
+            return arrays
+
+        arrays = compute()
+        log.info('Caching training data in {}'.format(self.path(key)))
+        return self.store(key, arrays)
+
+
+def cached_training_data(cache_dir, name, config, model_config, paths, columns, compute, n_samples=None):
+    '''
+    Return the dict of training arrays created by compute,
+    cached in cache_dir if it is not None.
+    '''
+    if cache_dir is None:
+        return compute()
+
+    key = training_cache_key(name, config, model_config, paths, columns, n_samples)
+    return TrainingCache(cache_dir).get(key, compute)
@@ -0,0 +1,61 @@
+import numpy as np
+from sklearn.calibration import _SigmoidCalibration
+from sklearn.isotonic import IsotonicRegression
+
+
+CALIBRATION_METHODS = ('sigmoid', 'isotonic')
+
+
+def fit_calibration(scores, labels, method='sigmoid'):
+    '''
+    Fit a mapping of the signal scores of a binary classifier
+    to calibrated probabilities, using the same sigmoid or isotonic
+    calibration as sklearn's CalibratedClassifierCV.
+
+    The scores should be out-of-fold predictions, e.g. those of
+    the cross validation, so they are not biased by the training.
+    '''
+    if method == 'sigmoid':
+        calibrator = _SigmoidCalibration()
+    elif method == 'isotonic':
+        calibrator = IsotonicRegression(out_of_bounds='clip')
+    else:
+        raise ValueError('Unknown calibration method {}, use one of {}'.format(
+            method, CALIBRATION_METHODS
+        ))
+
+    calibrator.fit(np.asarray(scores, dtype=np.float64), np.asarray(labels))
+    return calibrator
+
+
+class CalibratedClassifier:
+    '''
+    A fitted binary classifier and a calibration of its signal score,
+    created by fit_calibration.
+
+    predict_proba returns the calibrated probabilities.
+    n_jobs is passed through to the classifier.
+    '''
+    def __init__(self, estimator, calibrator):
+        self.estimator = estimator
+        self.calibrator = calibrator
+
+    @property
+    def classes_(self):
+        return self.estimator.classes_
+
+    @property
+    def n_jobs(self):
+        return getattr(self.estimator, 'n_jobs', 1)
+
+    @n_jobs.setter
+    def n_jobs(self, n_jobs):
+        self.estimator.n_jobs = n_jobs
+
+    def predict_proba(self, X):
+        scores = self.estimator.predict_proba(X)[:, 1]
+        proba = np.clip(self.calibrator.predict(scores), 0, 1)
+        return np.column_stack([1 - proba, proba])
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
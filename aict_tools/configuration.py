@@ -1,4 +1,6 @@
 import yaml
+import json
+import hashlib
 from sklearn import ensemble
 from collections import namedtuple
 from .features import find_used_source_features
@@ -24,7 +26,9 @@ class AICTConfig:
         'x_max',
         'separator',
         'has_multiple_telescopes',
-        #'selection'
+        'config_hash',
+        'selection',
+        'gamma_cascade',
         # 'class_name',
     )
 
@@ -34,6 +38,11 @@ class AICTConfig:
             return cls(yaml.load(f))
 
     def __init__(self, config):
+        # stored with trained models to recognize the config used for training
+        self.config_hash = hashlib.sha256(
+            json.dumps(config, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()
+
         self.has_multiple_telescopes = config.get('multiple_telescopes', False)
         self.runs_key = config.get('runs_key', 'runs')
 
@@ -46,14 +55,17 @@ class AICTConfig:
         )
         self.run_id_column = config.get('run_id_column', 'run_id')
 
-        #self.selection = config.get('selection')
+        # cuts in the format of aict_apply_cuts, used by --apply-selection
+        self.selection = config.get('selection')
+        # gamma score threshold for the cascade mode, see apply.GammaCascade
+        self.gamma_cascade = config.get('gamma_cascade')
 
 
         self.seed = config.get('seed', 0)
         np.random.seed(self.seed)
         # self.class_name = config.get('class_name', 'gamma')
 
-        self.disp = self.energy = self.separator = None
+        self.disp = self.energy = self.separator = self.x_max = None
         if 'disp' in config:
             self.disp = DispConfig(config)
 
@@ -122,6 +134,8 @@ class DispConfig:
             self.cog_x_column,
             self.cog_y_column,
             self.delta_column,
+            self.pointing_az_column,
+            self.pointing_alt_column,
         }
 
         cols.update(model_config['features'])
@@ -129,8 +143,6 @@ class DispConfig:
             cols.update(self.feature_generation.needed_columns)
         self.columns_to_read_apply = list(cols)
         cols.update({
-            self.pointing_az_column,
-            self.pointing_alt_column,
             self.source_az_column,
             self.source_alt_column,
         })
@@ -209,7 +221,13 @@ class SeparatorConfig:
         self.n_background = model_config.get('n_background', None)
         k = 'n_cross_validations'
         setattr(self, k, model_config.get(k, config.get(k, 5)))
+        # true: CalibratedClassifierCV with two extra fits,
+        # 'sigmoid' or 'isotonic': calibration on the out-of-fold cv scores
         self.calibrate_classifier = model_config.get('calibrate_classifier', False)
+        if self.calibrate_classifier in (False, True):
+            self.calibrate_classifier = bool(self.calibrate_classifier)
+        elif self.calibrate_classifier not in ('sigmoid', 'isotonic'):
+            raise ValueError('calibrate_classifier must be a bool, "sigmoid" or "isotonic"')
 
         gen_config = model_config.get('feature_generation')
         source_features = find_used_source_features(self.features, gen_config)
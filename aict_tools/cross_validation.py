@@ -0,0 +1,212 @@
+import logging
+from functools import partial
+
+import click
+import numpy as np
+from sklearn.base import clone, is_classifier
+from sklearn.tree import DecisionTreeClassifier, DecisionTreeRegressor
+from tqdm import tqdm
+
+from .ensemble import FORESTS, combine_fold_models
+from .io import check_model_path
+from .parallel import resolve_n_jobs, split_n_jobs, run_concurrently, run_folds
+
+
+log = logging.getLogger(__name__)
+
+# models skipping rows with zero sample weight, unless they bootstrap
+ROW_WEIGHT_MODELS = FORESTS + (DecisionTreeClassifier, DecisionTreeRegressor)
+
+
+def fold_options(command):
+    '''
+    Add the --fold-jobs, --fold-ensemble and --subsample-trees options
+    of CrossValidation to a training script
+    '''
+    options = [
+        click.option(
+            '--fold-jobs', type=int, default=1, show_default=True,
+            help='Number of cross validation folds to fit concurrently in worker'
+            ' processes, splitting the n_jobs of the model between them',
+        ),
+        click.option(
+            '--fold-ensemble', is_flag=True,
+            help='Save the models of the cross validation folds as an averaged ensemble'
+            ' instead of fitting the model again on the complete data set',
+        ),
+        click.option(
+            '--subsample-trees', is_flag=True,
+            help='With --fold-ensemble, keep only n_estimators / n_cross_validations'
+            ' trees of each fold forest, so the ensemble is as large as a single model',
+        ),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def fits_rows_by_weight(model, X, y, rows):
+    '''
+    Whether fitting model on X with a sample weight of one for rows and zero
+    otherwise gives the same model as fitting it on X[rows].
+    True for trees and forests without bootstrapping and class weights,
+    if X needs no conversion and all classes appear in rows.
+    '''
+    if type(model) not in ROW_WEIGHT_MODELS:
+        return False
+    if getattr(model, 'bootstrap', False) or getattr(model, 'class_weight', None) is not None:
+        return False
+    if X.dtype != np.float32 or not np.isfinite(X).all():
+        return False
+    if is_classifier(model) and len(np.unique(y[rows])) != len(np.unique(y)):
+        return False
+    return True
+
+
+def fit_rows(model, X, y, rows):
+    '''
+    Fit model on the rows of X and y,
+    without copying X if the model allows it, see fits_rows_by_weight.
+    '''
+    if fits_rows_by_weight(model, X, y, rows):
+        sample_weight = np.zeros(len(X))
+        sample_weight[rows] = 1
+        return model.fit(X, y, sample_weight=sample_weight)
+    return model.fit(X[rows], y[rows])
+
+
+def predict(model, X):
+    '''
+    Predictions stored for the cross validation,
+    (predict_proba[:, 1], predict) for classifiers
+    '''
+    if is_classifier(model):
+        return model.predict_proba(X)[:, 1], model.predict(X)
+    return model.predict(X)
+
+
+def fit_and_predict(models, train, test, X, *targets, return_models=False):
+    '''
+    Fit each of models on the train rows of X and its target
+    and predict the test rows. Several models are fit concurrently.
+    Returns the list of predictions of the models,
+    with return_models a tuple of fitted copies of the models and the predictions.
+    '''
+    if return_models:
+        models = [clone(model) for model in models]
+
+    def fit_and_predict_model(model, y, X_test):
+        fit_rows(model, X, y, train)
+        return predict(model, X_test)
+
+    X_test = X[test]
+    predictions = run_concurrently(*[
+        (fit_and_predict_model, model, y, X_test)
+        for model, y in zip(models, targets)
+    ])
+    return (models, predictions) if return_models else predictions
+
+
+class CrossValidation:
+    '''
+    Cross validation of models trained on the same features,
+    each on its own target, and fitting of the models stored afterwards.
+
+    The model paths are checked on construction, so the training scripts
+    fail before the training, see check_model_path.
+
+    The models of a fold are fit concurrently, with fold_jobs > 1
+    the folds are run concurrently in worker processes, see run_folds.
+    The threads of the models are split between them.
+
+    After the cross validation, final_models either fits the models
+    again on the complete data set, or with fold_ensemble combines
+    the models of the folds, see combine_fold_models.
+    '''
+    def __init__(
+        self, models, model_paths, seed,
+        fold_jobs=1, fold_ensemble=False, subsample_trees=False,
+    ):
+        self.models = list(models)
+        self.seed = seed
+        self.fold_jobs = fold_jobs
+        self.fold_ensemble = fold_ensemble
+        self.subsample_trees = subsample_trees
+        self.fold_models = []
+
+        for model, model_path in zip(self.models, model_paths):
+            check_model_path(model_path, model, fold_ensemble)
+
+        self.threaded = [m for m in self.models if hasattr(m, 'n_jobs')]
+        self.original_n_jobs = [m.n_jobs for m in self.threaded]
+        self.n_jobs = max([resolve_n_jobs(n) for n in self.original_n_jobs], default=1)
+
+    def share_n_jobs(self, n_jobs):
+        for model, n in zip(self.threaded, split_n_jobs(n_jobs, max(1, len(self.threaded)))):
+            model.n_jobs = n
+
+    def restore_n_jobs(self):
+        for model, n_jobs in zip(self.threaded, self.original_n_jobs):
+            model.n_jobs = n_jobs
+
+    def seed_models(self):
+        # the folds are fit with the same seed, so they are independent of
+        # each other and of the order they are run in. Setting it again before
+        # the final fit makes sure n_cross_validations does not change the final model.
+        np.random.seed(self.seed)
+        for model in self.models:
+            model.random_state = self.seed
+
+    def run(self, folds, X, *targets):
+        '''
+        Run the cross validation for the (train, test) row indices of folds.
+        Yields fold number, test rows and the list of the predictions of the models
+        for the test rows, see predict.
+        '''
+        folds = list(folds)
+        self.seed_models()
+        # each concurrent fold gets an equal part of the threads
+        if self.fold_jobs > 1:
+            self.share_n_jobs(split_n_jobs(self.n_jobs, self.fold_jobs)[-1])
+        else:
+            self.share_n_jobs(self.n_jobs)
+
+        self.fold_models = []
+        results = run_folds(
+            partial(fit_and_predict, self.models, return_models=self.fold_ensemble),
+            [X, *targets], folds, self.fold_jobs,
+        )
+        for fold, ((train, test), result) in tqdm(
+            enumerate(zip(folds, results)), total=len(folds)
+        ):
+            if self.fold_ensemble:
+                fold_models, result = result
+                self.fold_models.append(fold_models)
+            yield fold, test, result
+
+    def final_models(self, X, *targets, refit=None):
+        '''
+        Return the models to store after the cross validation.
+        Without fold_ensemble, the models are fit on the complete data set,
+        refit can return an estimator wrapping a model to fit instead of it.
+        '''
+        if self.fold_ensemble:
+            log.info('Combining the models of the cross validation...')
+            models = [
+                combine_fold_models(fold_models, subsample_trees=self.subsample_trees)
+                for fold_models in zip(*self.fold_models)
+            ]
+            self.restore_n_jobs()
+            for ensemble, model in zip(models, self.models):
+                if hasattr(model, 'n_jobs'):
+                    ensemble.n_jobs = model.n_jobs
+        else:
+            log.info('Building new model on complete data set...')
+            self.seed_models()
+            self.share_n_jobs(self.n_jobs)
+            models = [refit(m) if refit else m for m in self.models]
+            run_concurrently(*[(m.fit, X, y) for m, y in zip(models, targets)])
+            self.restore_n_jobs()
+
+        return models
+
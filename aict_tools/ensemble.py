@@ -0,0 +1,169 @@
+import copy
+
+import numpy as np
+from sklearn.ensemble import (
+    ExtraTreesClassifier,
+    ExtraTreesRegressor,
+    RandomForestClassifier,
+    RandomForestRegressor,
+)
+
+from .parallel import resolve_n_jobs, run_concurrently
+
+
+# forests whose prediction is the mean over their trees
+FORESTS = (
+    RandomForestClassifier,
+    RandomForestRegressor,
+    ExtraTreesClassifier,
+    ExtraTreesRegressor,
+)
+
+
+class FoldEnsemble:
+    '''
+    Average of the predictions of the models fitted in the folds
+    of a cross validation, for models that cannot be merged into
+    a single forest by combine_fold_models.
+    n_jobs is passed through to all models.
+    '''
+    def __init__(self, models):
+        self.models = list(models)
+
+    @property
+    def classes_(self):
+        return self.models[0].classes_
+
+    @property
+    def n_jobs(self):
+        return getattr(self.models[0], 'n_jobs', 1)
+
+    @n_jobs.setter
+    def n_jobs(self, n_jobs):
+        for model in self.models:
+            model.n_jobs = n_jobs
+
+    def predict_proba(self, X):
+        return np.mean([m.predict_proba(X) for m in self.models], axis=0)
+
+    def predict(self, X):
+        if hasattr(self.models[0], 'classes_'):
+            return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+        return np.mean([m.predict(X) for m in self.models], axis=0)
+
+
+def combine_fold_models(models, subsample_trees=False):
+    '''
+    Combine the models fitted in the folds of a cross validation
+    into one model averaging their predictions.
+
+    Forests are merged into a single forest of the same type containing the
+    trees of all folds, which can be used and stored like any other forest.
+    With subsample_trees, only n_estimators / len(models) trees of each
+    forest are kept, so the merged forest is as large as each fold forest.
+    Other models are wrapped in a FoldEnsemble.
+    '''
+    models = list(models)
+    if not all(type(m) in FORESTS for m in models) or len(set(map(type, models))) != 1:
+        return FoldEnsemble(models)
+
+    classes = getattr(models[0], 'classes_', None)
+    if classes is not None and not all(np.array_equal(m.classes_, classes) for m in models):
+        raise ValueError('All fold models must have seen the same classes')
+
+    # same number of trees per fold, so all folds have the same weight
+    n_trees = min(len(m.estimators_) for m in models)
+    if subsample_trees:
+        n_trees = max(1, n_trees // len(models))
+
+    forest = copy.copy(models[0])
+    forest.estimators_ = [tree for m in models for tree in m.estimators_[:n_trees]]
+    forest.n_estimators = len(forest.estimators_)
+    return forest
+
+
+def _leaf_bounds(tree, column):
+    '''
+    Smallest and largest probability of class column in the leaves of tree
+    '''
+    leaf = tree.tree_.children_left == -1
+    proba = tree.tree_.value[leaf, 0, :]
+    # older sklearn versions store class counts instead of fractions
+    normalizer = proba.sum(axis=1)
+    normalizer[normalizer == 0] = 1
+    proba = proba[:, column] / normalizer
+    return proba.min(), proba.max()
+
+
+def predict_proba_thresholded(model, X, threshold, column=1, n_trees_per_step=8):
+    '''
+    Decide for each event whether model.predict_proba(X)[:, column] >= threshold.
+
+    For classification forests, the trees are evaluated in steps of
+    n_trees_per_step trees using their compiled predict_proba. After each step,
+    events are not evaluated further as soon as the remaining trees cannot
+    change the decision, using the smallest and largest leaf probability
+    of each tree. Other models evaluate predict_proba for all events.
+
+    Returns score, passed and early:
+    score is the exact probability for all events evaluated by all trees
+    and nan for the events decided early, which are flagged by early.
+    passed is the decision for all events.
+    '''
+    if type(model) not in FORESTS or not hasattr(model, 'classes_'):
+        score = model.predict_proba(X)[:, column]
+        return score, score >= threshold, np.zeros(len(X), dtype=bool)
+
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    trees = model.estimators_
+    n_trees = len(trees)
+
+    minimum, maximum = np.array([_leaf_bounds(tree, column) for tree in trees]).T
+    # sum of the bounds of the trees not evaluated yet, after k trees
+    remaining_min = np.append(np.cumsum(minimum[::-1])[::-1], 0)
+    remaining_max = np.append(np.cumsum(maximum[::-1])[::-1], 0)
+    # tolerance for the different summation order of the bounds
+    eps = 1e-9
+
+    total = np.zeros(len(X))
+    early = np.zeros(len(X), dtype=bool)
+    passed = np.zeros(len(X), dtype=bool)
+    active = np.arange(len(X))
+    X_active = X
+    n_jobs = resolve_n_jobs(getattr(model, 'n_jobs', None))
+    # evaluate at least one tree per thread in each step
+    n_trees_per_step = max(n_trees_per_step, n_jobs)
+
+    for first in range(0, n_trees, n_trees_per_step):
+        step = trees[first:first + n_trees_per_step]
+        probas = []
+        for start in range(0, len(step), n_jobs):
+            probas.extend(run_concurrently(*[
+                (tree.predict_proba, X_active, False) for tree in step[start:start + n_jobs]
+            ]))
+
+        # add the trees one after another like scikit-learn does
+        partial = total[active]
+        for proba in probas:
+            partial += proba[:, column]
+        total[active] = partial
+
+        n_done = first + len(step)
+        if n_done == n_trees:
+            break
+
+        lower = (partial + remaining_min[n_done]) / n_trees
+        upper = (partial + remaining_max[n_done]) / n_trees
+        done = (upper < threshold - eps) | (lower >= threshold + eps)
+        if done.any():
+            early[active[done]] = True
+            passed[active[done]] = lower[done] >= threshold + eps
+            active = active[~done]
+            if len(active) == 0:
+                break
+            X_active = X[active]
+
+    score = total / n_trees
+    passed[~early] = score[~early] >= threshold
+    score[early] = np.nan
+    return score, passed, early
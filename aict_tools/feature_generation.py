@@ -1,5 +1,102 @@
-# imported so expressions can use @pi
-from numpy import pi
+import re
+import logging
+
+import numpy as np
+import numexpr as ne
+import pandas as pd
+
+
+log = logging.getLogger(__name__)
+
+# constants that can be used in expressions as @name
+constants = {'pi': np.pi, 'e': np.e}
+
+constant_re = re.compile(r'@(\w+)')
+
+
+class FeatureGenerator:
+    '''
+    Compiled version of a FeatureGenerationConfig.
+
+    All needed columns are taken once as contiguous arrays
+    and all features are evaluated on these arrays using numexpr,
+    in the order given in the config.
+    Generated features can use the features generated before them.
+    Expressions numexpr cannot handle are evaluated with pandas.eval.
+    '''
+    def __init__(self, config):
+        self.needed_columns = list(config.needed_columns)
+        self.features = []
+        self.constants = {}
+
+        for feature_name, expression in config.features.items():
+            for name in constant_re.findall(expression):
+                if name not in constants:
+                    raise ValueError(
+                        'Unknown constant @{} in feature {}'.format(name, feature_name)
+                    )
+                self.constants['__constant_' + name] = constants[name]
+
+            self.features.append((
+                feature_name,
+                expression,
+                constant_re.sub(r'__constant_\1', expression),
+            ))
+
+        # features numexpr failed to evaluate
+        self.use_pandas = set()
+
+    def get_arrays(self, df):
+        arrays = {}
+        for column in self.needed_columns:
+            values = df[column].values
+            if values.dtype.kind in 'iu':
+                values = values.astype(np.float64)
+            arrays[column] = np.ascontiguousarray(values)
+        return arrays
+
+    def evaluate(self, df):
+        '''
+        Returns a dict feature name -> array of the generated features
+        '''
+        arrays = self.get_arrays(df)
+        variables = dict(self.constants)
+        variables.update(arrays)
+
+        result = {}
+        for feature_name, expression, ne_expression in self.features:
+            if feature_name not in self.use_pandas:
+                try:
+                    values = ne.evaluate(ne_expression, local_dict=variables)
+                except (KeyError, NotImplementedError, SyntaxError, TypeError, ValueError):
+                    log.debug('Falling back to pandas.eval for {}'.format(feature_name))
+                    self.use_pandas.add(feature_name)
+
+            if feature_name in self.use_pandas:
+                values = self.evaluate_pandas(expression, arrays, len(df))
+
+            result[feature_name] = values
+            variables[feature_name] = arrays[feature_name] = values
+
+        return result
+
+    @staticmethod
+    def evaluate_pandas(expression, arrays, n_rows):
+        frame = pd.DataFrame(arrays, index=np.arange(n_rows), copy=False)
+        return frame.eval(expression, local_dict=constants).values
+
+
+_compiled = {}
+
+
+def compile_feature_generation(config):
+    '''
+    Return the cached FeatureGenerator for config
+    '''
+    key = (tuple(config.needed_columns), tuple(config.features.items()))
+    if key not in _compiled:
+        _compiled[key] = FeatureGenerator(config)
+    return _compiled[key]
 
 
 def feature_generation(df, config, inplace=False):
@@ -9,8 +106,9 @@ def feature_generation(df, config, inplace=False):
     if config is None:
         return df
 
-    for feature_name, expression in config.features.items():
-        df[feature_name] = df.loc[:, config.needed_columns].eval(expression)
+    generator = compile_feature_generation(config)
+    for feature_name, values in generator.evaluate(df).items():
+        df[feature_name] = values
 
     if not inplace:
         return df
@@ -0,0 +1,446 @@
+import json
+import mmap
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import cpu_count
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.tree._tree import Tree, NODE_DTYPE
+
+from .ensemble import FORESTS
+
+
+# marker for leaves in sklearn's tree arrays
+TREE_LEAF = -1
+# feature and threshold of leaves in sklearn's tree arrays
+TREE_UNDEFINED = -2
+
+# file format: magic, header length (uint64), json header,
+# then the arrays, each starting at a page boundary
+MAGIC = b'AICTFRST'
+FORMAT_VERSION = 1
+ARRAYS = ('feature', 'threshold', 'children', 'is_leaf', 'value', 'roots')
+
+
+def _align(offset):
+    return -(-offset // mmap.ALLOCATIONGRANULARITY) * mmap.ALLOCATIONGRANULARITY
+
+
+def float32_floor(values):
+    '''
+    Largest float32 values less or equal than the given float64 values,
+    so that for float32 x: x <= value if and only if x <= float32_floor(value)
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    rounded = values.astype(np.float32)
+    too_large = rounded > values
+    rounded[too_large] = np.nextafter(rounded[too_large], np.float32(-np.inf))
+    return rounded
+
+
+class CompactForest:
+    '''
+    Tree ensemble stored as contiguous node arrays of all trees,
+    evaluated by a batched numpy traversal.
+
+    Nodes of all trees are concatenated, `roots` holds the index of the
+    first node of each tree. The children of node i are
+    `children[2 * i]` (feature <= threshold) and `children[2 * i + 1]`.
+    Thresholds are rounded down to float32, which gives the same decisions
+    for float32 features as sklearn's float64 thresholds.
+
+    For regressors, `value` holds the prediction of each node,
+    for classifiers the normalized class probabilities.
+    Predictions are accumulated tree by tree in the same order as
+    scikit-learn does, so results are numerically equal.
+
+    Create from a fitted RandomForest or ExtraTrees model using
+    `CompactForest.from_sklearn(model)`, store and memory map it
+    using `save` and `load`.
+
+    The numpy traversal is slower than scikit-learn's compiled trees
+    except for small chunks. `to_sklearn` rebuilds the scikit-learn forest,
+    which `aict_tools.io.load_model` uses to predict with .forest files.
+    '''
+    # number of events traversed at once
+    batch_size = 2**16
+    # number of (tree, event) pairs traversed at once
+    batch_lanes = 2**16
+    # number of tree levels after which finished events are removed
+    compact_every = 4
+
+    def __init__(
+        self,
+        feature,
+        threshold,
+        children,
+        value,
+        roots,
+        is_leaf=None,
+        classes=None,
+        feature_names=None,
+        config_hash=None,
+        n_jobs=1,
+        n_features=None,
+        model_type=None,
+    ):
+        # arrays already in the right layout, e.g. memory maps, are not copied
+        self.feature = np.ascontiguousarray(feature, dtype=np.intp)
+        self.threshold = np.ascontiguousarray(threshold, dtype=np.float32)
+        self.children = np.ascontiguousarray(children, dtype=np.intp)
+        self.value = np.ascontiguousarray(value, dtype=np.float64)
+        self.roots = np.ascontiguousarray(roots, dtype=np.intp)
+        if is_leaf is None:
+            is_leaf = self.children[::2] == np.arange(len(self.feature))
+        self.is_leaf = np.ascontiguousarray(is_leaf, dtype=bool)
+        self.classes_ = None if classes is None else np.asarray(classes)
+        self.feature_names = None if feature_names is None else list(feature_names)
+        self.config_hash = config_hash
+        self.n_jobs = n_jobs
+        self.n_features = n_features
+        self.model_type = model_type
+
+    @property
+    def is_classifier(self):
+        return self.classes_ is not None
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    @classmethod
+    def from_sklearn(cls, model):
+        '''
+        Export a fitted sklearn forest with a single output.
+        Raises TypeError for unsupported models.
+        '''
+        # gradient boosting models have a 2d array of trees
+        estimators = getattr(model, 'estimators_', None)
+        if estimators is None or len(estimators) == 0 or not all(
+            hasattr(e, 'tree_') for e in estimators
+        ):
+            raise TypeError('Cannot export model of type {}'.format(type(model).__name__))
+
+        if getattr(model, 'n_outputs_', 1) != 1:
+            raise TypeError('Only models with a single output are supported')
+
+        classes = getattr(model, 'classes_', None)
+
+        features = []
+        thresholds = []
+        children = []
+        values = []
+        roots = []
+        offset = 0
+
+        for estimator in estimators:
+            tree = estimator.tree_
+            n_nodes = tree.node_count
+            # leaves point to themselves
+            leaf = tree.children_left == TREE_LEAF
+            own_index = np.arange(offset, offset + n_nodes)
+
+            features.append(np.where(leaf, 0, tree.feature))
+            thresholds.append(float32_floor(np.where(leaf, 0.0, tree.threshold)))
+            children.append(np.column_stack([
+                np.where(leaf, own_index, tree.children_left + offset),
+                np.where(leaf, own_index, tree.children_right + offset),
+            ]).ravel())
+
+            if classes is None:
+                values.append(tree.value[:, 0, 0])
+            else:
+                proba = tree.value[:, 0, :estimator.n_classes_]
+                normalizer = proba.sum(axis=1)[:, np.newaxis]
+                # older sklearn versions store class counts and normalize
+                # them in predict_proba, newer ones store the fractions
+                if not np.allclose(normalizer[normalizer != 0], 1, rtol=0, atol=1e-9):
+                    normalizer[normalizer == 0.0] = 1.0
+                    proba = proba / normalizer
+                values.append(proba)
+
+            roots.append(offset)
+            offset += n_nodes
+
+        return cls(
+            feature=np.concatenate(features),
+            threshold=np.concatenate(thresholds),
+            children=np.concatenate(children),
+            value=np.concatenate(values),
+            roots=roots,
+            classes=classes,
+            feature_names=getattr(model, 'feature_names', None),
+            config_hash=getattr(model, 'config_hash', None),
+            n_jobs=getattr(model, 'n_jobs', 1),
+            n_features=int(model.n_features_in_),
+            model_type=type(model).__name__,
+        )
+
+    def save(self, path):
+        '''
+        Write the forest into an uncompressed file, that can be
+        memory mapped by `CompactForest.load`.
+        '''
+        arrays = {}
+        offset = 0
+        for name in ARRAYS:
+            array = getattr(self, name)
+            arrays[name] = {
+                'dtype': array.dtype.str,
+                'shape': list(array.shape),
+                'offset': offset,
+            }
+            offset = _align(offset + array.nbytes)
+
+        header = {
+            'format_version': FORMAT_VERSION,
+            'feature_names': self.feature_names,
+            'config_hash': self.config_hash,
+            'n_features': self.n_features,
+            'model_type': self.model_type,
+            'classes': None if self.classes_ is None else self.classes_.tolist(),
+            'classes_dtype': None if self.classes_ is None else self.classes_.dtype.str,
+            'arrays': arrays,
+        }
+        header = json.dumps(header).encode('utf-8')
+        data_start = _align(len(MAGIC) + 8 + len(header))
+
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for name in ARRAYS:
+                f.seek(data_start + arrays[name]['offset'])
+                f.write(getattr(self, name).tobytes())
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a forest written by `CompactForest.save`.
+        The node arrays are read only memory maps of the file,
+        so all processes using the same file share the same memory.
+        '''
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError('{} is not a compact forest file'.format(path))
+            header_length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_length).decode('utf-8'))
+
+        if header['format_version'] != FORMAT_VERSION:
+            raise IOError('Unsupported format version {} in {}'.format(
+                header['format_version'], path
+            ))
+
+        data_start = _align(len(MAGIC) + 8 + header_length)
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=spec['dtype'])
+            else:
+                arrays[name] = np.memmap(
+                    path,
+                    dtype=spec['dtype'],
+                    mode='r',
+                    offset=data_start + spec['offset'],
+                    shape=shape,
+                )
+
+        classes = header['classes']
+        if classes is not None:
+            classes = np.array(classes, dtype=header['classes_dtype'])
+
+        return cls(
+            classes=classes,
+            feature_names=header['feature_names'],
+            config_hash=header['config_hash'],
+            n_features=header.get('n_features'),
+            model_type=header.get('model_type'),
+            **arrays
+        )
+
+    def _tree(self, first, end, n_features):
+        '''
+        Rebuild the sklearn Tree of the nodes [first:end]
+        '''
+        n_nodes = end - first
+        leaf = self.is_leaf[first:end]
+        children = self.children[2 * first:2 * end].reshape(n_nodes, 2) - first
+
+        nodes = np.zeros(n_nodes, dtype=NODE_DTYPE)
+        nodes['left_child'] = np.where(leaf, TREE_LEAF, children[:, 0])
+        nodes['right_child'] = np.where(leaf, TREE_LEAF, children[:, 1])
+        nodes['feature'] = np.where(leaf, TREE_UNDEFINED, self.feature[first:end])
+        nodes['threshold'] = np.where(leaf, TREE_UNDEFINED, self.threshold[first:end])
+        if 'missing_go_to_left' in NODE_DTYPE.names:
+            # same as the numpy traversal, nan is never larger than the threshold
+            nodes['missing_go_to_left'] = 1
+
+        # depth of the deepest leaf, stored with the sklearn tree
+        depth = 0
+        level = np.array([0])
+        while True:
+            level = level[~leaf[level]]
+            if len(level) == 0:
+                break
+            level = children[level].ravel()
+            depth += 1
+
+        value = np.ascontiguousarray(self.value[first:end].reshape(n_nodes, 1, -1))
+        n_classes = np.array([value.shape[2]], dtype=np.intp)
+        tree = Tree(n_features, n_classes, 1)
+        tree.__setstate__({
+            'max_depth': depth,
+            'node_count': n_nodes,
+            'nodes': nodes,
+            'values': value,
+        })
+        return tree
+
+    def to_sklearn(self):
+        '''
+        Rebuild the scikit-learn forest, predicting with its compiled trees.
+        The trees copy the node arrays, so the memory of a loaded forest
+        is not shared with other processes.
+        Only the attributes needed for prediction are restored,
+        impurities and sample counts of the nodes are not stored.
+        '''
+        n_features = self.n_features
+        if n_features is None:
+            n_features = len(self.feature_names) if self.feature_names else int(self.feature.max()) + 1
+
+        default = 'RandomForestClassifier' if self.is_classifier else 'RandomForestRegressor'
+        forests = {cls.__name__: cls for cls in FORESTS}
+        model = forests[self.model_type or default](n_jobs=self.n_jobs)
+        # renamed from base_estimator in sklearn 1.2
+        base = getattr(model, 'estimator', None) or model.base_estimator
+
+        ends = np.append(self.roots[1:], self.n_nodes)
+        estimators = []
+        for first, end in zip(self.roots, ends):
+            estimator = clone(base)
+            estimator.tree_ = self._tree(first, end, n_features)
+            estimator.n_outputs_ = 1
+            estimator.n_features_in_ = n_features
+            estimator.max_features_ = n_features
+            if self.is_classifier:
+                estimator.n_classes_ = len(self.classes_)
+                estimator.classes_ = np.arange(len(self.classes_), dtype=float)
+            estimators.append(estimator)
+
+        model.estimator_ = clone(base)
+        model.estimators_ = estimators
+        model.n_estimators = len(estimators)
+        model.n_outputs_ = 1
+        model.n_features_in_ = n_features
+        if self.is_classifier:
+            model.classes_ = self.classes_
+            model.n_classes_ = len(self.classes_)
+        model.feature_names = self.feature_names
+        model.config_hash = self.config_hash
+        return model
+
+    def _traverse(self, roots, X, leaves):
+        '''
+        Fill leaves (shape (len(roots), n_events)) with the leaves
+        reached by each event of X in the trees starting at roots.
+        '''
+        n_events, n_features = X.shape
+        flat = X.ravel()
+
+        leaves = leaves.reshape(-1)
+        # one lane per tree and event
+        active = np.arange(len(leaves))
+        rows = np.tile(np.arange(n_events) * n_features, len(roots))
+        nodes = np.repeat(roots, n_events)
+
+        depth = 0
+        while len(active) > 0:
+            index = np.take(self.feature, nodes)
+            index += rows
+            go_right = np.take(flat, index) > np.take(self.threshold, nodes)
+            nodes *= 2
+            nodes += go_right
+            nodes = np.take(self.children, nodes)
+            depth += 1
+
+            # leaves point to themselves, so removing the finished lanes
+            # only every few levels does not change the result
+            if depth % self.compact_every == 0:
+                done = np.take(self.is_leaf, nodes)
+                if done.any():
+                    leaves[active[done]] = nodes[done]
+                    running = ~done
+                    active = active[running]
+                    rows = rows[running]
+                    nodes = nodes[running]
+
+    def _batches(self, X):
+        '''
+        Traverse all trees for batches of events,
+        yields start, end and the reached leaves of shape (n_trees, end - start)
+        '''
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n_jobs = cpu_count() if self.n_jobs in (None, -1) else max(1, self.n_jobs)
+
+        with ThreadPoolExecutor(n_jobs) if n_jobs > 1 else nullcontext() as pool:
+            for start in range(0, len(X), self.batch_size):
+                end = min(start + self.batch_size, len(X))
+
+                leaves = np.empty((self.n_trees, end - start), dtype=np.intp)
+                # traverse as many trees at once as fit into batch_lanes,
+                # but make at least one group of trees per thread
+                n_trees = max(1, min(
+                    self.batch_lanes // (end - start),
+                    int(np.ceil(self.n_trees / n_jobs)),
+                ))
+                groups = [
+                    (self.roots[first:first + n_trees], X[start:end], leaves[first:first + n_trees])
+                    for first in range(0, self.n_trees, n_trees)
+                ]
+                if pool is None:
+                    for group in groups:
+                        self._traverse(*group)
+                else:
+                    # numpy releases the GIL in take and the comparisons
+                    list(pool.map(lambda group: self._traverse(*group), groups))
+
+                yield start, end, leaves
+
+    def apply(self, X):
+        '''
+        Return the index of the leaf reached in each tree,
+        shape (n_trees, n_events)
+        '''
+        leaves = np.empty((self.n_trees, len(X)), dtype=np.intp)
+        for start, end, nodes in self._batches(X):
+            leaves[:, start:end] = nodes
+        return leaves
+
+    def _mean_value(self, X):
+        result = np.empty((len(X), ) + self.value.shape[1:])
+        for start, end, nodes in self._batches(X):
+            # add up the trees one after another like scikit-learn does,
+            # without a temporary for the values of all trees
+            total = result[start:end]
+            np.take(self.value, nodes[0], axis=0, out=total)
+            for tree_nodes in nodes[1:]:
+                total += np.take(self.value, tree_nodes, axis=0)
+        result /= self.n_trees
+        return result
+
+    def predict(self, X):
+        if self.is_classifier:
+            return self.classes_.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+        return self._mean_value(X)
+
+    def predict_proba(self, X):
+        if not self.is_classifier:
+            raise TypeError('predict_proba is only available for classifiers')
+        return self._mean_value(X)
@@ -4,11 +4,14 @@ from sklearn2pmml import sklearn2pmml, PMMLPipeline
 import logging
 import numpy as np
 from .feature_generation import feature_generation
-from fact.io import read_data, h5py_get_n_rows
+from .forest import CompactForest
+from .ensemble import FORESTS
+from .selection import SelectionEvaluator, ZoneMaps, read_rows, drop_zone_map, n_rows_group
+from fact.io import read_data, read_h5py, h5py_get_n_rows, to_native_byteorder
 import pandas as pd
 import h5py
 import click
-__all__ = ['pickle_model']
+__all__ = ['pickle_model', 'load_model', 'H5PyColumnWriter']
 
 
 log = logging.getLogger(__name__)
@@ -38,10 +41,80 @@ def drop_prediction_column(data_path, group_name, column_name, yes=True):
         if column_name + '_mean' in columns:
             del f[group_name][column_name + '_mean']
 
-
-def read_telescope_data_chunked(path, config, chunksize, columns, feature_generation_config=None):
+        for suffix in ('', '_std', '_mean'):
+            drop_zone_map(f, group_name, column_name + suffix)
+
+
+source_dependent_columns = [
+    'source_x',
+    'source_y',
+    'source_alt',
+    'source_az',
+    'source_alt_mean',
+    'source_az_mean',
+    'disp',
+    'theta',
+    'theta_deg',
+    'theta_rec_pos',
+]
+for i in range(1, 6):
+    source_dependent_columns.extend([
+        'theta_off_' + str(i),
+        'theta_deg_off_' + str(i),
+        'theta_off_rec_pos_' + str(i),
+    ])
+
+
+def drop_source_dependent_columns(data_path, config, keep=(), yes=False):
+    '''
+    Deletes columns depending on the reconstructed source position
+    from the telescope and array events, as they become invalid with
+    a new disp prediction. Columns in keep are not deleted.
+    Returns the number of deleted columns.
+    '''
+    n_del_cols = 0
+    with h5py.File(data_path, 'r+') as f:
+        for column in source_dependent_columns:
+            if column in keep:
+                continue
+
+            for key in (config.array_events_key, config.telescope_events_key):
+                if column in f[key].keys():
+                    if not yes:
+                        click.confirm(
+                            'Dataset "{}" exists in file, overwrite?'.format(column),
+                            abort=True,
+                        )
+                        yes = True
+                    del f[key][column]
+                    drop_zone_map(f, key, column)
+                    log.warn("Deleted {} from the feature set.".format(column))
+                    n_del_cols += 1
+
+    return n_del_cols
+
+
+def read_telescope_data_chunked(
+        path,
+        config,
+        chunksize,
+        columns,
+        feature_generation_config=None,
+        selection=None,
+        ):
     '''
     Reads data from hdf5 file given as PATH and yields dataframes for each chunk
+
+    The needed array event columns are read only once and joined to each
+    chunk of telescope events by a binary search on the sorted join keys.
+    The file is read with h5py only, so it can be read while it is
+    open for writing, e.g. by a H5PyColumnWriter.
+
+    If a selection (same format as for aict_apply_cuts) is given,
+    only the telescope events passing it are read, the index of
+    the yielded dataframes are the rows of these events in the file.
+    Blocks of rows that cannot pass the selection according to the zone maps
+    of the file (see aict_index_zone_maps) are not read at all.
     '''
     n_rows = h5py_get_n_rows(path, config.telescope_events_key)
     if chunksize:
@@ -51,19 +124,42 @@ def read_telescope_data_chunked(path, config, chunksize, columns, feature_genera
         chunksize = n_rows
     log.info('Splitting data into {} chunks'.format(n_chunks))
 
+    telescope_event_columns, array_event_columns = get_event_columns(path, config, columns)
+    array_keys, array_events = read_array_events_sorted(path, config, array_event_columns)
+
+    if selection:
+        evaluator = SelectionEvaluator(selection)
+        with h5py.File(path, 'r') as f:
+            zone_maps = ZoneMaps.read(f, config.telescope_events_key, columns=list(selection))
+        if zone_maps is None:
+            log.debug('No zone maps found, evaluating selection on all rows')
+
     for chunk in range(n_chunks):
 
         start = chunk * chunksize
         end = min(n_rows, (chunk + 1) * chunksize)
 
-        df = read_telescope_data(
-            path,
-            config=config,
-            columns=columns,
-            first=start,
-            last=end
-        )
-        df.index = np.arange(start, end)
+        if selection:
+            with h5py.File(path, 'r') as f:
+                group = f[config.telescope_events_key]
+                rows = None
+                if zone_maps is not None:
+                    rows = zone_maps.candidate_rows(selection, start, end)
+                rows = np.flatnonzero(evaluator.mask(group, start, end, rows=rows))
+                telescope_events = read_h5py_rows(group, telescope_event_columns, start, end, rows)
+            index = start + rows
+        else:
+            telescope_events = read_h5py(
+                path,
+                key=config.telescope_events_key,
+                columns=telescope_event_columns,
+                first=start,
+                last=end,
+            )
+            index = np.arange(start, end)
+
+        df = join_array_events(telescope_events, array_events, array_keys, config)
+        df.index = index
 
         if feature_generation_config:
             feature_generation(df, feature_generation_config, inplace=True)
@@ -71,9 +167,203 @@ def read_telescope_data_chunked(path, config, chunksize, columns, feature_genera
         yield df, start, end
 
 
+def read_h5py_rows(group, columns, start, end, rows):
+    '''
+    Read rows (sorted, relative to start) of [start:end] of the given columns
+    of an open h5py group into a dataframe, like fact.io.read_h5py does for slices.
+    Only the storage chunks containing the rows are read.
+    '''
+    if columns is None:
+        columns = [name for name, dataset in group.items() if dataset.ndim == 1]
+
+    df = pd.DataFrame(index=np.arange(len(rows)))
+    for column in columns:
+        dataset = group[column]
+        array = to_native_byteorder(read_rows(dataset, start, end, rows))
+
+        # decode unicode strings to str
+        if array.dtype.kind in {'S', 'O'}:
+            array = array.astype('U')
+
+        if dataset.attrs.get('timeformat') is not None:
+            array = pd.to_datetime(array)
+
+        if array.ndim == 1:
+            df[column] = array
+        elif array.ndim == 2:
+            for i in range(array.shape[1]):
+                df[column + '_{}'.format(i)] = array[:, i]
+        else:
+            log.warning('Skipping column {} with more than 2 dimensions'.format(column))
+
+    return df
+
+
+def get_event_columns(path, config, columns):
+    '''
+    Split the requested columns into telescope event and array event columns.
+    Both sets always contain the join keys.
+    Returns (None, None) if no columns are given, meaning all columns.
+    '''
+    if not columns:
+        return None, None
+
+    join_keys = [config.run_id_column, config.array_event_id_column]
+    with h5py.File(path, 'r') as f:
+        array_event_columns = set(f[config.array_events_key].keys()) & set(columns)
+        telescope_event_columns = set(f[config.telescope_events_key].keys()) & set(columns)
+
+    array_event_columns |= set(join_keys)
+    telescope_event_columns |= set(join_keys)
+
+    return telescope_event_columns, array_event_columns
+
+
+def keys_array(run_id, array_event_id):
+    '''
+    Build a structured array of (run_id, array_event_id) keys.
+    Structured arrays compare lexicographically, so they can be sorted
+    and searched with numpy.
+    '''
+    keys = np.empty(len(run_id), dtype=[
+        ('run_id', run_id.dtype), ('array_event_id', array_event_id.dtype)
+    ])
+    keys['run_id'] = run_id
+    keys['array_event_id'] = array_event_id
+    return keys
+
+
+def join_keys_array(df, config):
+    '''
+    Build a structured array of the (run_id, array_event_id) keys of df,
+    see `keys_array`.
+    '''
+    return keys_array(
+        df[config.run_id_column].values, df[config.array_event_id_column].values
+    )
+
+
+def read_array_events_sorted(path, config, columns=None):
+    '''
+    Read the array events and sort them by their join keys.
+    Returns the sorted keys and the array events in the same order.
+    The index of the returned dataframe is the row in the file.
+    '''
+    array_events = read_h5py(
+        path,
+        key=config.array_events_key,
+        columns=columns,
+    )
+    array_events.index = np.arange(len(array_events))
+    keys = join_keys_array(array_events, config)
+
+    order = np.argsort(keys, kind='mergesort')
+    array_events = array_events.iloc[order]
+
+    return keys[order], array_events
+
+
+def join_array_events(telescope_events, array_events, array_keys, config):
+    '''
+    Add the array event columns to the telescope events, keeping the order
+    of the telescope events.
+    array_keys and array_events have to be sorted as returned by
+    `read_array_events_sorted`.
+    '''
+    keys = join_keys_array(telescope_events, config)
+
+    idx = np.searchsorted(array_keys, keys)
+    found = idx < len(array_keys)
+    found[found] = array_keys[idx[found]] == keys[found]
+    if not found.all():
+        raise ValueError(
+            'Found {} telescope events without corresponding array event'
+            .format(np.count_nonzero(~found))
+        )
+
+    join_keys = [config.run_id_column, config.array_event_id_column]
+    df = telescope_events
+    for column in array_events.columns:
+        if column in join_keys or column in df.columns:
+            continue
+        df[column] = array_events[column].values[idx]
+
+    return df
+
+
+def sample_rows(n_rows, n_sample, random_state):
+    '''
+    Draw n_sample distinct rows out of n_rows, returned sorted.
+    Does not need memory proportional to n_rows for small samples.
+    '''
+    if n_sample > n_rows // 2:
+        return np.sort(random_state.permutation(n_rows)[:n_sample])
+
+    rows = np.empty(0, dtype=int)
+    while len(rows) < n_sample:
+        new_rows = random_state.randint(0, n_rows, n_sample - len(rows))
+        rows = np.unique(np.append(rows, new_rows))
+    return rows
+
+
+def sample_rows_seeded(n_rows, n_sample):
+    '''
+    Rows drawn by `sample_rows` from a copy of numpy's global random state,
+    which is seeded from the config. The global state is not advanced,
+    so calling this again gives the same rows.
+    '''
+    state = np.random.RandomState()
+    state.set_state(np.random.get_state())
+    return sample_rows(n_rows, n_sample, state)
+
+
+def read_telescope_data_sample(path, config, telescope_event_columns, array_event_columns, n_sample, first=None, last=None):
+    '''
+    Read n_sample random telescope events of rows [first:last] and their array events.
+    Only the sampled rows are read from the file, the random state
+    is a copy of numpy's global random state, seeded from the config.
+    '''
+    with h5py.File(path, 'r') as f:
+        group = f[config.telescope_events_key]
+        start, end, _ = slice(first, last).indices(n_rows_group(group))
+
+        if n_sample > end - start:
+            raise ValueError(
+                'number of sampled events'
+                ' {} must be smaller than number events in file {} ({})'
+                .format(n_sample, path, end - start)
+            )
+        log.info('Randomly sample {} events'.format(n_sample))
+        rows = sample_rows_seeded(end - start, n_sample)
+
+        telescope_events = read_h5py_rows(group, telescope_event_columns, start, end, rows)
+
+        # find the array events of the sampled events using the keys only
+        array_group = f[config.array_events_key]
+        array_keys = keys_array(
+            array_group[config.run_id_column][:],
+            array_group[config.array_event_id_column][:],
+        )
+        order = np.argsort(array_keys, kind='mergesort')
+        keys = join_keys_array(telescope_events, config)
+        idx = np.searchsorted(array_keys[order], keys).clip(0, len(order) - 1)
+        array_rows = np.unique(order[idx])
+
+        array_events = read_h5py_rows(
+            array_group, array_event_columns, 0, len(array_keys), array_rows
+        )
+
+    array_keys = array_keys[array_rows]
+    order = np.argsort(array_keys, kind='mergesort')
+    array_events = array_events.iloc[order].reset_index(drop=True)
+
+    return join_array_events(telescope_events, array_events, array_keys[order], config)
+
+
 def read_telescope_data(path, config, columns, feature_generation_config=None, n_sample=None, first=None, last=None):
     '''
     Read given columns from data and perform a random sample if n_sample is supplied.
+    With n_sample, only the sampled events are read.
     Returns a single pandas data frame
     '''
     telescope_event_columns = None
@@ -87,32 +377,31 @@ def read_telescope_data(path, config, columns, feature_generation_config=None, n
             array_event_columns |= set(join_keys)
             telescope_event_columns |= set(join_keys)
 
-    telescope_events = read_data(
-        file_path=path,
-        key=config.telescope_events_key,
-        columns=telescope_event_columns,
-        first=first,
-        last=last,
-    )
-    array_events = read_data(
-        file_path=path,
-        key=config.array_events_key,
-        columns=array_event_columns,
-    )
-
-    df = pd.merge(left=array_events, right=telescope_events, left_on=join_keys, right_on=join_keys)
-
     if n_sample is not None:
-        if n_sample > len(df):
-            raise ValueError(
-                'number of sampled events'
-                ' {} must be smaller than number events in file {} ({})'
-                .format(n_sample, path, len(df))
-            )
-        log.info('Randomly sample {} events'.format(n_sample))
-        state = np.random.RandomState()
-        state.set_state(np.random.get_state())
-        df = df.sample(n_sample, random_state=state)
+        df = read_telescope_data_sample(
+            path,
+            config,
+            None if telescope_event_columns is None else sorted(telescope_event_columns),
+            None if array_event_columns is None else sorted(array_event_columns),
+            n_sample,
+            first=first,
+            last=last,
+        )
+    else:
+        telescope_events = read_data(
+            file_path=path,
+            key=config.telescope_events_key,
+            columns=telescope_event_columns,
+            first=first,
+            last=last,
+        )
+        array_events = read_data(
+            file_path=path,
+            key=config.array_events_key,
+            columns=array_event_columns,
+        )
+
+        df = pd.merge(left=array_events, right=telescope_events, left_on=join_keys, right_on=join_keys)
 
     # generate features if given in config
     if feature_generation_config:
@@ -121,9 +410,35 @@ def read_telescope_data(path, config, columns, feature_generation_config=None, n
     return df
 
 
-def pickle_model(classifier, feature_names, model_path, label_text='label'):
+def check_model_path(model_path, model, fold_ensemble=False):
+    '''
+    Check that pickle_model can store the trained model at model_path,
+    so the training scripts fail before the training instead of after it.
+    Only forests can be stored as .forest and --fold-ensemble combines
+    other models into a FoldEnsemble, which can only be stored as .pkl.
+    '''
+    extension = path.splitext(model_path)[1]
+    is_forest = type(model) in FORESTS
+
+    if fold_ensemble and not is_forest and extension != '.pkl':
+        raise click.ClickException(
+            'The --fold-ensemble of {} models can only be stored as .pkl'.format(
+                type(model).__name__
+            )
+        )
+
+    if extension == '.forest' and not is_forest:
+        raise click.ClickException(
+            'Only random forests and extra trees can be stored as .forest, not {}'.format(
+                type(model).__name__
+            )
+        )
+
+
+def pickle_model(classifier, feature_names, model_path, label_text='label', config_hash=None):
     p, extension = path.splitext(model_path)
     classifier.feature_names = feature_names
+    classifier.config_hash = config_hash
 
     if (extension == '.pmml'):
         joblib.dump(classifier, p + '.pkl', compress=4)
@@ -135,14 +450,39 @@ def pickle_model(classifier, feature_names, model_path, label_text='label'):
         pipeline.active_fields = np.array(feature_names)
         sklearn2pmml(pipeline, model_path)
 
+    elif (extension == '.forest'):
+        joblib.dump(classifier, p + '.pkl', compress=4)
+        CompactForest.from_sklearn(classifier).save(model_path)
+
     else:
         joblib.dump(classifier, model_path, compress=4)
 
 
+def load_model(model_path, config=None):
+    '''
+    Load a model written by pickle_model.
+    .forest files are memory mapped and rebuilt into scikit-learn forests,
+    everything else is loaded using joblib.
+    If config is given, warn if the model was trained using a different config.
+    '''
+    if path.splitext(model_path)[1] == '.forest':
+        model = CompactForest.load(model_path).to_sklearn()
+    else:
+        model = joblib.load(model_path)
+
+    model_hash = getattr(model, 'config_hash', None)
+    if config is not None and model_hash is not None and model_hash != config.config_hash:
+        log.warning('Model {} was trained using a different config'.format(model_path))
+
+    return model
+
+
 def append_to_h5py(f, array, group, key):
     '''
     Write numpy array to h5py hdf5 file
     '''
+    # the values change, so the zone map is not valid anymore
+    drop_zone_map(f, group, key)
     group = f.require_group(group)  # create if not exists
 
     max_shape = list(array.shape)
@@ -160,3 +500,111 @@ def append_to_h5py(f, array, group, key):
 
         group[key].resize(n_existing + n_new, axis=0)
         group[key][n_existing:n_existing + n_new] = array
+
+
+class H5PyColumnWriter:
+    '''
+    Write prediction columns into an existing h5py hdf5 file chunk by chunk.
+
+    The file is opened once for the lifetime of the writer.
+    Columns are created with their final length, so each chunk is written
+    at its [start:end] offset without resizing the dataset.
+    Existing columns with the same shape and dtype are overwritten in place,
+    other existing columns are replaced.
+
+    Use as a context manager:
+
+        with H5PyColumnWriter(path) as writer:
+            writer.require_column('events', 'gamma', n_rows)
+            writer.write('events', 'gamma', prediction, start, end)
+    '''
+    # target size of a single hdf5 chunk in bytes
+    chunk_bytes = 2**20
+
+    def __init__(self, path, chunksize=None, yes=True):
+        self.path = path
+        self.chunksize = chunksize
+        self.yes = yes
+        self.file = None
+
+    def __enter__(self):
+        self.file = h5py.File(self.path, 'r+')
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def chunk_layout(self, n_rows, shape, dtype):
+        row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape, dtype=int))
+        n_chunk_rows = max(1, self.chunk_bytes // row_bytes)
+        if self.chunksize:
+            n_chunk_rows = min(n_chunk_rows, self.chunksize)
+        n_chunk_rows = max(1, min(n_chunk_rows, n_rows))
+        return (n_chunk_rows, ) + tuple(shape)
+
+    def require_column(self, group_name, column_name, n_rows, dtype='float64', shape=()):
+        '''
+        Make sure column_name exists in group_name with n_rows rows
+        '''
+        group = self.file.require_group(group_name)
+        full_shape = (n_rows, ) + tuple(shape)
+
+        if column_name in group and not self.yes:
+            click.confirm(
+                f'Column \"{column_name}\" exists in file, overwrite?', abort=True,
+            )
+
+        # the values change, so the zone map is not valid anymore
+        drop_zone_map(self.file, group_name, column_name)
+
+        if column_name in group:
+            dataset = group[column_name]
+            if dataset.shape == full_shape and dataset.dtype == np.dtype(dtype):
+                return dataset
+            del group[column_name]
+
+        return group.create_dataset(
+            column_name,
+            shape=full_shape,
+            dtype=dtype,
+            maxshape=(None, ) + tuple(shape),
+            chunks=self.chunk_layout(n_rows, shape, dtype),
+        )
+
+    def write(self, group_name, column_name, array, start, end, rows=None):
+        '''
+        Write array into rows [start:end] of an existing column.
+        If rows (in the file) are given, array only contains the values
+        of these rows and all other rows of [start:end] are set to nan.
+        '''
+        array = np.asarray(array)
+        if rows is not None and len(rows) != end - start:
+            full = np.full((end - start, ) + array.shape[1:], np.nan)
+            full[np.asarray(rows) - start] = array
+            array = full
+        self.file[group_name][column_name][start:end] = array
+
+    def write_block(self, group_name, start, end, columns):
+        '''
+        Write rows [start:end] of several columns, given as dict name -> array
+        '''
+        if end <= start:
+            return
+        for column_name, array in columns.items():
+            self.write(group_name, column_name, array, start, end)
+
+    def write_column(self, group_name, column_name, array):
+        '''
+        Write a complete column at once
+        '''
+        array = np.asarray(array)
+        self.require_column(
+            group_name, column_name, len(array),
+            dtype=array.dtype, shape=array.shape[1:],
+        )
+        self.write(group_name, column_name, array, 0, len(array))
@@ -1,4 +1,8 @@
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, cpu_count, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+from threading import Thread, Event
 import numpy as np
 
 
@@ -27,3 +31,359 @@ def parallelize_array_computation(func, *arrays, n_jobs=-1):
         result = pool.starmap(func, blocks)
 
     return result
+
+
+def resolve_n_jobs(n_jobs):
+    '''
+    Number of threads meant by n_jobs, following the sklearn convention
+    that None means 1, -1 all cores, -2 all cores but one etc.
+    '''
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, cpu_count() + 1 + n_jobs)
+    return max(1, n_jobs)
+
+
+def split_n_jobs(n_jobs, n_parts):
+    '''
+    Split a thread budget of n_jobs into n_parts budgets of at least one thread
+    '''
+    base, extra = divmod(max(resolve_n_jobs(n_jobs), n_parts), n_parts)
+    return [base + (i < extra) for i in range(n_parts)]
+
+
+def run_concurrently(*calls):
+    '''
+    Run each call, a tuple (func, *args), in its own thread
+    and return their results in the same order.
+    Only useful for functions releasing the GIL, like fitting or
+    predicting with sklearn's forests.
+    '''
+    if len(calls) == 1:
+        func, *args = calls[0]
+        return [func(*args)]
+
+    with ThreadPoolExecutor(len(calls)) as pool:
+        futures = [pool.submit(*call) for call in calls]
+        return [future.result() for future in futures]
+
+
+_done = object()
+
+
+def prefetch(iterable, depth=1):
+    '''
+    Consume iterable in a background thread, keeping at most
+    depth items ready in advance.
+    Exceptions raised by the iterable are re-raised in the calling thread.
+    For depth=0, iterable is returned unchanged.
+    '''
+    if not depth:
+        return iterable
+    return _prefetch(iterable, depth)
+
+
+def _prefetch(iterable, depth):
+    items = Queue(maxsize=depth)
+    stop = Event()
+
+    def put(item, exception=None):
+        # give up if the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                items.put((item, exception), timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_done, e)
+        else:
+            put(_done)
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, exception = items.get()
+            if exception is not None:
+                raise exception
+            if item is _done:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BackgroundWorker:
+    '''
+    Execute function calls one after another in a background thread.
+
+    At most depth calls are queued, submit blocks if the queue is full.
+    Calls are executed in the order they were submitted.
+    Leaving the context waits for all calls and re-raises the first exception.
+    For depth=0, calls are executed directly in submit.
+
+    with BackgroundWorker(depth=2) as worker:
+        worker.submit(print, 'Hello')
+    '''
+    def __init__(self, depth=1):
+        self.depth = depth
+        self.exception = None
+        self.thread = None
+
+    def __enter__(self):
+        if self.depth:
+            self.calls = Queue(maxsize=self.depth)
+            self.thread = Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.thread is not None:
+            self.calls.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.exception is not None and exc[0] is None:
+            raise self.exception
+
+    def _run(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            if self.exception is not None:
+                continue
+            func, args, kwargs = call
+            try:
+                func(*args, **kwargs)
+            except BaseException as e:
+                self.exception = e
+
+    def submit(self, func, *args, **kwargs):
+        if self.exception is not None:
+            raise self.exception
+
+        if self.thread is None:
+            func(*args, **kwargs)
+        else:
+            self.calls.put((func, args, kwargs))
+
+
+# shared memory blocks attached in this worker process, name -> SharedMemory
+_attached = {}
+
+
+def _attach(name, dtype, shape):
+    if name not in _attached:
+        _attached[name] = SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=_attached[name].buf)
+
+
+def _compute_block(func, inputs, outputs, start, end):
+    # forget blocks the parent process replaced by larger ones
+    used = {name for name, _, _ in inputs} | {name for name, _, _ in outputs.values()}
+    for name in set(_attached) - used:
+        _attached.pop(name).close()
+
+    blocks = [_attach(*spec)[start:end] for spec in inputs]
+    result = func(*blocks)
+    for key, spec in outputs.items():
+        _attach(*spec)[start:end] = result[key]
+
+
+def _run_fold(args):
+    func, specs, train, test = args
+    return func(train, test, *[_attach(*spec) for spec in specs])
+
+
+def run_folds(func, arrays, folds, n_fold_jobs=1):
+    '''
+    Call func(train, test, *arrays) for each (train, test) in folds
+    and yield the results in the order of folds.
+
+    With n_fold_jobs > 1, the folds run concurrently in a pool of
+    n_fold_jobs worker processes. The arrays are copied into shared memory
+    once, only the names of the memory blocks and the fold indices are
+    pickled for each fold, so func has to be picklable, e.g. a module level
+    function or a functools.partial of one.
+    '''
+    folds = list(folds)
+    n_fold_jobs = min(resolve_n_jobs(n_fold_jobs), len(folds))
+
+    if n_fold_jobs <= 1:
+        for train, test in folds:
+            yield func(train, test, *arrays)
+        return
+
+    # see SharedMemoryExecutor.__enter__
+    resource_tracker.ensure_running()
+    buffers = []
+    try:
+        specs = []
+        for array in arrays:
+            array = np.asarray(array)
+            if array.dtype.hasobject:
+                raise TypeError('Only arrays of numerical types can be shared')
+            shm = SharedMemory(create=True, size=max(1, array.nbytes))
+            buffers.append(shm)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            specs.append((shm.name, array.dtype.str, array.shape))
+
+        with Pool(n_fold_jobs) as pool:
+            yield from pool.imap(
+                _run_fold, [(func, specs, train, test) for train, test in folds]
+            )
+    finally:
+        for shm in buffers:
+            shm.close()
+            shm.unlink()
+
+
+# unlinked shared memory blocks still used by arrays returned from map
+_retired = []
+
+
+def _release(shm):
+    '''
+    Close shm, or keep it until all arrays using its memory are gone
+    '''
+    for retired in _retired[:]:
+        try:
+            retired.close()
+            _retired.remove(retired)
+        except BufferError:
+            pass
+    try:
+        shm.close()
+    except BufferError:
+        _retired.append(shm)
+
+
+class SharedMemoryExecutor:
+    '''
+    Long lived pool of worker processes to compute a function
+    on blocks of numpy arrays.
+
+    Inputs and outputs are exchanged through multiprocessing.shared_memory,
+    only the names of the memory blocks and the block offsets are pickled.
+    The shared memory is reused for subsequent calls.
+
+    with SharedMemoryExecutor(n_jobs=4) as executor:
+        for df in chunks:
+            result = executor.map(func, [df.x.values, df.y.values], {'r': 'f8'})
+
+    `func` gets one block of each input array and must return a dict
+    with an array for each key in outputs.
+
+    The arrays returned by map are views of the shared memory, they are
+    only valid until the next call of map or close.
+    Inputs are copied into the shared memory, unless they were created
+    using shared_input.
+    '''
+    def __init__(self, n_jobs=-1):
+        if n_jobs == -1:
+            n_jobs = cpu_count()
+        self.n_jobs = n_jobs
+        self.pool = None
+        self.buffers = {}
+
+    def __enter__(self):
+        if self.n_jobs > 1:
+            # workers have to share the resource tracker of this process,
+            # otherwise their trackers unlink the shared memory when they exit
+            resource_tracker.ensure_running()
+            self.pool = Pool(self.n_jobs)
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        for shm in self.buffers.values():
+            shm.unlink()
+            _release(shm)
+        self.buffers = {}
+
+    def _shared_array(self, slot, dtype, shape):
+        '''
+        Return an array in the shared memory block for slot,
+        replacing the block if it is too small
+        '''
+        dtype = np.dtype(dtype)
+        n_bytes = max(1, dtype.itemsize * int(np.prod(shape, dtype=int)))
+
+        shm = self.buffers.get(slot)
+        if shm is None or shm.size < n_bytes:
+            if shm is not None:
+                shm.unlink()
+                _release(shm)
+            shm = self.buffers[slot] = SharedMemory(create=True, size=n_bytes)
+
+        spec = (shm.name, dtype.str, shape)
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf), spec
+
+    def shared_input(self, i, dtype, shape):
+        '''
+        Return an array to be passed as input i to the next call of map.
+        Filling it directly avoids copying the input into the shared memory.
+        Without worker processes, this is a normal array.
+        '''
+        if self.pool is None:
+            return np.empty(shape, dtype=dtype)
+        return self._shared_array(('input', i), dtype, shape)[0]
+
+    def map(self, func, arrays, outputs):
+        '''
+        Compute func on blocks of arrays, writing the results into
+        preallocated output arrays of the dtypes given in outputs.
+        Returns a dict name -> array, see the class docstring
+        for how long these arrays are valid.
+        '''
+        n_elements = set(len(a) for a in arrays)
+        if len(n_elements) != 1:
+            raise ValueError('All arrays must have same length')
+        n_elements = n_elements.pop()
+
+        if self.pool is None:
+            result = func(*arrays)
+            return {k: np.asarray(result[k], dtype=dtype) for k, dtype in outputs.items()}
+
+        input_specs = []
+        for i, array in enumerate(arrays):
+            array = np.asarray(array)
+            if array.dtype.hasobject:
+                raise TypeError('Only arrays of numerical types can be shared')
+            shared, spec = self._shared_array(('input', i), array.dtype, array.shape)
+            # arrays from shared_input are already in place
+            if shared.ctypes.data != array.ctypes.data:
+                shared[:] = array
+            input_specs.append(spec)
+
+        output_arrays = {}
+        output_specs = {}
+        for key, dtype in outputs.items():
+            output_arrays[key], output_specs[key] = self._shared_array(
+                ('output', key), dtype, (n_elements, )
+            )
+
+        block_size = max(1, int(np.ceil(n_elements / self.n_jobs)))
+        self.pool.starmap(_compute_block, [
+            (func, input_specs, output_specs, start, min(start + block_size, n_elements))
+            for start in range(0, n_elements, block_size)
+        ])
+
+        return output_arrays
@@ -6,6 +6,8 @@ from matplotlib.colors import LogNorm
 from matplotlib.colors import LinearSegmentedColormap
 from sklearn.calibration import CalibratedClassifierCV
 
+from .calibration import CalibratedClassifier
+
 def hex2rgb(s):
     h = s.lstrip('#')
     return tuple(int(h[i:i+2], 16) / 255.0 for i in (0, 2 ,4))
@@ -311,6 +313,8 @@ def plot_probabilities(performance_df, model, ax=None,
 
     if isinstance(model, CalibratedClassifierCV):
         model = model.base_estimator
+    if isinstance(model, CalibratedClassifier):
+        model = model.estimator
 
     bin_edges = np.linspace(0, 1, model.n_estimators + 2)
     bin_mids = (bin_edges[1:] + bin_edges[:-1]) * 0.5
@@ -340,6 +344,8 @@ def plot_precision_recall(performance_df, model, ax=None, beta=0.1, classname='G
 
     if isinstance(model, CalibratedClassifierCV):
         model = model.base_estimator
+    if isinstance(model, CalibratedClassifier):
+        model = model.estimator
 
 
     ax.axvline(0, color='lightgray')
@@ -400,6 +406,8 @@ def plot_feature_importances(model, feature_names, ax=None):
 
     if isinstance(model, CalibratedClassifierCV):
         model = model.base_estimator
+    if isinstance(model, CalibratedClassifier):
+        model = model.estimator
 
     if hasattr(model, 'estimators_'):
 
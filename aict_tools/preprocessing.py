@@ -1,5 +1,6 @@
 import numpy as np
 import logging
+import threading
 
 
 log = logging.getLogger(__name__)
@@ -35,6 +36,81 @@ def check_valid_rows(df):
     return valid
 
 
+class FeatureBuffer:
+    '''
+    Reusable C-contiguous float32 buffer for feature matrices.
+
+    `fill` converts the columns of a DataFrame into the buffer, replacing
+    infinite values with the float32 limits like `convert_to_float32`
+    and building the mask of rows without nans like `check_valid_rows`,
+    without copying the DataFrame.
+    The buffers only grow, so the returned matrix is a view
+    that is overwritten by the next call to `fill`.
+    '''
+    def __init__(self):
+        self.buffer = np.empty(0, dtype=np.float32)
+        # column major scratch space for frames with mixed dtypes
+        self.columns = np.empty(0, dtype=np.float32)
+
+    @staticmethod
+    def _view(buffer, shape):
+        size = shape[0] * shape[1]
+        if buffer.size < size:
+            buffer = np.empty(size, dtype=np.float32)
+        return buffer, buffer[:size].reshape(shape)
+
+    def fill(self, df):
+        '''
+        Returns the float32 feature matrix and the mask of valid rows
+        '''
+        n_rows, n_columns = df.shape
+        self.buffer, X = self._view(self.buffer, (n_rows, n_columns))
+        valid = np.ones(n_rows, dtype=bool)
+
+        if len(set(df.dtypes)) <= 1:
+            # a single block, df.values is a view
+            np.copyto(X, df.values, casting='unsafe')
+        else:
+            # converting column by column is only fast into contiguous memory
+            self.columns, columns = self._view(self.columns, (n_columns, n_rows))
+            for i, column in enumerate(df.columns):
+                np.copyto(columns[i], df[column].values, casting='unsafe')
+            np.copyto(X, columns.T)
+
+        # values too large for float32 became inf
+        if np.isfinite(X).all():
+            return X, valid
+
+        finfo = np.finfo(np.float32)
+        np.clip(X, finfo.min, finfo.max, out=X)
+
+        nan = np.flatnonzero(np.isnan(X))
+        if len(nan) > 0:
+            valid[nan // n_columns] = False
+            log.warning(
+                'Data contains not-predictable events.\n'
+                'There are nan-values in columns: {}'.format(
+                    df.columns[np.unique(nan % n_columns)]
+                )
+            )
+
+        return X, valid
+
+
+_feature_buffers = threading.local()
+
+
+def features_to_float32(df):
+    '''
+    Fill the FeatureBuffer of the current thread with df.
+    Returns the float32 feature matrix and the mask of valid rows,
+    the matrix is only valid until the next call in the same thread.
+    '''
+    if not hasattr(_feature_buffers, 'buffer'):
+        _feature_buffers.buffer = FeatureBuffer()
+    return _feature_buffers.buffer.fill(df)
+
+
 def calc_true_disp(source_x, source_y, cog_x, cog_y, delta):
     true_disp = euclidean_distance(
         source_x, source_y,
@@ -52,9 +128,146 @@ def calc_true_disp(source_x, source_y, cog_x, cog_y, delta):
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord, AltAz
+from astropy.time import Time
 from ctapipe.coordinates import CameraFrame, EngineeringCameraFrame
 
+def _pointing_rotation(az_pointing, alt_pointing):
+    '''
+    Rotation matrices from AltAz into the telescope frame,
+    same as ctapipe's altaz_to_telescope, shape (n_events, 3, 3)
+    '''
+    cos_az, sin_az = np.cos(az_pointing), np.sin(az_pointing)
+    cos_alt, sin_alt = np.cos(alt_pointing), np.sin(alt_pointing)
+    zeros = np.zeros_like(cos_az)
+
+    return np.stack([
+        np.stack([cos_alt * cos_az, cos_alt * sin_az, sin_alt], axis=-1),
+        np.stack([-sin_az, cos_az, zeros], axis=-1),
+        np.stack([-sin_alt * cos_az, -sin_alt * sin_az, cos_alt], axis=-1),
+    ], axis=-2)
+
+
+def _spherical_to_cartesian(lon, lat):
+    return np.stack([
+        np.cos(lat) * np.cos(lon),
+        np.cos(lat) * np.sin(lon),
+        np.sin(lat),
+    ], axis=-1)
+
+
 def horizontal_to_camera(az, alt, az_pointing, alt_pointing, focal_length):
+    '''
+    Transform horizontal coordinates (in rad) into coordinates in the
+    EngineeringCameraFrame (n_mirrors=2) of ctapipe (in m).
+
+    This is a closed form numpy implementation of
+    `horizontal_to_camera_astropy`, results agree to better than 1e-9 m.
+    '''
+    az, alt = np.asarray(az, dtype=float), np.asarray(alt, dtype=float)
+    focal_length = np.asarray(focal_length, dtype=float)
+
+    rotation = _pointing_rotation(
+        np.asarray(az_pointing, dtype=float), np.asarray(alt_pointing, dtype=float),
+    )
+    telescope = np.einsum('...ij,...j->...i', rotation, _spherical_to_cartesian(az, alt))
+
+    fov_lon = np.arctan2(telescope[..., 1], telescope[..., 0])
+    fov_lat = np.arcsin(np.clip(telescope[..., 2], -1, 1))
+
+    # CameraFrame: x = fov_lat * f, y = fov_lon * f
+    # EngineeringCameraFrame with two mirrors: x = y_cam, y = -x_cam
+    x = fov_lon * focal_length
+    y = -fov_lat * focal_length
+
+    return x, y
+
+
+def camera_to_horizontal(x, y, az_pointing, alt_pointing, focal_length):
+    '''
+    Transform coordinates in the EngineeringCameraFrame (n_mirrors=2)
+    of ctapipe (in m) into horizontal coordinates (in rad).
+    Returns alt, az.
+
+    This is a closed form numpy implementation of
+    `camera_to_horizontal_astropy`, results agree to better than 1e-9 rad.
+    '''
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    focal_length = np.asarray(focal_length, dtype=float)
+
+    fov_lon = x / focal_length
+    fov_lat = -y / focal_length
+
+    rotation = _pointing_rotation(
+        np.asarray(az_pointing, dtype=float), np.asarray(alt_pointing, dtype=float),
+    )
+    # the transpose is the inverse of a rotation matrix
+    horizontal = np.einsum(
+        '...ji,...j->...i', rotation, _spherical_to_cartesian(fov_lon, fov_lat)
+    )
+
+    alt = np.arcsin(np.clip(horizontal[..., 2], -1, 1))
+    az = np.arctan2(horizontal[..., 1], horizontal[..., 0]) % (2 * np.pi)
+
+    return alt, az
+
+
+def datetime64_to_time(timestamp):
+    '''
+    Create an astropy Time from an array of np.datetime64 timestamps
+    through their int64 nanoseconds, without creating python datetimes.
+    '''
+    ns = np.asarray(timestamp).astype('datetime64[ns]').astype(np.int64)
+    seconds, nanoseconds = np.divmod(ns, 10**9)
+    return Time(seconds.astype(float), nanoseconds / 1e9, format='unix', scale='utc')
+
+
+def transform_to_horizontal_interpolated(coord, timestamp, location, time_step=1.0):
+    '''
+    Transform the fixed sky position coord into horizontal coordinates
+    for each of the np.datetime64 timestamps. Returns alt, az in rad.
+
+    The exact transformation is only computed on a grid with a spacing
+    of time_step seconds, restricted to the grid cells that contain
+    timestamps, so gaps between runs cost nothing.
+    Positions in between are linearly interpolated as cartesian unit vectors.
+    A source moves with at most the earth's angular velocity
+    omega = 7.3e-5 rad/s, so the error is below (omega * time_step)**2 / 8,
+    e.g. 7e-10 rad for 1 s and 3e-6 rad for 60 s.
+
+    If time_step is None or <= 0, every timestamp is transformed exactly.
+    '''
+    ns = np.asarray(timestamp).astype('datetime64[ns]').astype(np.int64)
+
+    if time_step is None or time_step <= 0 or len(ns) == 0:
+        altaz = coord.transform_to(AltAz(location=location, obstime=datetime64_to_time(ns)))
+        return altaz.alt.rad, altaz.az.rad
+
+    step = max(1, int(round(time_step * 1e9)))
+    start = ns.min()
+    cell, remainder = np.divmod(ns - start, step)
+
+    grid = np.unique(np.concatenate([cell, cell + 1]))
+    grid_time = datetime64_to_time(start + grid * step)
+    grid_altaz = coord.transform_to(AltAz(location=location, obstime=grid_time))
+    grid_vectors = _spherical_to_cartesian(grid_altaz.az.rad, grid_altaz.alt.rad)
+
+    # cell + 1 is always in the grid and follows cell directly
+    idx = np.searchsorted(grid, cell)
+    weight = (remainder / step)[:, np.newaxis]
+    vectors = (1 - weight) * grid_vectors[idx] + weight * grid_vectors[idx + 1]
+    vectors /= np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+
+    alt = np.arcsin(np.clip(vectors[:, 2], -1, 1))
+    az = np.arctan2(vectors[:, 1], vectors[:, 0]) % (2 * np.pi)
+
+    return alt, az
+
+
+def horizontal_to_camera_astropy(az, alt, az_pointing, alt_pointing, focal_length):
+    '''
+    Reference implementation of `horizontal_to_camera` using
+    astropy and ctapipe's EngineeringCameraFrame.
+    '''
     hf = AltAz()
 
     pointing = SkyCoord(
@@ -82,7 +295,11 @@ def horizontal_to_camera(az, alt, az_pointing, alt_pointing, focal_length):
     return xy_coord.x.to(u.m).value, xy_coord.y.to(u.m).value
 
 
-def camera_to_horizontal(x, y, az_pointing, alt_pointing, focal_length):
+def camera_to_horizontal_astropy(x, y, az_pointing, alt_pointing, focal_length):
+    '''
+    Reference implementation of `camera_to_horizontal` using
+    astropy and ctapipe's EngineeringCameraFrame.
+    '''
     hf = AltAz()
 
     pointing = SkyCoord(
@@ -0,0 +1,312 @@
+import click
+import logging
+from tqdm import tqdm
+import numpy as np
+import pandas as pd
+
+from fact.io import h5py_get_n_rows
+
+from ..apply import (
+    predict_separator,
+    predict_energy,
+    predict_disp,
+    predict_x_max,
+    ArrayEventAggregator,
+    GammaCascade,
+)
+from ..io import (
+    H5PyColumnWriter,
+    load_model,
+    read_telescope_data_chunked,
+    drop_source_dependent_columns,
+)
+from ..configuration import AICTConfig
+from ..feature_generation import compile_feature_generation
+from ..parallel import prefetch, BackgroundWorker, split_n_jobs
+from ..preprocessing import camera_to_horizontal
+
+
+def get_features(df, model_config):
+    '''
+    Select the features of model_config from df, generating the features
+    defined in the feature generation of this model without copying df
+    '''
+    if model_config.feature_generation is None:
+        return df[model_config.features]
+
+    generated = compile_feature_generation(model_config.feature_generation).evaluate(df)
+    return pd.DataFrame({
+        feature: generated[feature] if feature in generated else df[feature].values
+        for feature in model_config.features
+    }, index=df.index, columns=model_config.features)
+
+
+@click.command()
+@click.argument('configuration_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('data_path', type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--separator-model', 'separator_model_path',
+    type=click.Path(exists=True, dir_okay=False),
+    help='Path to the pickled separation model',
+)
+@click.option(
+    '--energy-model', 'energy_model_path',
+    type=click.Path(exists=True, dir_okay=False),
+    help='Path to the pickled energy model',
+)
+@click.option(
+    '--disp-model', 'disp_model_path',
+    type=click.Path(exists=True, dir_okay=False),
+    help='Path to the pickled disp model, needs --sign-model',
+)
+@click.option(
+    '--sign-model', 'sign_model_path',
+    type=click.Path(exists=True, dir_okay=False),
+    help='Path to the pickled sign model, needs --disp-model',
+)
+@click.option(
+    '--x-max-model', 'x_max_model_path',
+    type=click.Path(exists=True, dir_okay=False),
+    help='Path to the pickled x_max model',
+)
+@click.option('-n', '--n-jobs', type=int, help='Number of cores to use')
+@click.option('-y', '--yes', help='Do not prompt for overwrites', is_flag=True)
+@click.option('-v', '--verbose', help='Verbose log output', is_flag=True)
+@click.option(
+    '-N', '--chunksize', type=int,
+    help='If given, only process the given number of events at once',
+)
+@click.option(
+    '--apply-selection', is_flag=True,
+    help='Only predict for the events passing the selection of the config,'
+    ' all other events get nan',
+)
+@click.option(
+    '--cascade', is_flag=True,
+    help='Only predict energy and disp for events above the gamma score'
+    ' threshold given in the gamma_cascade section of the config, other events get nan',
+)
+@click.option(
+    '--pipeline-depth', type=int, default=0, show_default=True,
+    help='If > 0, read the next and write the previous chunks in background'
+    ' threads, keeping at most this many chunks queued for each',
+)
+def main(
+    configuration_path,
+    data_path,
+    separator_model_path,
+    energy_model_path,
+    disp_model_path,
+    sign_model_path,
+    x_max_model_path,
+    n_jobs,
+    yes,
+    verbose,
+    chunksize,
+    apply_selection,
+    cascade,
+    pipeline_depth,
+):
+    '''
+    Apply all given models to data in a single pass.
+    Each chunk of events is read only once and the predictions of all
+    models are added to the file, together with their array-level
+    mean and standard deviation.
+
+    CONFIGURATION_PATH: Path to the config yaml file
+    DATA_PATH: path to the CTA data in a h5py hdf5 file
+
+    The program adds the following columns to the telescope events:
+        <separator class_name>: the gamma score
+        <energy class_name>: the estimated energy
+        <x_max class_name>: the estimated x_max
+        source_x, source_y, source_alt, source_az, disp:
+            the estimated source position
+
+    and <column>_mean, <column>_std to the array events for all columns
+    except source_x, source_y and disp.
+    '''
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
+    log = logging.getLogger()
+
+    config = AICTConfig.from_yaml(configuration_path)
+
+    if apply_selection and not config.selection:
+        raise click.ClickException('--apply-selection given, but config has no selection')
+    selection = config.selection if apply_selection else None
+
+    if (disp_model_path is None) != (sign_model_path is None):
+        raise click.ClickException('--disp-model and --sign-model must be given together')
+
+    model_paths = {
+        'separator': separator_model_path,
+        'energy': energy_model_path,
+        'x_max': x_max_model_path,
+        'disp': disp_model_path,
+    }
+    model_paths = {k: v for k, v in model_paths.items() if v is not None}
+    if not model_paths:
+        raise click.ClickException('No model given')
+
+    for name in model_paths:
+        if getattr(config, name) is None:
+            raise click.ClickException(
+                'Model for {0} given, but config has no "{0}" section'.format(name)
+            )
+
+    energy_first = False
+    if cascade:
+        if not config.gamma_cascade:
+            raise click.ClickException('--cascade given, but config has no gamma_cascade section')
+        if 'separator' not in model_paths:
+            raise click.ClickException('--cascade needs --separator-model')
+        cascade = GammaCascade.from_config(config.gamma_cascade)
+        # a threshold in bins of the estimated energy needs the energy of all events
+        energy_first = 'energy' in model_paths and cascade.column == config.energy.class_name
+    else:
+        cascade = None
+
+    log.info('Loading models')
+    models = {name: load_model(path, config) for name, path in model_paths.items()}
+    if 'disp' in models:
+        sign_model = load_model(sign_model_path, config)
+    log.info('Done')
+
+    if n_jobs:
+        for model in models.values():
+            model.n_jobs = n_jobs
+        if 'disp' in models:
+            # both models predict at the same time
+            models['disp'].n_jobs, sign_model.n_jobs = split_n_jobs(n_jobs, 2)
+
+    # telescope event columns to write and columns to aggregate per array event
+    prediction_columns = []
+    aggregated_columns = []
+    for name in ('separator', 'energy', 'x_max'):
+        if name in models:
+            prediction_columns.append(getattr(config, name).class_name)
+            aggregated_columns.append(getattr(config, name).class_name)
+
+    if 'disp' in models:
+        prediction_columns.extend(['source_x', 'source_y', 'source_alt', 'source_az', 'disp'])
+        aggregated_columns.extend(['source_alt', 'source_az'])
+
+        n_del_cols = drop_source_dependent_columns(
+            data_path, config,
+            keep=prediction_columns + [c + s for c in aggregated_columns for s in ('_mean', '_std')],
+            yes=yes,
+        )
+        # user already confirmed overwriting
+        yes = yes or n_del_cols > 0
+        if n_del_cols > 0:
+            log.warn(
+                'Source dependent features need to be calculated from the'
+                ' predicted source possition.'
+            )
+
+    run_id_column = config.run_id_column
+    array_event_id_column = config.array_event_id_column
+
+    columns = {run_id_column, array_event_id_column}
+    for name in models:
+        columns.update(getattr(config, name).columns_to_read_apply)
+    if 'disp' in models:
+        columns.add('focal_length')
+    if cascade and cascade.column and not energy_first:
+        columns.add(cascade.column)
+
+    n_rows = h5py_get_n_rows(data_path, config.telescope_events_key)
+    df_generator = read_telescope_data_chunked(
+        data_path, config, chunksize, columns, selection=selection,
+    )
+    df_generator = prefetch(df_generator, pipeline_depth)
+
+    aggregator = ArrayEventAggregator(data_path, config, aggregated_columns)
+
+    log.info('Predicting on data...')
+    writer = H5PyColumnWriter(data_path, chunksize=chunksize, yes=yes)
+    with writer, BackgroundWorker(pipeline_depth) as worker:
+        for column in prediction_columns:
+            writer.require_column(config.telescope_events_key, column, n_rows)
+        for column in aggregator.output_columns:
+            writer.require_column(
+                config.array_events_key, column, aggregator.n_array_events
+            )
+
+        for df, start, end in tqdm(df_generator):
+            predictions = {}
+
+            if 'separator' in models:
+                model_config = config.separator
+                predictions[model_config.class_name] = predict_separator(
+                    get_features(df, model_config), models['separator'],
+                )
+
+            mask = None
+            if cascade and not energy_first:
+                values = df[cascade.column].values if cascade.column else None
+                mask = cascade.mask(predictions[config.separator.class_name], values)
+
+            if 'energy' in models:
+                model_config = config.energy
+                predictions[model_config.class_name] = predict_energy(
+                    get_features(df, model_config),
+                    models['energy'],
+                    log_target=model_config.log_target,
+                    mask=mask,
+                )
+
+            if cascade and energy_first:
+                mask = cascade.mask(
+                    predictions[config.separator.class_name],
+                    predictions[config.energy.class_name],
+                )
+
+            if 'x_max' in models:
+                model_config = config.x_max
+                predictions[model_config.class_name] = predict_x_max(
+                    get_features(df, model_config),
+                    models['x_max'],
+                    log_target=model_config.log_target,
+                )
+
+            if 'disp' in models:
+                model_config = config.disp
+                disp = predict_disp(
+                    get_features(df, model_config), models['disp'], sign_model, mask=mask,
+                )
+                delta = df[model_config.delta_column].values
+                source_x = df[model_config.cog_x_column].values + disp * np.cos(delta)
+                source_y = df[model_config.cog_y_column].values + disp * np.sin(delta)
+                source_alt, source_az = camera_to_horizontal(
+                    x=source_x, y=source_y,
+                    az_pointing=df[model_config.pointing_az_column],
+                    alt_pointing=df[model_config.pointing_alt_column],
+                    focal_length=df['focal_length'],
+                )
+                predictions['source_x'] = source_x
+                predictions['source_y'] = source_y
+                predictions['source_alt'] = source_alt
+                predictions['source_az'] = source_az
+                predictions['disp'] = disp
+
+            for column in prediction_columns:
+                worker.submit(
+                    writer.write,
+                    config.telescope_events_key, column,
+                    predictions[column], start, end, df.index,
+                )
+
+            worker.submit(
+                writer.write_block,
+                config.array_events_key,
+                *aggregator.update(df, predictions),
+            )
+
+        worker.submit(
+            writer.write_block, config.array_events_key, *aggregator.finish()
+        )
+
+
+if __name__ == '__main__':
+    main()
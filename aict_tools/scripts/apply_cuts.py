@@ -2,10 +2,8 @@ import click
 import yaml
 import h5py
 import logging
-import pandas as pd
 
-from fact.io import h5py_get_n_rows, read_data, write_data
-from ..apply import create_mask_h5py, apply_cuts_h5py_chunked
+from ..apply import apply_cuts_h5py_chunked, CutFlow
 
 
 @click.command()
@@ -14,12 +12,28 @@ from ..apply import create_mask_h5py, apply_cuts_h5py_chunked
 @click.argument('input_path', type=click.Path(exists=True, dir_okay=False))
 @click.argument('output_path', type=click.Path(exists=False, dir_okay=False))
 @click.option('-k', '--key', help='Name of the hdf5 group', default='telescope_events')
+@click.option(
+    '-N', '--chunksize', type=int, default=100000, show_default=True,
+    help='Number of events processed at once',
+)
+@click.option(
+    '--cut-flow', 'cut_flow_path', type=click.Path(dir_okay=False),
+    help='Also write the number of events surviving each cut to this json file.'
+    ' The cuts are then evaluated in config order instead of cheapest first',
+)
 @click.option('-v', '--verbose', help='Verbose log output', is_flag=True)
-def main(configuration_path, input_path, output_path, key, verbose):
+def main(configuration_path, input_path, output_path, key, chunksize, cut_flow_path, verbose):
     '''
     Apply cuts given in CONFIGURATION_PATH to the data in INPUT_PATH and
     write the result to OUTPUT_PATH.
 
+    With --cut-flow, the number of telescope and array events surviving
+    each cut is written to the group "cut_flow" of OUTPUT_PATH and to a
+    json file.
+
+    The data is processed in chunks, only the array event keys are
+    read completely.
+
     example:
     ```
     selection:
@@ -36,27 +50,23 @@ def main(configuration_path, input_path, output_path, key, verbose):
 
     selection = config.get('selection', {})
 
-    array_events = read_data(input_path, key='array_events')
-    telescope_events = read_data(input_path, key='telescope_events')
-
-    mask_telescope = create_mask_h5py(input_path, selection, key='telescope_events')
-    selected_telescope_events = telescope_events[mask_telescope]
-
-    array_events['idx'] = array_events.index
-    merge = pd.merge(
-        selected_telescope_events[['run_id', 'array_event_id']], 
-        array_events[['run_id', 'array_event_id', 'idx']],
-        on=['run_id', 'array_event_id'],
-        how='left')
-    selected_array_events = array_events[array_events.idx.isin(merge.idx)]
-
-    write_data(selected_telescope_events, output_path, key='telescope_events', 
-                use_h5py=True, mode='w')
-    write_data(selected_array_events, output_path, key='array_events', 
-                    use_h5py=True, mode='a')
+    cut_flow = CutFlow(selection) if cut_flow_path else None
+    apply_cuts_h5py_chunked(
+        input_path,
+        output_path,
+        selection,
+        key=key,
+        chunksize=chunksize,
+        cut_flow=cut_flow,
+        array_events_key='array_events',
+    )
 
     with h5py.File(input_path, mode='r') as infile, h5py.File(output_path, 'r+') as outfile:
         if 'runs' in infile.keys():
             log.info('Copying runs group to outputfile')
             infile.copy('/runs', outfile['/'])
 
+    if cut_flow is not None:
+        cut_flow.write_h5py(output_path)
+        cut_flow.write_json(cut_flow_path)
+        log.info('Cut flow written to {}'.format(cut_flow_path))
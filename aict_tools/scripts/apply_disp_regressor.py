@@ -1,17 +1,20 @@
 import click
 import numpy as np
-import pandas as pd
-from sklearn.externals import joblib
 import logging
-import h5py
 from tqdm import tqdm
 
-from ..io import append_to_h5py, read_telescope_data_chunked
-from ..apply import predict_disp
+from ..io import (
+    H5PyColumnWriter,
+    load_model,
+    read_telescope_data_chunked,
+    drop_source_dependent_columns,
+)
+from ..apply import predict_disp, ArrayEventAggregator
 from ..configuration import AICTConfig
+from ..parallel import prefetch, BackgroundWorker, split_n_jobs
 from ..preprocessing import camera_to_horizontal
 
-from fact.io import read_data
+from fact.io import h5py_get_n_rows
 
 
 @click.command()
@@ -29,8 +32,18 @@ from fact.io import read_data
 )
 @click.option('-c', '--column_name', help='Name of column to be added', 
               default='disp')
+@click.option(
+    '--apply-selection', is_flag=True,
+    help='Only predict for the events passing the selection of the config,'
+    ' all other events get nan',
+)
+@click.option(
+    '--pipeline-depth', type=int, default=0, show_default=True,
+    help='If > 0, read the next and write the previous chunks in background'
+    ' threads, keeping at most this many chunks queued for each',
+)
 def main(configuration_path, data_path, disp_model_path, sign_model_path, 
-         chunksize, n_jobs, yes, verbose, column_name):
+         chunksize, n_jobs, yes, verbose, column_name, apply_selection, pipeline_depth):
     '''
     Apply given model to data. 
     Columns specifying the predicted source position (in camera coordinates 
@@ -48,63 +61,38 @@ def main(configuration_path, data_path, disp_model_path, sign_model_path,
     config = AICTConfig.from_yaml(configuration_path)
     model_config = config.disp
 
-    columns_to_delete = [
-        'source_x',
-        'source_y',
-        'source_alt',
-        'source_az',
-        'source_alt_mean',
-        'source_az_mean',
-        'disp',
-        'theta',
-        'theta_deg',
-        'theta_rec_pos',
+    if apply_selection and not config.selection:
+        raise click.ClickException('--apply-selection given, but config has no selection')
+    selection = config.selection if apply_selection else None
+
+    # prediction columns are overwritten in place by the column writer
+    telescope_prediction_columns = [
+        'source_x', 'source_y', 'source_alt', 'source_az', column_name,
+    ]
+    array_prediction_columns = [
+        'source_alt_mean', 'source_alt_std', 'source_az_mean', 'source_az_std',
     ]
-    for i in range(1, 6):
-        columns_to_delete.extend([
-            'theta_off_' + str(i),
-            'theta_deg_off_' + str(i),
-            'theta_off_rec_pos_' + str(i),
-        ])
-
-    n_del_cols = 0
-    with h5py.File(data_path, 'r+') as f:
-        for column in columns_to_delete:
-
-            if column in f[config.array_events_key].keys():
-                if not yes:
-                    click.confirm(
-                        'Dataset "{}" exists in file, overwrite?'.format(column),
-                        abort=True,
-                    )
-                    yes = True
-                del f[config.array_events_key][column]
-                log.warn("Deleted {} from the feature set.".format(column))
-                n_del_cols += 1
-
-            if column in f[config.telescope_events_key].keys():
-                if not yes:
-                    click.confirm(
-                        'Dataset "{}" exists in file, overwrite?'.format(column),
-                        abort=True,
-                    )
-                    yes = True
-                del f[config.telescope_events_key][column]
-                log.warn("Deleted {} from the feature set.".format(column))
-                n_del_cols += 1
+
+    n_del_cols = drop_source_dependent_columns(
+        data_path, config,
+        keep=telescope_prediction_columns + array_prediction_columns,
+        yes=yes,
+    )
+    # user already confirmed overwriting
+    yes = yes or n_del_cols > 0
 
     if n_del_cols > 0:
         log.warn("Source dependent features need to be calculated from the predicted source possition. "
                  + "Use e.g. `fact_calculate_theta` from https://github.com/fact-project/pyfact.")
 
     log.info('Loading model')
-    disp_model = joblib.load(disp_model_path)
-    sign_model = joblib.load(sign_model_path)
+    disp_model = load_model(disp_model_path, config)
+    sign_model = load_model(sign_model_path, config)
     log.info('Done')
 
     if n_jobs:
-        disp_model.n_jobs = n_jobs
-        sign_model.n_jobs = n_jobs
+        # both models predict at the same time
+        disp_model.n_jobs, sign_model.n_jobs = split_n_jobs(n_jobs, 2)
 
     # Add focal_length to be read for coordinate transformation
     columns = model_config.columns_to_read_apply
@@ -112,64 +100,64 @@ def main(configuration_path, data_path, disp_model_path, sign_model_path,
     columns.append('run_id')
     columns.append('array_event_id')
 
+    n_rows = h5py_get_n_rows(data_path, config.telescope_events_key)
     df_generator = read_telescope_data_chunked(
         data_path, config, chunksize, columns,
-        feature_generation_config=model_config.feature_generation
+        feature_generation_config=model_config.feature_generation,
+        selection=selection,
     )
+    df_generator = prefetch(df_generator, pipeline_depth)
 
     log.info('Predicting on data...')
 
-    chunked_frames = []
-
-    for df_data, start, end in tqdm(df_generator):
-
-        disp = predict_disp(
-            df_data[model_config.features], disp_model, sign_model
+    aggregator = ArrayEventAggregator(data_path, config, ['source_alt', 'source_az'])
+
+    writer = H5PyColumnWriter(data_path, chunksize=chunksize, yes=yes)
+    with writer, BackgroundWorker(pipeline_depth) as worker:
+        for column in telescope_prediction_columns:
+            writer.require_column(config.telescope_events_key, column, n_rows)
+        for column in aggregator.output_columns:
+            writer.require_column(
+                config.array_events_key, column, aggregator.n_array_events
+            )
+
+        for df_data, start, end in tqdm(df_generator):
+
+            disp = predict_disp(
+                df_data[model_config.features], disp_model, sign_model
+            )
+
+            source_x = ( df_data[model_config.cog_x_column] 
+                        + disp * np.cos(df_data[model_config.delta_column]) )
+            source_y = ( df_data[model_config.cog_y_column] 
+                        + disp * np.sin(df_data[model_config.delta_column]) )
+
+            source_alt, source_az = camera_to_horizontal(
+                            x=source_x, y=source_y,
+                            az_pointing=df_data[model_config.pointing_az_column],
+                            alt_pointing=df_data[model_config.pointing_alt_column],
+                            focal_length=df_data['focal_length'])
+
+            key = config.telescope_events_key
+            rows = df_data.index
+            worker.submit(writer.write, key, 'source_x', source_x, start, end, rows)
+            worker.submit(writer.write, key, 'source_y', source_y, start, end, rows)
+            worker.submit(writer.write, key, 'source_alt', source_alt, start, end, rows)
+            worker.submit(writer.write, key, 'source_az', source_az, start, end, rows)
+            worker.submit(writer.write, key, column_name, disp, start, end, rows)
+
+            worker.submit(
+                writer.write_block,
+                config.array_events_key,
+                *aggregator.update(
+                    df_data, {'source_alt': source_alt, 'source_az': source_az}
+                ),
+            )
+
+        worker.submit(
+            writer.write_block, config.array_events_key, *aggregator.finish()
         )
 
-        source_x = ( df_data[model_config.cog_x_column] 
-                    + disp * np.cos(df_data[model_config.delta_column]) )
-        source_y = ( df_data[model_config.cog_y_column] 
-                    + disp * np.sin(df_data[model_config.delta_column]) )
-
-        source_alt, source_az = camera_to_horizontal(
-                        x=source_x, y=source_y,
-                        az_pointing=df_data[model_config.pointing_az_column],
-                        alt_pointing=df_data[model_config.pointing_alt_column],
-                        focal_length=df_data['focal_length'])
-
-        d = df_data[['run_id', 'array_event_id']].copy()
-        d['source_alt'] = source_alt
-        d['source_az'] = source_az
-        chunked_frames.append(d)
-
-        with h5py.File(data_path, 'r+') as f:
-            append_to_h5py(f, source_x, config.telescope_events_key, 'source_x')
-            append_to_h5py(f, source_y, config.telescope_events_key, 'source_y')
-            append_to_h5py(f, source_alt, config.telescope_events_key, 'source_alt')
-            append_to_h5py(f, source_az, config.telescope_events_key, 'source_az')
-            append_to_h5py(f, disp, config.telescope_events_key, column_name)
-
-            # if config.has_multiple_telescopes == False:
-            #     append_to_h5py(f, source_alt, config.array_events_key, 'source_alt_mean')
-            #     append_to_h5py(f, source_az, config.array_events_key, 'source_az_mean')
-
-    d = pd.concat(chunked_frames).groupby(
-            ['run_id', 'array_event_id'], sort=False
-        ).agg(['mean', 'std'])
-
-    mean_alt = d['source_alt']['mean'].values
-    mean_az = d['source_az']['mean'].values
-    std_alt = d['source_alt']['std'].values
-    std_az = d['source_az']['std'].values
-
-    with h5py.File(data_path, 'r+') as f:
-        append_to_h5py(f, mean_alt, config.array_events_key, 'source_alt_mean')
-        append_to_h5py(f, mean_az, config.array_events_key, 'source_az_mean')
-        append_to_h5py(f, std_alt, config.array_events_key, 'source_alt_std') 
-        append_to_h5py(f, std_az, config.array_events_key, 'source_az_std')            
-
-
 
 if __name__ == '__main__':
     main()
@@ -1,15 +1,12 @@
 import click
-from sklearn.externals import joblib
 import logging
-import h5py
 from tqdm import tqdm
 
-import pandas as pd
-import numpy as np
-
-from ..apply import predict_energy
-from ..io import append_to_h5py, read_telescope_data_chunked, drop_prediction_column
+from ..apply import predict_energy, ArrayEventAggregator
+from ..io import H5PyColumnWriter, load_model, read_telescope_data_chunked
+from fact.io import h5py_get_n_rows
 from ..configuration import AICTConfig
+from ..parallel import prefetch, BackgroundWorker
 
 
 @click.command()
@@ -26,8 +23,18 @@ from ..configuration import AICTConfig
 )
 @click.option('-c', '--column_name', help='Name of column to be added', 
               default='energy')
+@click.option(
+    '--apply-selection', is_flag=True,
+    help='Only predict for the events passing the selection of the config,'
+    ' all other events get nan',
+)
+@click.option(
+    '--pipeline-depth', type=int, default=0, show_default=True,
+    help='If > 0, read the next and write the previous chunks in background'
+    ' threads, keeping at most this many chunks queued for each',
+)
 def main(configuration_path, data_path, model_path, chunksize, n_jobs, yes, 
-         verbose, column_name):
+         verbose, column_name, apply_selection, pipeline_depth):
     '''
     Apply given model to data.
     Columns specifying the predicted energy are added to the file.
@@ -41,64 +48,62 @@ def main(configuration_path, data_path, model_path, chunksize, n_jobs, yes,
     config = AICTConfig.from_yaml(configuration_path)
     model_config = config.energy
 
+    if apply_selection and not config.selection:
+        raise click.ClickException('--apply-selection given, but config has no selection')
+    selection = config.selection if apply_selection else None
+
     prediction_column_name = column_name
-    drop_prediction_column(
-        data_path, group_name=config.telescope_events_key,
-        column_name=prediction_column_name, yes=yes
-    )
-    if config.has_multiple_telescopes:
-        drop_prediction_column(
-            data_path, group_name=config.array_events_key,
-            column_name=prediction_column_name, yes=yes
-        )
 
     log.debug('Loading model')
-    model = joblib.load(model_path)
+    model = load_model(model_path, config)
     log.debug('Done')
 
     if n_jobs:
         model.n_jobs = n_jobs
 
+    n_rows = h5py_get_n_rows(data_path, config.telescope_events_key)
     df_generator = read_telescope_data_chunked(
         data_path, config, chunksize, model_config.columns_to_read_apply,
-        feature_generation_config=model_config.feature_generation
+        feature_generation_config=model_config.feature_generation,
+        selection=selection,
     )
+    df_generator = prefetch(df_generator, pipeline_depth)
 
-    chunked_frames = []
-
-    for df_data, start, end in tqdm(df_generator):
+    aggregator = ArrayEventAggregator(data_path, config, [prediction_column_name])
 
-        energy_prediction = predict_energy(
-            df_data[model_config.features],
-            model,
-            log_target=model_config.log_target,
+    writer = H5PyColumnWriter(data_path, chunksize=chunksize, yes=yes)
+    with writer, BackgroundWorker(pipeline_depth) as worker:
+        writer.require_column(
+            config.telescope_events_key, prediction_column_name, n_rows
         )
-
-        d = df_data[['run_id', 'array_event_id']].copy()
-        d[prediction_column_name] = energy_prediction
-        chunked_frames.append(d)
-
-        with h5py.File(data_path, 'r+') as f:
-            append_to_h5py(
-                f, energy_prediction, config.telescope_events_key, 
-                prediction_column_name
+        for column in aggregator.output_columns:
+            writer.require_column(
+                config.array_events_key, column, aggregator.n_array_events
             )
 
+        for df_data, start, end in tqdm(df_generator):
 
-    d = pd.concat(chunked_frames).groupby(
-            ['run_id', 'array_event_id'], sort=False
-        ).agg(['mean', 'std'])
+            energy_prediction = predict_energy(
+                df_data[model_config.features],
+                model,
+                log_target=model_config.log_target,
+            )
 
-    mean = d[prediction_column_name]['mean'].values
-    std = d[prediction_column_name]['std'].values
-    with h5py.File(data_path, 'r+') as f:
-        append_to_h5py(
-                f, mean, config.array_events_key, prediction_column_name + '_mean'
+            worker.submit(
+                writer.write,
+                config.telescope_events_key, prediction_column_name,
+                energy_prediction, start, end, df_data.index,
             )
-        append_to_h5py(
-                f, std, config.array_events_key, prediction_column_name + '_std'
+            worker.submit(
+                writer.write_block,
+                config.array_events_key,
+                *aggregator.update(df_data, {prediction_column_name: energy_prediction}),
             )
 
+        worker.submit(
+            writer.write_block, config.array_events_key, *aggregator.finish()
+        )
+
 
 if __name__ == '__main__':
     main()
@@ -1,41 +1,29 @@
 import click
 import numpy as np
-from sklearn.externals import joblib
 import logging
 from tqdm import tqdm
-import pandas as pd
-from functools import partial
 import os
 
-from astropy.time import Time
-from astropy.coordinates import AltAz, SkyCoord
-import astropy.units as u
+from astropy.coordinates import SkyCoord
 
 from fact.io import read_h5py, to_h5py
 from fact.instrument.constants import LOCATION
 from fact.analysis.source import calc_theta_camera, calc_theta_offs_camera
 from fact.coordinates import camera_to_equatorial, horizontal_to_camera
 
-from ..apply import predict_energy, predict_disp, predict_separator
-from ..parallel import parallelize_array_computation
-from ..io import read_telescope_data_chunked
+from ..apply import predict_energy, predict_disp, predict_separator, GammaCascade
+from ..parallel import SharedMemoryExecutor, split_n_jobs
+from ..io import load_model, read_telescope_data_chunked
 from ..configuration import AICTConfig
 from ..feature_generation import feature_generation
-from ..preprocessing import calc_true_disp
+from ..preprocessing import calc_true_disp, transform_to_horizontal_interpolated
 
 
-def to_altaz(obstime, source):
-    altaz = AltAz(location=LOCATION, obstime=obstime)
-    return source.transform_to(altaz)
-
-
-def concat_results_altaz(results):
-    obstime = np.concatenate([s.obstime for s in results])
-    return SkyCoord(
-        alt=np.concatenate([s.alt.deg for s in results]) * u.deg,
-        az=np.concatenate([s.az.deg for s in results]) * u.deg,
-        frame=AltAz(location=LOCATION, obstime=obstime)
+def calc_source_altaz(timestamp, source, time_step):
+    alt, az = transform_to_horizontal_interpolated(
+        source, timestamp, location=LOCATION, time_step=time_step,
     )
+    return {'source_zd': 90 - np.rad2deg(alt), 'source_az': np.rad2deg(az)}
 
 
 def calc_source_features_common(
@@ -192,6 +180,17 @@ needed_columns = [
     '-N', '--chunksize', type=int,
     help='If given, only process the given number of events at once',
 )
+@click.option(
+    '--time-step', type=float, default=1.0, show_default=True,
+    help='Time step in seconds of the grid on which the source position is'
+    ' transformed to AltAz exactly, positions in between are interpolated.'
+    ' Use 0 to transform every event exactly.',
+)
+@click.option(
+    '--cascade', is_flag=True,
+    help='Only predict energy and disp for events above the gamma score'
+    ' threshold given in the gamma_cascade section of the config, other events get nan',
+)
 def main(
     configuration_path,
     data_path,
@@ -205,6 +204,8 @@ def main(
     n_jobs,
     yes,
     verbose,
+    time_step,
+    cascade,
 ):
     '''
     Apply given model to data. Two columns are added to the file, energy_prediction
@@ -227,6 +228,15 @@ def main(
 
     config = AICTConfig.from_yaml(configuration_path)
 
+    if cascade:
+        if not config.gamma_cascade:
+            raise click.ClickException('--cascade given, but config has no gamma_cascade section')
+        cascade = GammaCascade.from_config(config.gamma_cascade)
+        # a threshold in bins of the estimated energy needs the energy of all events
+        energy_first = cascade.column == 'gamma_energy_prediction'
+    else:
+        cascade = None
+
     if os.path.isfile(output):
         if not yes:
             click.confirm(
@@ -236,22 +246,24 @@ def main(
         open(output, 'w').close()
 
     log.info('Loading model')
-    separator_model = joblib.load(separator_model_path)
-    energy_model = joblib.load(energy_model_path)
-    disp_model = joblib.load(disp_model_path)
-    sign_model = joblib.load(sign_model_path)
+    separator_model = load_model(separator_model_path, config)
+    energy_model = load_model(energy_model_path, config)
+    disp_model = load_model(disp_model_path, config)
+    sign_model = load_model(sign_model_path, config)
     log.info('Done')
 
     if n_jobs:
         separator_model.n_jobs = n_jobs
         energy_model.n_jobs = n_jobs
-        disp_model.n_jobs = n_jobs
-        sign_model.n_jobs = n_jobs
+        # both models predict at the same time
+        disp_model.n_jobs, sign_model.n_jobs = split_n_jobs(n_jobs, 2)
 
     columns = set(needed_columns)
     for model in ('separator', 'energy', 'disp'):
         model_config = getattr(config, model)
         columns.update(model_config.columns_to_read_apply)
+    if cascade and cascade.column and not energy_first:
+        columns.add(cascade.column)
     try:
         runs = read_h5py(data_path, key='runs')
         sources = runs['source'].unique()
@@ -272,73 +284,93 @@ def main(
         columns=columns,
     )
 
+    theta_columns = ['theta_deg'] + ['theta_deg_off_{}'.format(i) for i in range(1, 6)]
+    if source:
+        source_features = dict.fromkeys(theta_columns + ['ra_prediction', 'dec_prediction'], 'f8')
+    else:
+        source_features = dict.fromkeys(theta_columns + ['true_disp'], 'f8')
+
     log.info('Predicting on data...')
-    for df, start, end in tqdm(df_generator):
-        df_sep = feature_generation(df, config.separator.feature_generation)
-        df['gamma_prediction'] = predict_separator(
-            df_sep[config.separator.features], separator_model,
-        )
-
-        df_energy = feature_generation(df, config.energy.feature_generation)
-        df['gamma_energy_prediction'] = predict_energy(
-            df_energy[config.energy.features],
-            energy_model,
-            log_target=config.energy.log_target,
-        )
-
-        df_disp = feature_generation(df, config.disp.feature_generation)
-        disp = predict_disp(
-            df_disp[config.disp.features], disp_model, sign_model
-        )
-
-        source_x = df.cog_x + disp * np.cos(df.delta)
-        source_y = df.cog_y + disp * np.sin(df.delta)
-        df['source_x_prediction'] = source_x
-        df['source_y_prediction'] = source_y
-        df['disp_prediction'] = disp
-
-        if source:
-            obstime = Time(pd.to_datetime(df['timestamp'].values).to_pydatetime())
-            source_altaz = concat_results_altaz(parallelize_array_computation(
-                partial(to_altaz, source=source),
-                obstime,
-                n_jobs=n_jobs,
-            ))
-
-            result = parallelize_array_computation(
-                calc_source_features_obs,
-                source_x,
-                source_y,
-                source_altaz.zen.deg,
-                source_altaz.az.deg,
-                df['pointing_position_zd'].values,
-                df['pointing_position_az'].values,
-                obstime,
-                n_jobs=n_jobs,
+    with SharedMemoryExecutor(n_jobs=n_jobs) as executor:
+        for df, start, end in tqdm(df_generator):
+            df_sep = feature_generation(df, config.separator.feature_generation)
+            df['gamma_prediction'] = predict_separator(
+                df_sep[config.separator.features], separator_model,
             )
-        else:
-
-            result = parallelize_array_computation(
-                calc_source_features_sim,
-                source_x,
-                source_y,
-                df['source_position_zd'].values,
-                df['source_position_az'].values,
-                df['pointing_position_zd'].values,
-                df['pointing_position_az'].values,
-                df['cog_x'].values,
-                df['cog_y'].values,
-                df['delta'].values,
-                n_jobs=n_jobs,
+
+            mask = None
+            if cascade and not energy_first:
+                values = df[cascade.column].values if cascade.column else None
+                mask = cascade.mask(df['gamma_prediction'].values, values)
+
+            df_energy = feature_generation(df, config.energy.feature_generation)
+            df['gamma_energy_prediction'] = predict_energy(
+                df_energy[config.energy.features],
+                energy_model,
+                log_target=config.energy.log_target,
+                mask=mask,
             )
 
-        for k in result[0].keys():
-            df[k] = np.concatenate([r[k] for r in result])
+            if cascade and energy_first:
+                mask = cascade.mask(
+                    df['gamma_prediction'].values, df['gamma_energy_prediction'].values
+                )
+
+            df_disp = feature_generation(df, config.disp.feature_generation)
+            disp = predict_disp(
+                df_disp[config.disp.features], disp_model, sign_model, mask=mask,
+            )
 
-        if source:
-            to_h5py(df[dl3_columns_obs], output, key='events', mode='a')
-        else:
-            to_h5py(df[dl3_columns_sim], output, key='events', mode='a')
+            # computed directly into the shared memory of the first two inputs
+            source_x = executor.shared_input(0, 'f8', len(df))
+            source_y = executor.shared_input(1, 'f8', len(df))
+            np.add(df.cog_x.values, disp * np.cos(df.delta.values), out=source_x)
+            np.add(df.cog_y.values, disp * np.sin(df.delta.values), out=source_y)
+            df['source_x_prediction'] = source_x
+            df['source_y_prediction'] = source_y
+            df['disp_prediction'] = disp
+
+            if source:
+                obstime = df['timestamp'].values.astype('datetime64[ns]')
+                source_altaz = calc_source_altaz(obstime, source, time_step)
+
+                result = executor.map(
+                    calc_source_features_obs,
+                    [
+                        source_x,
+                        source_y,
+                        source_altaz['source_zd'],
+                        source_altaz['source_az'],
+                        df['pointing_position_zd'].values,
+                        df['pointing_position_az'].values,
+                        obstime,
+                    ],
+                    outputs=source_features,
+                )
+            else:
+                result = executor.map(
+                    calc_source_features_sim,
+                    [
+                        source_x,
+                        source_y,
+                        df['source_position_zd'].values,
+                        df['source_position_az'].values,
+                        df['pointing_position_zd'].values,
+                        df['pointing_position_az'].values,
+                        df['cog_x'].values,
+                        df['cog_y'].values,
+                        df['delta'].values,
+                    ],
+                    outputs=source_features,
+                )
+
+            for k, values in result.items():
+                df[k] = values
+
+            if source:
+                to_h5py(df[dl3_columns_obs], output, key='events', mode='a')
+            else:
+                to_h5py(df[dl3_columns_sim], output, key='events', mode='a')
 
     if source:
         log.info('Copying "runs" group')
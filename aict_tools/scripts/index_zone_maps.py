@@ -0,0 +1,47 @@
+import click
+import logging
+
+from ..selection import index_zone_maps, ZONE_MAPS_KEY
+
+
+@click.command()
+@click.argument('data_path', type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '-k', '--key', help='Name of the hdf5 group to index',
+    default='telescope_events', show_default=True,
+)
+@click.option(
+    '-b', '--block-size', type=int, default=2**14, show_default=True,
+    help='Number of rows summarized in one zone map entry',
+)
+@click.option(
+    '-c', '--column', 'columns', multiple=True,
+    help='Column to index, all numeric columns if not given',
+)
+@click.option('-v', '--verbose', help='Verbose log output', is_flag=True)
+def main(data_path, key, block_size, columns, verbose):
+    '''
+    Store the minimum and maximum of each column in blocks of rows (zone maps)
+    in the group "zone_maps" of the hdf5 file at DATA_PATH.
+
+    When reading with a selection, blocks that cannot pass the selection
+    according to the zone maps are skipped.
+    Zone maps of columns written by the aict_apply_* scripts are removed,
+    rerun this command after applying new models to index them again.
+    Zone maps of columns changed by other tools are noticed by a checksum
+    of sampled rows and ignored.
+    '''
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
+    log = logging.getLogger()
+
+    zone_maps = index_zone_maps(data_path, key, block_size=block_size, columns=columns or None)
+    log.info('Stored zone maps of {} columns in {} blocks in {}/{}'.format(
+        len(zone_maps.minimum),
+        int(-(-zone_maps.n_rows // block_size)),
+        ZONE_MAPS_KEY,
+        key,
+    ))
+
+
+if __name__ == '__main__':
+    main()
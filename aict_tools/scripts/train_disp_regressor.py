@@ -2,16 +2,17 @@ import pandas as pd
 import click
 from sklearn import model_selection
 from sklearn import metrics
-from tqdm import tqdm
 import numpy as np
 import h5py
 
 from fact.io import write_data, read_data
 from ..preprocessing import horizontal_to_camera
 from ..io import pickle_model, read_telescope_data, append_to_h5py
+from ..cache import cached_training_data
 from ..preprocessing import convert_to_float32, calc_true_disp
 from ..feature_generation import feature_generation
 from ..configuration import AICTConfig
+from ..cross_validation import CrossValidation, fold_options
 
 import logging
 
@@ -27,8 +28,15 @@ import logging
 @click.option('-v', '--verbose', help='Verbose log output', is_flag=True)
 @click.option('-c', '--column_name', 
               help='Column name to be given to prediction', default='disp')
+@click.option(
+    '--cache-dir', type=click.Path(file_okay=False),
+    help='Directory to cache the preprocessed training data in, reused by'
+    ' later runs with the same input data and data related config',
+)
+@fold_options
 def main(configuration_path, signal_path, predictions_path, disp_model_path, 
-        sign_model_path, key, verbose, column_name):
+        sign_model_path, key, verbose, column_name, cache_dir, fold_jobs,
+        fold_ensemble, subsample_trees):
     '''
     Train two learners to be able to reconstruct the source position.
     One regressor for disp and one classifier for the sign of delta.
@@ -44,8 +52,10 @@ def main(configuration_path, signal_path, predictions_path, disp_model_path,
     DISP_MODEL_PATH: Path to save the disp model to.
 
     SIGN_MODEL_PATH: Path to save the disp model to.
-        Allowed extensions are .pkl and .pmml.
-        If extension is .pmml, then both pmml and pkl file will be saved
+        Allowed extensions are .pkl, .pmml and .forest.
+        If extension is .pmml, then both pmml and pkl file will be saved.
+        If extension is .forest, then both a memory mappable
+        compact forest and a pkl file will be saved
     '''
 
     logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
@@ -53,56 +63,72 @@ def main(configuration_path, signal_path, predictions_path, disp_model_path,
 
     config = AICTConfig.from_yaml(configuration_path)
     model_config = config.disp
-
-    disp_regressor = model_config.disp_regressor
-    sign_classifier = model_config.sign_classifier
-
-    disp_regressor.random_state = config.seed
-    sign_classifier.random_state = config.seed
+    # disp and sign model are trained at the same time,
+    # sharing the threads they would use one after another
+    cross_validation = CrossValidation(
+        [model_config.disp_regressor, model_config.sign_classifier],
+        [disp_model_path, sign_model_path], config.seed,
+        fold_jobs=fold_jobs, fold_ensemble=fold_ensemble, subsample_trees=subsample_trees,
+    )
 
     columns = model_config.columns_to_read_train
     columns.append(config.energy.target_column)
     columns.append('focal_length')
 
-    log.info('Loading data')
-    df = read_telescope_data(
-        signal_path, config,
-        columns,
-        feature_generation_config=model_config.feature_generation,
-        n_sample=model_config.n_signal
-    )
-
-    log.info('Total number of events: {}'.format(len(df)))
-
-    source_x, source_y = horizontal_to_camera(
-        az=df[model_config.source_az_column],
-        alt=df[model_config.source_alt_column],
-        az_pointing=df[model_config.pointing_az_column],
-        alt_pointing=df[model_config.pointing_alt_column],
-        focal_length=df['focal_length']
-    )
-
-    df['true_disp'], df['true_sign'] = calc_true_disp(
-        source_x, source_y,
-        df[model_config.cog_x_column], df[model_config.cog_y_column],
-        df[model_config.delta_column],
+    def load_training_data():
+        log.info('Loading data')
+        df = read_telescope_data(
+            signal_path, config,
+            columns,
+            feature_generation_config=model_config.feature_generation,
+            n_sample=model_config.n_signal
+        )
+
+        log.info('Total number of events: {}'.format(len(df)))
+
+        source_x, source_y = horizontal_to_camera(
+            az=df[model_config.source_az_column],
+            alt=df[model_config.source_alt_column],
+            az_pointing=df[model_config.pointing_az_column],
+            alt_pointing=df[model_config.pointing_alt_column],
+            focal_length=df['focal_length']
+        )
+
+        df['true_disp'], df['true_sign'] = calc_true_disp(
+            source_x, source_y,
+            df[model_config.cog_x_column], df[model_config.cog_y_column],
+            df[model_config.delta_column],
+        )
+
+        # generate features if given in config
+        if model_config.feature_generation:
+            feature_generation(df, model_config.feature_generation, inplace=True)
+
+        df_train = convert_to_float32(df)
+        df_train.dropna(how='any', inplace=True)
+
+        log.info('Events after nan-dropping: {} '.format(len(df_train)))
+
+        return {
+            'X': df_train[model_config.features].values,
+            'target_disp': df['true_disp'].loc[df_train.index].values,
+            'target_sign': df['true_sign'].loc[df_train.index].values,
+            'mc_energies': df_train[config.energy.target_column].values,
+            'n_events': np.array(len(df)),
+            # rows of df used for training, to write back the cv predictions
+            'index': df.index.get_indexer(df_train.index),
+        }
+
+    data = cached_training_data(
+        cache_dir, 'disp', config, model_config, [signal_path], columns,
+        load_training_data, n_samples=[model_config.n_signal],
     )
-
-    # generate features if given in config
-    if model_config.feature_generation:
-        feature_generation(df, model_config.feature_generation, inplace=True)
-
-    df_train = convert_to_float32(df)
-    df_train.dropna(how='any', inplace=True)
-    mc_energies = df_train[config.energy.target_column]
-    df_train = df_train[config.disp.features]
-
-    df['prediction_disp'] = np.zeros(len(df)) * np.nan
-
-    log.info('Events after nan-dropping: {} '.format(len(df_train)))
-
-    target_disp = df['true_disp'].loc[df_train.index]
-    target_sign = df['true_sign'].loc[df_train.index]
+    X = data['X']
+    target_disp = data['target_disp']
+    target_sign = data['target_sign']
+    mc_energies = data['mc_energies']
+    prediction_disp = np.full(int(data['n_events']), np.nan)
+    index = data['index']
 
     log.info('Starting {} fold cross validation... '.format(
         model_config.n_cross_validations
@@ -118,25 +144,17 @@ def main(configuration_path, signal_path, predictions_path, disp_model_path,
         random_state=config.seed,
     )
 
-    for fold, (train, test) in tqdm(enumerate(kfold.split(df_train.values))):
-
-        cv_x_train, cv_x_test = df_train.values[train], df_train.values[test]
-
-        cv_disp_train, cv_disp_test = target_disp.values[train], target_disp.values[test]
-        cv_sign_train, cv_sign_test = target_sign.values[train], target_sign.values[test]
-
-        disp_regressor.fit(cv_x_train, cv_disp_train)
-        cv_disp_prediction = disp_regressor.predict(cv_x_test)
-
-        sign_classifier.fit(cv_x_train, cv_sign_train)
-        cv_sign_prediction = sign_classifier.predict(cv_x_test)
-        cv_sign_proba = sign_classifier.predict_proba(cv_x_test)[:, 1]
+    folds = kfold.split(X)
+    cv_results = cross_validation.run(folds, X, target_disp, target_sign)
+    for fold, test, cv_result in cv_results:
+        cv_disp_prediction, (cv_sign_proba, cv_sign_prediction) = cv_result
+        cv_disp_test, cv_sign_test = target_disp[test], target_sign[test]
 
         scores_disp.append(metrics.r2_score(cv_disp_test, cv_disp_prediction))
         
         scores_sign.append(metrics.accuracy_score(cv_sign_test, cv_sign_prediction))
         
-        df.prediction_disp[test] = cv_disp_prediction
+        prediction_disp[index[test]] = cv_disp_prediction
 
         cv_predictions.append(pd.DataFrame({
             'disp': cv_disp_test,
@@ -169,34 +187,30 @@ def main(configuration_path, signal_path, predictions_path, disp_model_path,
 
     with h5py.File(signal_path, 'r+') as f:
             append_to_h5py(
-                f, df.prediction_disp, 
+                f, prediction_disp, 
                 config.telescope_events_key, 
                 column_name
             )
 
-    log.info('Building new model on complete data set...')
-    # set random seed again to make sure different settings
-    # for n_cross_validations don't change the final model
-    np.random.seed(config.seed)
-    disp_regressor.random_state = config.seed
-    sign_classifier.random_state = config.seed
-
-    disp_regressor.fit(df_train.values, target_disp.values)
-    sign_classifier.fit(df_train.values, target_sign.values)
+    disp_regressor, sign_classifier = cross_validation.final_models(
+        X, target_disp, target_sign,
+    )
 
     log.info('Pickling disp model to {} ...'.format(disp_model_path))
     pickle_model(
         disp_regressor,
-        feature_names=list(df_train.columns),
+        feature_names=list(model_config.features),
         model_path=disp_model_path,
         label_text='disp',
+        config_hash=config.config_hash,
     )
     log.info('Pickling sign model to {} ...'.format(sign_model_path))
     pickle_model(
         sign_classifier,
-        feature_names=list(df_train.columns),
+        feature_names=list(model_config.features),
         model_path=sign_model_path,
         label_text='disp',
+        config_hash=config.config_hash,
     )
 
 
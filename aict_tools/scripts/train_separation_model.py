@@ -2,7 +2,7 @@ import pandas as pd
 import click
 from sklearn import model_selection
 from sklearn.calibration import CalibratedClassifierCV
-from tqdm import tqdm
+from functools import partial
 import numpy as np
 from sklearn import metrics
 import logging
@@ -10,7 +10,10 @@ from fact.io import check_extension, write_data
 
 from ..configuration import AICTConfig
 from ..io import pickle_model, read_telescope_data
+from ..cache import cached_training_data
 from ..preprocessing import convert_to_float32
+from ..calibration import CALIBRATION_METHODS, CalibratedClassifier, fit_calibration
+from ..cross_validation import CrossValidation, fold_options
 
 logging.basicConfig()
 log = logging.getLogger()
@@ -24,8 +27,14 @@ log = logging.getLogger()
 @click.argument('predictions_path', type=click.Path(exists=False, dir_okay=False))
 @click.argument('model_path', type=click.Path(exists=False, dir_okay=False))
 @click.option('-v', '--verbose', help='Verbose log output', is_flag=True)
+@click.option(
+    '--cache-dir', type=click.Path(file_okay=False),
+    help='Directory to cache the preprocessed training data in, reused by'
+    ' later runs with the same input data and data related config',
+)
+@fold_options
 def main(configuration_path, signal_path, background_path, predictions_path, 
-         model_path, verbose):
+         model_path, verbose, cache_dir, fold_jobs, fold_ensemble, subsample_trees):
     '''
     Train a classifier on signal and background monte carlo data and write the model
     to MODEL_PATH in pmml or pickle format.
@@ -38,56 +47,82 @@ def main(configuration_path, signal_path, background_path, predictions_path,
 
     PREDICTIONS_PATH : path to the file where the mc predictions are stored.
 
-    MODEL_PATH: Path to save the model to. Allowed extensions are .pkl and .pmml.
-        If extension is .pmml, then both pmml and pkl file will be saved
+    MODEL_PATH: Path to save the model to. Allowed extensions are .pkl, .pmml and .forest.
+        If extension is .pmml, then both pmml and pkl file will be saved.
+        If extension is .forest, then both a memory mappable
+        compact forest and a pkl file will be saved
     '''
 
     logging.getLogger().setLevel(logging.DEBUG if verbose else logging.INFO)
 
     check_extension(predictions_path)
-    check_extension(model_path, allowed_extensions=['.pmml', '.pkl'])
+    check_extension(model_path, allowed_extensions=['.pmml', '.pkl', '.forest'])
 
     config = AICTConfig.from_yaml(configuration_path)
     model_config = config.separator
-
-    columns = model_config.columns_to_read_train
-    columns.append(config.energy.target_column)
-
-    log.info('Loading signal data')
-    df_signal = read_telescope_data(
-        signal_path, config, columns,
-        feature_generation_config=model_config.feature_generation,
-        n_sample=model_config.n_signal
+    cross_validation = CrossValidation(
+        [model_config.model], [model_path], config.seed,
+        fold_jobs=fold_jobs, fold_ensemble=fold_ensemble, subsample_trees=subsample_trees,
     )
-    df_signal['label_text'] = 'signal'
-    df_signal['label'] = 1
-
-    log.info('Loading background data')
-    df_background = read_telescope_data(
-        background_path, config, columns,
-        feature_generation_config=model_config.feature_generation,
-        n_sample=model_config.n_background
-    )
-    df_background['label_text'] = 'background'
-    df_background['label'] = 0
-
-    df_full = pd.concat([df_background, df_signal], ignore_index=True)
-
-    df_training = df_full.copy()
-    log.debug('Total training events: {}'.format(len(df_training)))
 
-    df_training.dropna(how='any', inplace=True)
-    log.debug('Training events after dropping nans: {}'.format(len(df_training)))
+    if fold_ensemble and model_config.calibrate_classifier is True:
+        raise click.ClickException(
+            '--fold-ensemble cannot be combined with calibrate_classifier: true,'
+            ' use calibrate_classifier: sigmoid or isotonic'
+        )
 
-    mc_energies = convert_to_float32(df_training[config.energy.target_column])
-    label = df_training['label']
-    df_training = convert_to_float32(df_training[model_config.features])
+    if model_config.calibrate_classifier and model_path.endswith('.forest'):
+        raise click.ClickException(
+            'A calibrated classifier cannot be stored as .forest, use .pkl'
+        )
 
-    #label = df_full.loc[df_training.index, 'label']
+    columns = model_config.columns_to_read_train
+    columns.append(config.energy.target_column)
 
+    def load_training_data():
+        log.info('Loading signal data')
+        df_signal = read_telescope_data(
+            signal_path, config, columns,
+            feature_generation_config=model_config.feature_generation,
+            n_sample=model_config.n_signal
+        )
+        df_signal['label_text'] = 'signal'
+        df_signal['label'] = 1
+
+        log.info('Loading background data')
+        df_background = read_telescope_data(
+            background_path, config, columns,
+            feature_generation_config=model_config.feature_generation,
+            n_sample=model_config.n_background
+        )
+        df_background['label_text'] = 'background'
+        df_background['label'] = 0
+
+        df_full = pd.concat([df_background, df_signal], ignore_index=True)
+
+        df_training = df_full.copy()
+        log.debug('Total training events: {}'.format(len(df_training)))
+
+        df_training.dropna(how='any', inplace=True)
+        log.debug('Training events after dropping nans: {}'.format(len(df_training)))
+
+        return {
+            'X': convert_to_float32(df_training[model_config.features]).values,
+            'label': df_training['label'].values,
+            'mc_energies': convert_to_float32(df_training[config.energy.target_column]).values,
+        }
+
+    data = cached_training_data(
+        cache_dir, 'separator', config, model_config,
+        [signal_path, background_path], columns, load_training_data,
+        n_samples=[model_config.n_signal, model_config.n_background],
+    )
+    X = data['X']
+    y = data['label']
+    mc_energies = data['mc_energies']
 
-    n_gammas = len(label[label == 1])
-    n_protons = len(label[label == 0])
+    n_gammas = np.count_nonzero(y == 1)
+    n_protons = np.count_nonzero(y == 0)
     log.info('Training classifier with {} background and {} signal events'.format(
         n_protons, n_gammas
     ))
@@ -96,11 +131,7 @@ def main(configuration_path, signal_path, background_path, predictions_path,
     # save prediction_path for each cv iteration
     cv_predictions = []
 
-    # iterate over test and training sets
-    X = df_training.values
-    y = label.values
     n_cross_validations = model_config.n_cross_validations
-    classifier = model_config.model
 
     log.info('Starting {} fold cross validation... '.format(n_cross_validations))
 
@@ -109,17 +140,12 @@ def main(configuration_path, signal_path, background_path, predictions_path,
     )
 
     aucs = []
-    cv_it = stratified_kfold.split(X, y)
-    for fold, (train, test) in enumerate(tqdm(cv_it, total=n_cross_validations)):
-        # select data
-        xtrain, xtest = X[train], X[test]
-        ytrain, ytest = y[train], y[test]
-
-        # fit and predict
-        classifier.fit(xtrain, ytrain)
-
-        y_probas = classifier.predict_proba(xtest)[:, 1]
-        y_prediction = classifier.predict(xtest)
+    # out-of-fold scores of all events, used to calibrate the final model
+    cv_scores = np.full(len(y), np.nan)
+    folds = stratified_kfold.split(X, y)
+    for fold, test, ((y_probas, y_prediction), ) in cross_validation.run(folds, X, y):
+        ytest = y[test]
+        cv_scores[test] = y_probas
 
         cv_predictions.append(pd.DataFrame({
             'label': ytest,
@@ -136,25 +162,28 @@ def main(configuration_path, signal_path, background_path, predictions_path,
     log.info('Writing predictions from cross validation')
     write_data(predictions_df, predictions_path, mode='w')
 
-    # set random seed again to make sure different settings
-    # for n_cross_validations don't change the final model
-    np.random.seed(config.seed)
-    classifier.random_state = config.seed
-
-    if model_config.calibrate_classifier:
+    refit = None
+    if model_config.calibrate_classifier is True:
         log.info('Training calibrated classifier')
-        classifier = CalibratedClassifierCV(classifier, cv=2, method='sigmoid')
-        classifier.fit(X, y)
-    else:
-        log.info('Training model on complete dataset')
-        classifier.fit(X, y)
+        refit = partial(CalibratedClassifierCV, cv=2, method='sigmoid')
+    classifier, = cross_validation.final_models(X, y, refit=refit)
+
+    if model_config.calibrate_classifier in CALIBRATION_METHODS:
+        log.info('Calibrating on the cross validated scores ({})'.format(
+            model_config.calibrate_classifier
+        ))
+        classifier = CalibratedClassifier(
+            classifier,
+            fit_calibration(cv_scores, y, model_config.calibrate_classifier),
+        )
 
     log.info('Pickling model to {} ...'.format(model_path))
     pickle_model(
         classifier=classifier,
         model_path=model_path,
         label_text='label',
-        feature_names=list(df_training.columns)
+        feature_names=list(model_config.features),
+        config_hash=config.config_hash,
     )
 
 
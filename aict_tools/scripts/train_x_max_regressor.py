@@ -2,14 +2,15 @@ import pandas as pd
 import click
 from sklearn import model_selection
 from sklearn import metrics
-from tqdm import tqdm
 import numpy as np
 import h5py
 
 from fact.io import write_data, read_data
 from ..io import pickle_model, read_telescope_data, append_to_h5py
+from ..cache import cached_training_data
 from ..preprocessing import convert_to_float32
 from ..configuration import AICTConfig
+from ..cross_validation import CrossValidation, fold_options
 import logging
 
 logging.basicConfig()
@@ -25,8 +26,14 @@ log = logging.getLogger()
 @click.option('-v', '--verbose', help='Verbose log output', is_flag=True)
 @click.option('-c', '--column_name', 
               help='Name of column to be added', default='x_max')
+@click.option(
+    '--cache-dir', type=click.Path(file_okay=False),
+    help='Directory to cache the preprocessed training data in, reused by'
+    ' later runs with the same input data and data related config',
+)
+@fold_options
 def main(configuration_path, signal_path, predictions_path, model_path, verbose, 
-         column_name):
+         column_name, cache_dir, fold_jobs, fold_ensemble, subsample_trees):
     '''
     Train a x_max regressor.
     Both pmml and pickle format are supported for the output.
@@ -38,40 +45,58 @@ def main(configuration_path, signal_path, predictions_path, model_path, verbose,
     PREDICTIONS_PATH : path to the file where the mc predictions are stored.
 
     MODEL_PATH: Path to save the model to.
-        Allowed extensions are .pkl and .pmml.
-        If extension is .pmml, then both pmml and pkl file will be saved
+        Allowed extensions are .pkl, .pmml and .forest.
+        If extension is .pmml, then both pmml and pkl file will be saved.
+        If extension is .forest, then both a memory mappable
+        compact forest and a pkl file will be saved
     '''
     logging.getLogger().setLevel(logging.DEBUG if verbose else logging.INFO)
 
     config = AICTConfig.from_yaml(configuration_path)
     model_config = config.x_max
+    cross_validation = CrossValidation(
+        [model_config.model], [model_path], config.seed,
+        fold_jobs=fold_jobs, fold_ensemble=fold_ensemble, subsample_trees=subsample_trees,
+    )
 
     columns = model_config.columns_to_read_train
     columns.append(config.energy.target_column)
 
-    df = read_telescope_data(
-        signal_path, config,
-        columns,
-        feature_generation_config=model_config.feature_generation,
-        n_sample=model_config.n_signal
+    def load_training_data():
+        df = read_telescope_data(
+            signal_path, config,
+            columns,
+            feature_generation_config=model_config.feature_generation,
+            n_sample=model_config.n_signal
+        )
+
+        log.info('Total number of events: {}'.format(len(df)))
+
+        df_train = convert_to_float32(df)
+        df_train.dropna(how='any', inplace=True)
+
+        log.debug('Events after nan-dropping: {} '.format(len(df_train)))
+
+        return {
+            'X': df_train[model_config.features].values,
+            'target': df[model_config.target_column].loc[df_train.index].values,
+            'mc_energies': df_train[config.energy.target_column].values,
+            'n_events': np.array(len(df)),
+            # rows of df used for training, to write back the cv predictions
+            'index': df.index.get_indexer(df_train.index),
+        }
+
+    data = cached_training_data(
+        cache_dir, 'x_max', config, model_config, [signal_path], columns,
+        load_training_data, n_samples=[model_config.n_signal],
     )
-
-    log.info('Total number of events: {}'.format(len(df)))
-
-    df_train = convert_to_float32(df)
-    df_train.dropna(how='any', inplace=True)
-    mc_energies = df_train[config.energy.target_column]
-    df_train = df_train[config.x_max.features]
-
-    df['prediction_x_max'] = np.zeros(len(df)) * np.nan
-
-    log.debug('Events after nan-dropping: {} '.format(len(df_train)))
-
-    target = df[model_config.target_column].loc[df_train.index]
-    target.name = 'true_x_max'
+    X = data['X']
+    target = data['target']
+    mc_energies = data['mc_energies']
+    prediction_x_max = np.full(int(data['n_events']), np.nan)
+    index = data['index']
 
     n_cross_validations = model_config.n_cross_validations
-    regressor = model_config.model
     log.info('Starting {} fold cross validation... '.format(n_cross_validations))
 
     scores = []
@@ -80,13 +105,9 @@ def main(configuration_path, signal_path, predictions_path, model_path, verbose,
     kfold = model_selection.KFold(n_splits=n_cross_validations, 
                     shuffle=True, random_state=config.seed)
 
-    for fold, (train, test) in tqdm(enumerate(kfold.split(df_train.values))):
-
-        cv_x_train, cv_x_test = df_train.values[train], df_train.values[test]
-        cv_y_train, cv_y_test = target.values[train], target.values[test]
-
-        regressor.fit(cv_x_train, cv_y_train)
-        cv_y_prediction = regressor.predict(cv_x_test)
+    folds = kfold.split(X)
+    for fold, test, (cv_y_prediction, ) in cross_validation.run(folds, X, target):
+        cv_y_test = target[test]
 
         if model_config.log_target is True:
             cv_y_test = np.exp(cv_y_test)
@@ -94,7 +115,7 @@ def main(configuration_path, signal_path, predictions_path, model_path, verbose,
 
         scores.append(metrics.r2_score(cv_y_test, cv_y_prediction))
 
-        df.prediction_x_max[test] = cv_y_prediction
+        prediction_x_max[index[test]] = cv_y_prediction
 
         cv_predictions.append(pd.DataFrame({
             'x_max': cv_y_test,
@@ -115,7 +136,7 @@ def main(configuration_path, signal_path, predictions_path, model_path, verbose,
 
     with h5py.File(signal_path, 'r+') as f:
             append_to_h5py(
-                f, df.prediction_x_max, 
+                f, prediction_x_max, 
                 config.telescope_events_key, 
                 column_name
             )
@@ -125,20 +146,15 @@ def main(configuration_path, signal_path, predictions_path, model_path, verbose,
         scores.mean(), scores.std()
     ))
 
-    log.info('Building new model on complete data set...')
-    # set random seed again to make sure different settings
-    # for n_cross_validations don't change the final model
-    np.random.seed(config.seed)
-    regressor.random_state = config.seed
-
-    regressor.fit(df_train.values, target.values)
+    regressor, = cross_validation.final_models(X, target)
 
     log.info('Pickling model to {} ...'.format(model_path))
     pickle_model(
             regressor,
-            feature_names=list(df_train.columns),
+            feature_names=list(model_config.features),
             model_path=model_path,
             label_text=column_name,
+            config_hash=config.config_hash,
     )
 
 
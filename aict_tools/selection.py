@@ -0,0 +1,403 @@
+import hashlib
+import json
+import logging
+from operator import le, lt, eq, ne, ge, gt
+from time import perf_counter
+
+import h5py
+import numpy as np
+
+
+log = logging.getLogger(__name__)
+
+# rows read at once from not chunked datasets by read_rows
+CONTIGUOUS_BLOCK = 2**12
+
+# group containing the zone maps of all indexed groups
+ZONE_MAPS_KEY = 'zone_maps'
+
+OPERATORS = {
+    '<': lt, 'lt': lt,
+    '<=': le, 'le': le,
+    '==': eq, 'eq': eq,
+    '=': eq,
+    '!=': ne, 'ne': ne,
+    '>': gt, 'gt': gt,
+    '>=': ge, 'ge': ge,
+}
+
+
+def sample_fingerprint(dataset, step):
+    '''
+    Checksum of the dtype, the shape, every step-th row and the last row of dataset,
+    used to notice columns changed after their zone maps were built
+    without reading them completely.
+    '''
+    checksum = hashlib.sha256('{} {}'.format(dataset.dtype.str, dataset.shape).encode())
+    checksum.update(np.ascontiguousarray(dataset[::step]).tobytes())
+    checksum.update(np.ascontiguousarray(dataset[-1:]).tobytes())
+    return checksum.hexdigest()
+
+
+def n_rows_group(group):
+    '''
+    Number of rows of the datasets in an open h5py group
+    '''
+    for dataset in group.values():
+        return dataset.shape[0]
+    return 0
+
+
+def read_rows(dataset, start, end, rows):
+    '''
+    Read rows (sorted, relative to start) of dataset[start:end].
+    Only the storage chunks of the dataset containing any of the rows
+    are read, runs of neighbouring chunks are read at once.
+    '''
+    n_rows = end - start
+    if len(rows) == 0:
+        return dataset[start:start]
+    if len(rows) > n_rows // 2:
+        return dataset[start:end][rows]
+
+    block = dataset.chunks[0] if dataset.chunks else CONTIGUOUS_BLOCK
+    blocks = np.unique((start + rows) // block)
+    # split the needed blocks into runs of consecutive blocks
+    run_starts = np.append(0, np.flatnonzero(np.diff(blocks) > 1) + 1)
+    run_ends = np.append(run_starts[1:], len(blocks))
+
+    parts = []
+    for first, last in zip(blocks[run_starts], blocks[run_ends - 1]):
+        read_start = max(start, first * block)
+        read_end = min(end, (last + 1) * block)
+        lo, hi = np.searchsorted(rows, [read_start - start, read_end - start])
+        parts.append(dataset[read_start:read_end][rows[lo:hi] - (read_start - start)])
+
+    return np.concatenate(parts)
+
+
+class SelectionEvaluator:
+    '''
+    Compiled version of a selection config {column: [operator, value]}.
+
+    `mask` evaluates the cuts one after another on an open h5py group.
+    Each cut only reads the rows that survived the previous cuts
+    and evaluation stops as soon as no row is left.
+    After each call, the cuts are reordered by their measured cost per row
+    divided by the fraction of rows they remove, so cheap cuts
+    removing many events run first on the next chunk.
+    '''
+    def __init__(self, selection_config):
+        self.cuts = []
+        for name, (operator, value) in selection_config.items():
+            if operator not in OPERATORS:
+                raise ValueError('Unknown operator "{}" for column {}'.format(operator, name))
+            self.cuts.append((name, OPERATORS[operator], value, operator))
+        self.config_order = list(self.cuts)
+
+        self.n_evaluated = {name: 0 for name, *_ in self.cuts}
+        self.n_passed = {name: 0 for name, *_ in self.cuts}
+        self.duration = {name: 0.0 for name, *_ in self.cuts}
+
+    def rank(self, cut):
+        name = cut[0]
+        n = self.n_evaluated[name]
+        if n == 0:
+            # not measured yet, measure as soon as possible
+            return -np.inf
+        cost = self.duration[name] / n
+        removed = 1 - self.n_passed[name] / n
+        return cost / max(removed, 1e-12)
+
+    def mask(self, group, start=0, end=None, cut_flow=None, keys=None, rows=None):
+        '''
+        Boolean mask for rows [start:end] of the datasets in group.
+        If rows (sorted, relative to start) are given, only these rows
+        are evaluated, all others are rejected.
+
+        If a CutFlow is given, the cuts are evaluated in config order
+        and the surviving rows after each cut are added to it.
+        keys are the array event key columns of the rows, they are read
+        from group if cut_flow needs them and they are not given.
+        '''
+        if end is None:
+            end = n_rows_group(group)
+
+        mask = np.zeros(end - start, dtype=bool)
+        alive = np.arange(end - start) if rows is None else np.asarray(rows)
+
+        cuts = self.cuts
+        if cut_flow is not None:
+            cuts = self.config_order
+            if keys is None and cut_flow.key_columns is not None:
+                keys = [group[column][start:end] for column in cut_flow.key_columns]
+            cut_flow.update(0, alive, keys)
+
+        for stage, (name, operator, value, operator_name) in enumerate(cuts, start=1):
+            if len(alive) == 0:
+                break
+
+            t0 = perf_counter()
+            passed = operator(read_rows(group[name], start, end, alive), value)
+            self.duration[name] += perf_counter() - t0
+            self.n_evaluated[name] += len(alive)
+            self.n_passed[name] += np.count_nonzero(passed)
+
+            log.debug('Cut "{} {} {}" removed {} events'.format(
+                name, operator_name, value, len(alive) - np.count_nonzero(passed)
+            ))
+            alive = alive[passed]
+            if cut_flow is not None:
+                cut_flow.update(stage, alive, keys)
+
+        mask[alive] = True
+
+        # stable sort keeps the config order for equal ranks
+        self.cuts.sort(key=self.rank)
+        return mask
+
+
+class CutFlow:
+    '''
+    Number of telescope events and array events surviving each cut
+    of a selection config, accumulated over chunks by `SelectionEvaluator.mask`.
+
+    Array events are counted from the key columns (run_id, array_event_id),
+    which have to be sorted as the telescope events are.
+    Pass key_columns=None to only count telescope events.
+    '''
+    def __init__(self, selection_config, key_columns=('run_id', 'array_event_id')):
+        self.cuts = [
+            '{} {} {}'.format(name, operator, value)
+            for name, (operator, value) in selection_config.items()
+        ]
+        self.key_columns = None if key_columns is None else list(key_columns)
+
+        n_stages = len(self.cuts) + 1
+        self.n_telescope_events = np.zeros(n_stages, dtype=np.int64)
+        self.n_array_events = np.zeros(n_stages, dtype=np.int64)
+        # last counted array event of each stage, to not count array events
+        # spanning two chunks twice
+        self.last_keys = [None] * n_stages
+
+    @property
+    def levels(self):
+        if self.key_columns is None:
+            return ['telescope_events']
+        return ['telescope_events', 'array_events']
+
+    def update(self, stage, rows, keys=None):
+        '''
+        Add rows (indices into keys) surviving the first `stage` cuts
+        '''
+        self.n_telescope_events[stage] += len(rows)
+        if keys is None or len(rows) == 0:
+            return
+
+        selected = [k[rows] for k in keys]
+        new = np.zeros(len(rows), dtype=bool)
+        for k in selected:
+            new[1:] |= k[1:] != k[:-1]
+        new[0] = tuple(k[0] for k in selected) != self.last_keys[stage]
+
+        self.n_array_events[stage] += np.count_nonzero(new)
+        self.last_keys[stage] = tuple(k[-1] for k in selected)
+
+    def to_dict(self):
+        '''
+        Cut flow as a list of dicts, one per cut,
+        with the number of events before and after the cut,
+        the efficiency of the cut and the cumulative efficiency
+        '''
+        rows = []
+        for stage, cut in enumerate(self.cuts, start=1):
+            row = {'cut': cut}
+            for level in self.levels:
+                counts = getattr(self, 'n_' + level)
+                total = int(counts[0])
+                before, after = int(counts[stage - 1]), int(counts[stage])
+                row[level] = {
+                    'before': before,
+                    'after': after,
+                    'efficiency': after / before if before > 0 else float('nan'),
+                    'cumulative_efficiency': after / total if total > 0 else float('nan'),
+                }
+            rows.append(row)
+        return rows
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_h5py(self, path, key='cut_flow', mode='a'):
+        '''
+        Write the cut flow as a table with one row per cut into group key
+        '''
+        rows = self.to_dict()
+        with h5py.File(path, mode) as f:
+            if key in f:
+                del f[key]
+            group = f.create_group(key)
+            group.create_dataset('cut', data=np.array(self.cuts, dtype=h5py.string_dtype()))
+            for level in self.levels:
+                for field in ('before', 'after', 'efficiency', 'cumulative_efficiency'):
+                    group.create_dataset(
+                        '{}_{}'.format(level, field),
+                        data=np.array([row[level][field] for row in rows]),
+                    )
+
+
+class ZoneMaps:
+    '''
+    Minimum and maximum of columns in blocks of block_size rows,
+    used to skip blocks that cannot pass a selection.
+
+    Zone maps are created once for a file using `ZoneMaps.build`
+    and stored in the group "zone_maps/<key>" of the file,
+    together with a sample_fingerprint of each column.
+    '''
+    def __init__(self, block_size, n_rows, minimum, maximum, fingerprints):
+        self.block_size = block_size
+        self.n_rows = n_rows
+        self.minimum = minimum
+        self.maximum = maximum
+        self.fingerprints = fingerprints
+
+    @classmethod
+    def build(cls, group, block_size=2**14, columns=None):
+        '''
+        Compute the zone maps for the numeric 1d columns of an open h5py group
+        '''
+        if columns is None:
+            columns = [
+                name for name, dataset in group.items()
+                if dataset.ndim == 1 and dataset.dtype.kind in 'biuf'
+            ]
+
+        n_rows = n_rows_group(group)
+        n_blocks = int(np.ceil(n_rows / block_size))
+        minimum = {}
+        maximum = {}
+        fingerprints = {}
+        for column in columns:
+            fingerprints[column] = sample_fingerprint(group[column], block_size)
+            minimum[column] = np.full(n_blocks, np.nan)
+            maximum[column] = np.full(n_blocks, np.nan)
+            dataset = group[column]
+            for block in range(n_blocks):
+                values = dataset[block * block_size:(block + 1) * block_size]
+                values = values[~np.isnan(values)] if values.dtype.kind == 'f' else values
+                # blocks with only nans keep nan, no comparison passes for them
+                if len(values) > 0:
+                    lower, upper = values.min(), values.max()
+                    # round outwards, large integers are not exact as float64
+                    minimum[column][block] = np.nextafter(float(lower), -np.inf) \
+                        if float(lower) > lower.item() else lower
+                    maximum[column][block] = np.nextafter(float(upper), np.inf) \
+                        if float(upper) < upper.item() else upper
+
+        return cls(block_size, n_rows, minimum, maximum, fingerprints)
+
+    def write(self, f, key):
+        '''
+        Store the zone maps of group key in the open h5py file f
+        '''
+        name = '{}/{}'.format(ZONE_MAPS_KEY, key)
+        if name in f:
+            del f[name]
+        group = f.create_group(name)
+        group.attrs['block_size'] = self.block_size
+        group.attrs['n_rows'] = self.n_rows
+        for column in self.minimum:
+            group[column] = np.column_stack([self.minimum[column], self.maximum[column]])
+            group[column].attrs['fingerprint'] = self.fingerprints[column]
+
+    @classmethod
+    def read(cls, f, key, columns=None):
+        '''
+        Read the zone maps of group key from the open h5py file f,
+        only of the given columns if columns is not None.
+        Returns None if the file has no zone maps for key or
+        if they do not match the number of rows of key anymore.
+        Zone maps of columns whose fingerprint changed are left out,
+        so all rows are evaluated for cuts on these columns.
+        '''
+        name = '{}/{}'.format(ZONE_MAPS_KEY, key)
+        if name not in f:
+            return None
+
+        group = f[name]
+        n_rows = n_rows_group(f[key])
+        if group.attrs['n_rows'] != n_rows:
+            log.warning('Ignoring outdated zone maps for {}'.format(key))
+            return None
+
+        block_size = int(group.attrs['block_size'])
+        minimum = {}
+        maximum = {}
+        fingerprints = {}
+        for column, dataset in group.items():
+            if columns is not None and column not in columns:
+                continue
+
+            fingerprint = dataset.attrs.get('fingerprint')
+            if column not in f[key] or fingerprint != sample_fingerprint(f[key][column], block_size):
+                log.warning('Ignoring outdated zone map of {}/{}'.format(key, column))
+                continue
+
+            values = dataset[:]
+            minimum[column] = values[:, 0]
+            maximum[column] = values[:, 1]
+            fingerprints[column] = fingerprint
+
+        return cls(block_size, n_rows, minimum, maximum, fingerprints)
+
+    def candidate_rows(self, selection_config, start, end):
+        '''
+        Rows (relative to start) of [start:end] in blocks that can contain
+        rows passing all cuts of selection_config.
+        '''
+        first = start // self.block_size
+        last = int(np.ceil(end / self.block_size))
+        candidates = np.ones(last - first, dtype=bool)
+
+        for name, (operator, value) in selection_config.items():
+            # != passes nans, so blocks cannot be excluded using min and max
+            if name not in self.minimum or OPERATORS[operator] is ne:
+                continue
+            operator = OPERATORS[operator]
+            minimum = self.minimum[name][first:last]
+            maximum = self.maximum[name][first:last]
+
+            with np.errstate(invalid='ignore'):
+                if operator in (lt, le):
+                    candidates &= operator(minimum, value)
+                elif operator in (gt, ge):
+                    candidates &= operator(maximum, value)
+                else:
+                    candidates &= (minimum <= value) & (maximum >= value)
+
+        blocks = np.flatnonzero(candidates) + first
+        rows = (blocks[:, np.newaxis] * self.block_size + np.arange(self.block_size)).ravel()
+        rows = rows[(rows >= start) & (rows < end)]
+        return rows - start
+
+
+def drop_zone_map(f, key, column):
+    '''
+    Remove the zone map of a column of group key in the open h5py file f,
+    needed when the column is changed or deleted
+    '''
+    name = '{}/{}/{}'.format(ZONE_MAPS_KEY, key, column)
+    if name in f:
+        del f[name]
+
+
+def index_zone_maps(path, key='telescope_events', block_size=2**14, columns=None):
+    '''
+    Compute and store the zone maps of group key in the hdf5 file at path
+    '''
+    with h5py.File(path, 'r+') as f:
+        zone_maps = ZoneMaps.build(f[key], block_size=block_size, columns=columns)
+        zone_maps.write(f, key)
+    return zone_maps
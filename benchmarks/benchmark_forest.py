@@ -0,0 +1,130 @@
+'''
+Compare prediction times of scikit-learn forests and their
+aict_tools.forest.CompactForest version for different chunk sizes
+and the times to load and apply models stored as .pkl and .forest.
+With --threshold, also time aict_tools.ensemble.predict_proba_thresholded.
+
+    python benchmarks/benchmark_forest.py --n-estimators 200 --n-jobs -1
+'''
+import os
+import tempfile
+import time
+
+import click
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+
+from aict_tools.ensemble import predict_proba_thresholded
+from aict_tools.forest import CompactForest
+from aict_tools.io import pickle_model, load_model
+
+
+def best_time(func, X, chunksize, repeat=3):
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        for start in range(0, len(X), chunksize):
+            func(X[start:start + chunksize])
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def best_load_time(path, X, repeat=3):
+    '''
+    Best times to load the model at path and to predict X with it
+    '''
+    load_times = []
+    predict_times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        model = load_model(path)
+        t1 = time.perf_counter()
+        model.predict(X)
+        load_times.append(t1 - t0)
+        predict_times.append(time.perf_counter() - t1)
+    return min(load_times), min(predict_times)
+
+
+@click.command()
+@click.option('--n-estimators', default=100, show_default=True)
+@click.option('--n-features', default=10, show_default=True)
+@click.option('--n-train', default=20000, show_default=True)
+@click.option('--n-events', default=100000, show_default=True)
+@click.option('--min-samples-leaf', default=2, show_default=True)
+@click.option('-n', '--n-jobs', default=1, show_default=True, help='n_jobs of the sklearn model')
+@click.option(
+    '-c', '--chunksize', 'chunksizes', multiple=True, type=int,
+    default=[1000, 10000, 100000], show_default=True,
+)
+@click.option(
+    '-t', '--threshold', type=float,
+    help='Also time predict_proba_thresholded of the classifier for this threshold',
+)
+def main(n_estimators, n_features, n_train, n_events, min_samples_leaf, n_jobs, chunksizes, threshold):
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(n_train + n_events, n_features)).astype(np.float32)
+    y = X[:, 0] + X[:, 1]**2 + rng.normal(0, 0.5, len(X))
+
+    models = {
+        'regressor': RandomForestRegressor,
+        'classifier': RandomForestClassifier,
+    }
+
+    click.echo('{:>10} {:>10} {:>12} {:>12} {:>8}'.format(
+        'model', 'chunksize', 'sklearn / s', 'compact / s', 'speedup'
+    ))
+    fitted = {}
+    for name, cls in models.items():
+        target = y[:n_train] > 1 if name == 'classifier' else y[:n_train]
+        model = cls(
+            n_estimators=n_estimators,
+            min_samples_leaf=min_samples_leaf,
+            n_jobs=n_jobs,
+            random_state=0,
+        )
+        model.fit(X[:n_train], target)
+        fitted[name] = model
+        forest = CompactForest.from_sklearn(model)
+
+        X_test = X[n_train:]
+        if name == 'classifier':
+            assert np.allclose(forest.predict_proba(X_test), model.predict_proba(X_test))
+            sklearn_predict, compact_predict = model.predict_proba, forest.predict_proba
+        else:
+            assert np.allclose(forest.predict(X_test), model.predict(X_test))
+            sklearn_predict, compact_predict = model.predict, forest.predict
+
+        for chunksize in chunksizes:
+            t_sklearn = best_time(sklearn_predict, X_test, chunksize)
+            t_compact = best_time(compact_predict, X_test, chunksize)
+            click.echo('{:>10} {:>10d} {:>12.3f} {:>12.3f} {:>8.2f}'.format(
+                name, chunksize, t_sklearn, t_compact, t_sklearn / t_compact,
+            ))
+
+            if name == 'classifier' and threshold is not None:
+                t_threshold = best_time(
+                    lambda X: predict_proba_thresholded(model, X, threshold), X_test, chunksize,
+                )
+                click.echo('{:>10} {:>10d} {:>12.3f} {:>12.3f} {:>8.2f}'.format(
+                    'threshold', chunksize, t_sklearn, t_threshold, t_sklearn / t_threshold,
+                ))
+
+    click.echo()
+    click.echo('{:>10} {:>10} {:>12} {:>12}'.format(
+        'model', 'format', 'load / s', 'predict / s'
+    ))
+    with tempfile.TemporaryDirectory(prefix='aict_tools_benchmark_') as d:
+        for name, model in fitted.items():
+            features = ['f{}'.format(i) for i in range(n_features)]
+            pickle_model(model, features, os.path.join(d, name + '.forest'))
+            for extension in ('.pkl', '.forest'):
+                t_load, t_predict = best_load_time(
+                    os.path.join(d, name + extension), X[n_train:],
+                )
+                click.echo('{:>10} {:>10} {:>12.3f} {:>12.3f}'.format(
+                    name, extension, t_load, t_predict,
+                ))
+
+
+if __name__ == '__main__':
+    main()
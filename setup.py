@@ -9,6 +9,7 @@ setup(
     author_email='kai.bruegge@tu-dortmund.de',
     license='MIT',
     packages=find_packages(),
+    python_requires='>=3.8',
     setup_requires=['pytest-runner'],
     tests_require=['pytest'],
     install_requires=[
@@ -40,6 +41,7 @@ setup(
             'aict_apply_disp_regressor = aict_tools.scripts.apply_disp_regressor:main',
             'aict_train_x_max_regressor = aict_tools.scripts.train_x_max_regressor:main',
             'aict_apply_x_max_regressor = aict_tools.scripts.apply_x_max_regressor:main',
+            'aict_apply_all = aict_tools.scripts.apply_all:main',
             'aict_split_data = aict_tools.scripts.split_data:main',
             'aict_equalize_data = aict_tools.scripts.equalize_data:main',
             'aict_plot_gh_performance = aict_tools.scripts.plot_gh_performance:main',
@@ -47,6 +49,7 @@ setup(
             'aict_plot_direction_performance = aict_tools.scripts.plot_direction_performance:main',
             'aict_plot_x_max_performance = aict_tools.scripts.plot_x_max_performance:main',
             'aict_apply_cuts = aict_tools.scripts.apply_cuts:main',
+            'aict_index_zone_maps = aict_tools.scripts.index_zone_maps:main',
             'aict_convert_pandas2h5py = klaas.scripts.convert_pandas2h5py:main',
             'fact_to_dl3 = aict_tools.scripts.fact_to_dl3:main',
         ],
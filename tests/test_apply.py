@@ -0,0 +1,253 @@
+import numpy as np
+import pandas as pd
+import h5py
+import tempfile
+import os
+
+
+class Config:
+    run_id_column = 'run_id'
+    array_event_id_column = 'array_event_id'
+    array_events_key = 'array_events'
+
+
+def test_array_event_aggregator():
+    from aict_tools.apply import ArrayEventAggregator
+
+    rng = np.random.RandomState(0)
+    n_array_events = 50
+    array_events = pd.DataFrame({
+        'run_id': np.repeat([1, 2], n_array_events // 2),
+        'array_event_id': np.tile(np.arange(n_array_events // 2), 2),
+    })
+    # array events without telescope events get 0 telescopes
+    n_telescopes = rng.randint(0, 4, n_array_events)
+    telescope_events = array_events.loc[
+        np.repeat(array_events.index, n_telescopes)
+    ].reset_index(drop=True)
+    telescope_events['gamma'] = rng.uniform(0, 1, len(telescope_events))
+    telescope_events.loc[::7, 'gamma'] = np.nan
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'test.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group('array_events')
+            group['run_id'] = array_events['run_id'].values
+            group['array_event_id'] = array_events['array_event_id'].values
+
+        aggregator = ArrayEventAggregator(path, Config, ['gamma'])
+
+    result = {c: np.full(n_array_events, -1.0) for c in aggregator.output_columns}
+    blocks = []
+    for start in range(0, len(telescope_events), 13):
+        chunk = telescope_events.iloc[start:start + 13]
+        blocks.append(aggregator.update(chunk, {'gamma': chunk['gamma']}))
+    blocks.append(aggregator.finish())
+
+    next_row = 0
+    for start, end, block in blocks:
+        assert start == next_row
+        for column, values in block.items():
+            result[column][start:end] = values
+        next_row = end
+    assert next_row == n_array_events
+
+    expected = telescope_events.groupby(['run_id', 'array_event_id'])['gamma'].agg(['mean', 'std'])
+    expected = array_events.join(expected, on=['run_id', 'array_event_id'])
+
+    assert np.allclose(result['gamma_mean'], expected['mean'], equal_nan=True)
+    assert np.allclose(result['gamma_std'], expected['std'], equal_nan=True)
+
+
+def test_array_event_aggregator_unordered():
+    from aict_tools.apply import ArrayEventAggregator
+
+    rng = np.random.RandomState(1)
+    n_array_events = 60
+    array_events = pd.DataFrame({
+        'run_id': np.repeat([1, 2], n_array_events // 2),
+        'array_event_id': np.tile(np.arange(n_array_events // 2), 2),
+    })
+    n_telescopes = rng.randint(0, 4, n_array_events)
+    telescope_events = array_events.loc[
+        np.repeat(array_events.index, n_telescopes)
+    ].reset_index(drop=True)
+    telescope_events['gamma'] = rng.uniform(0, 1, len(telescope_events))
+
+    # array events in a different order than the telescope events,
+    # telescope events of the same array event not consecutive
+    array_events = array_events.iloc[rng.permutation(n_array_events)].reset_index(drop=True)
+    telescope_events = telescope_events.iloc[rng.permutation(len(telescope_events))]
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'test.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group('array_events')
+            group['run_id'] = array_events['run_id'].values
+            group['array_event_id'] = array_events['array_event_id'].values
+
+        aggregator = ArrayEventAggregator(path, Config, ['gamma'])
+
+    result = {c: np.full(n_array_events, -1.0) for c in aggregator.output_columns}
+    blocks = []
+    for start in range(0, len(telescope_events), 13):
+        chunk = telescope_events.iloc[start:start + 13]
+        blocks.append(aggregator.update(chunk, {'gamma': chunk['gamma']}))
+    blocks.append(aggregator.finish())
+    # later blocks can overwrite earlier ones
+    for start, end, block in blocks:
+        for column, values in block.items():
+            result[column][start:end] = values
+
+    expected = telescope_events.groupby(['run_id', 'array_event_id'])['gamma'].agg(['mean', 'std'])
+    expected = array_events.join(expected, on=['run_id', 'array_event_id'])
+
+    assert np.allclose(result['gamma_mean'], expected['mean'], equal_nan=True)
+    assert np.allclose(result['gamma_std'], expected['std'], equal_nan=True)
+
+
+def test_selection_evaluator():
+    from aict_tools.apply import SelectionEvaluator, create_mask_h5py, OPERATORS
+
+    rng = np.random.RandomState(0)
+    n_events = 10000
+    columns = {
+        'size': rng.exponential(100, n_events),
+        'width': rng.uniform(0, 1, n_events),
+        'length': rng.uniform(0, 1, n_events),
+    }
+    selection = {
+        'size': ['>', 60],
+        'width': ['<=', 0.3],
+        'length': ['lt', 0.1],
+    }
+
+    expected = np.ones(n_events, dtype=bool)
+    for name, (operator, value) in selection.items():
+        expected &= OPERATORS[operator](columns[name], value)
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'test.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group('telescope_events')
+            for name, values in columns.items():
+                group.create_dataset(name, data=values, chunks=(128, ))
+
+        assert np.array_equal(create_mask_h5py(path, selection), expected)
+
+        evaluator = SelectionEvaluator(selection)
+        with h5py.File(path, 'r') as f:
+            for start in range(0, n_events, 3000):
+                end = min(start + 3000, n_events)
+                mask = evaluator.mask(f['telescope_events'], start, end)
+                assert np.array_equal(mask, expected[start:end])
+
+        # all cuts were measured and the evaluator reordered them
+        assert sorted(c[0] for c in evaluator.cuts) == sorted(selection)
+        assert all(evaluator.n_evaluated[name] > 0 for name in selection)
+
+
+def test_cut_flow():
+    from aict_tools.apply import CutFlow, apply_cuts_h5py_chunked, OPERATORS
+
+    rng = np.random.RandomState(1)
+    n_array_events = 500
+    n_telescopes = rng.randint(1, 4, n_array_events)
+    n_events = n_telescopes.sum()
+    columns = {
+        'run_id': np.repeat(np.repeat([1, 2], n_array_events // 2), n_telescopes),
+        'array_event_id': np.repeat(np.arange(n_array_events), n_telescopes),
+        'size': rng.exponential(100, n_events),
+        'width': rng.uniform(0, 1, n_events),
+    }
+    selection = {'size': ['>', 60], 'width': ['<=', 0.3]}
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'test.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group('telescope_events')
+            for name, values in columns.items():
+                group.create_dataset(name, data=values, chunks=(64, ))
+            group['image'] = rng.normal(size=(n_events, 2, 3))
+
+            group = f.create_group('array_events')
+            # array events in a different order than the telescope events
+            order = rng.permutation(n_array_events)
+            group['run_id'] = np.repeat([1, 2], n_array_events // 2)[order]
+            group['array_event_id'] = np.arange(n_array_events)[order]
+
+        cut_flow = CutFlow(selection)
+        output_path = os.path.join(d, 'output.hdf5')
+        apply_cuts_h5py_chunked(
+            path, output_path, selection, chunksize=333, progress=False,
+            cut_flow=cut_flow, array_events_key='array_events',
+        )
+        cut_flow.write_h5py(output_path)
+
+        with h5py.File(output_path, 'r') as f, h5py.File(path, 'r') as infile:
+            assert list(f['cut_flow/telescope_events_after']) == list(cut_flow.n_telescope_events[1:])
+
+            mask = np.ones(n_events, dtype=bool)
+            for name, (operator, value) in selection.items():
+                mask &= OPERATORS[operator](columns[name], value)
+            assert np.array_equal(f['telescope_events/image'][:], infile['telescope_events/image'][:][mask])
+
+            selected = np.isin(order, columns['array_event_id'][mask])
+            assert np.array_equal(f['array_events/array_event_id'][:], order[selected])
+
+    mask = np.ones(n_events, dtype=bool)
+    expected_telescope = [n_events]
+    expected_array = [n_array_events]
+    for name, (operator, value) in selection.items():
+        mask &= OPERATORS[operator](columns[name], value)
+        expected_telescope.append(mask.sum())
+        expected_array.append(len(np.unique(columns['array_event_id'][mask])))
+
+    assert list(cut_flow.n_telescope_events) == expected_telescope
+    assert list(cut_flow.n_array_events) == expected_array
+
+    rows = cut_flow.to_dict()
+    assert rows[-1]['array_events']['after'] == expected_array[-1]
+    assert rows[-1]['telescope_events']['cumulative_efficiency'] == expected_telescope[-1] / n_events
+
+
+def test_apply_cuts_sparse():
+    from aict_tools.apply import apply_cuts_h5py_chunked
+
+    rng = np.random.RandomState(2)
+    n_events = 5000
+    size = rng.exponential(100, n_events)
+    image = rng.normal(size=(n_events, 2, 3))
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'test.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group('telescope_events')
+            group.create_dataset('size', data=size, chunks=(64, ))
+            group.create_dataset('image', data=image, chunks=(64, 2, 3))
+
+        # few selected events, most chunks are empty
+        for threshold in (500, 1e9):
+            output_path = os.path.join(d, 'output.hdf5')
+            apply_cuts_h5py_chunked(
+                path, output_path, {'size': ['>', threshold]}, chunksize=500, progress=False,
+            )
+            mask = size > threshold
+            with h5py.File(output_path, 'r') as f:
+                assert np.array_equal(f['telescope_events/size'][:], size[mask])
+                assert np.array_equal(f['telescope_events/image'][:], image[mask])
+
+
+def test_gamma_cascade():
+    from aict_tools.apply import GammaCascade
+
+    gamma = np.array([0.1, 0.5, 0.9, np.nan, 0.4, 0.4])
+
+    cascade = GammaCascade.from_config({'threshold': 0.5})
+    assert list(cascade.mask(gamma)) == [False, True, True, False, False, False]
+
+    cascade = GammaCascade.from_config({
+        'column': 'energy', 'bins': [0, 100, 1000], 'threshold': [0.8, 0.3],
+    })
+    energy = np.array([50, 50, 50, 500, 500, 5000])
+    assert list(cascade.mask(gamma, energy)) == [False, False, True, False, True, True]
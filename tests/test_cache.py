@@ -0,0 +1,231 @@
+import numpy as np
+import h5py
+import tempfile
+import os
+from sklearn.ensemble import RandomForestRegressor
+
+
+class Config:
+    telescope_events_key = 'telescope_events'
+    array_events_key = 'array_events'
+    run_id_column = 'run_id'
+    array_event_id_column = 'array_event_id'
+    seed = 0
+
+
+class ModelConfig:
+    __slots__ = (
+        'features', 'n_signal', 'n_cross_validations', 'model', 'columns_to_read_train',
+    )
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+
+def test_training_cache():
+    from aict_tools.cache import cached_training_data, training_cache_key
+
+    n_events = 1000
+    rng = np.random.RandomState(0)
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'test.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group('telescope_events')
+            group['run_id'] = np.ones(n_events, dtype=int)
+            group['array_event_id'] = np.arange(n_events)
+            group['width'] = rng.uniform(0, 1, n_events)
+            group['length'] = rng.uniform(0, 1, n_events)
+            group = f.create_group('array_events')
+            group['run_id'] = np.ones(n_events, dtype=int)
+            group['array_event_id'] = np.arange(n_events)
+
+        model_config = ModelConfig(
+            features=['width'], n_signal=None, n_cross_validations=5,
+            model=RandomForestRegressor(n_estimators=10),
+        )
+        columns = ['width']
+
+        calls = []
+
+        def compute():
+            with h5py.File(path, 'r') as f:
+                width = f['telescope_events/width'][:]
+            calls.append(1)
+            return {'X': width[:, np.newaxis], 'n_events': np.array(len(width))}
+
+        def get():
+            return cached_training_data(
+                os.path.join(d, 'cache'), 'test', Config, model_config,
+                [path], columns, compute,
+            )
+
+        data = get()
+        assert len(calls) == 1
+        cached = get()
+        assert len(calls) == 1
+        assert np.array_equal(data['X'], cached['X'])
+        assert int(cached['n_events']) == n_events
+
+        key = training_cache_key('test', Config, model_config, [path], columns)
+
+        # hyperparameters and columns not read do not invalidate the cache
+        model_config.n_cross_validations = 10
+        model_config.model = RandomForestRegressor(n_estimators=100)
+        with h5py.File(path, 'r+') as f:
+            f['telescope_events/length'][0] = 2
+            f['telescope_events/energy'] = np.ones(n_events)
+        assert training_cache_key('test', Config, model_config, [path], columns) == key
+
+        # a replaced input file or a changed data config does
+        new_path = os.path.join(d, 'new.hdf5')
+        with h5py.File(path, 'r') as f, h5py.File(new_path, 'w') as new:
+            f.copy('telescope_events', new)
+            f.copy('array_events', new)
+            new['telescope_events/width'][-1] = 2
+        os.replace(new_path, path)
+        assert training_cache_key('test', Config, model_config, [path], columns) != key
+        get()
+        assert len(calls) == 2
+
+        model_config.n_signal = 100
+        assert training_cache_key('test', Config, model_config, [path], columns) != key
+
+        # without a cache directory, always compute
+        cached_training_data(None, 'test', Config, model_config, [path], columns, compute)
+        assert len(calls) == 3
+
+
+def test_training_cache_sampled():
+    '''
+    For sampled training data, only the sampled rows are hashed
+    and a cache hit does not read the complete columns
+    '''
+    from aict_tools.cache import cached_training_data, training_cache_key
+    from aict_tools.io import read_telescope_data_sample
+
+    n_events = 100000
+    n_sample = 100
+    rng = np.random.RandomState(0)
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'test.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group('telescope_events')
+            group.create_dataset('run_id', data=np.ones(n_events, dtype=int), chunks=(100, ))
+            group.create_dataset('array_event_id', data=np.arange(n_events), chunks=(100, ))
+            group.create_dataset('width', data=rng.uniform(0, 1, n_events), chunks=(100, ))
+            group = f.create_group('array_events')
+            group.create_dataset('run_id', data=np.ones(n_events, dtype=int), chunks=(100, ))
+            group.create_dataset('array_event_id', data=np.arange(n_events), chunks=(100, ))
+
+        model_config = ModelConfig(
+            features=['width'], n_signal=n_sample, n_cross_validations=5,
+            model=RandomForestRegressor(n_estimators=10),
+        )
+        columns = ['width', 'run_id', 'array_event_id']
+
+        def compute():
+            df = read_telescope_data_sample(path, Config, columns, [], n_sample)
+            return {'X': df[['width']].values}
+
+        def get():
+            return cached_training_data(
+                os.path.join(d, 'cache'), 'test', Config, model_config,
+                [path], columns, compute, n_samples=[n_sample],
+            )
+
+        np.random.seed(Config.seed)
+        data = get()
+
+        n_read = []
+        getitem = h5py.Dataset.__getitem__
+
+        def counting_getitem(self, args, *more):
+            values = getitem(self, args, *more)
+            n_read.append(np.size(values))
+            return values
+
+        h5py.Dataset.__getitem__ = counting_getitem
+        try:
+            cached = get()
+        finally:
+            h5py.Dataset.__getitem__ = getitem
+
+        assert np.array_equal(data['X'], cached['X'])
+        assert 0 < sum(n_read) <= len(columns) * n_sample * 100
+
+        key = training_cache_key(
+            'test', Config, model_config, [path], columns, n_samples=[n_sample],
+        )
+
+        with h5py.File(path, 'r') as f:
+            width = f['telescope_events/width'][:]
+        not_sampled = np.flatnonzero(~np.isin(width, data['X'][:, 0]))[0]
+        sampled = np.flatnonzero(np.isin(width, data['X'][:, 0]))[0]
+
+        # values that are not sampled do not change the key, sampled ones do
+        with h5py.File(path, 'r+') as f:
+            f['telescope_events/width'][not_sampled] = 2
+        assert training_cache_key(
+            'test', Config, model_config, [path], columns, n_samples=[n_sample],
+        ) == key
+
+        with h5py.File(path, 'r+') as f:
+            f['telescope_events/width'][sampled] = 2
+        assert training_cache_key(
+            'test', Config, model_config, [path], columns, n_samples=[n_sample],
+        ) != key
+
+        # a different seed samples different rows
+        np.random.seed(Config.seed + 1)
+        assert training_cache_key(
+            'test', Config, model_config, [path], columns, n_samples=[n_sample],
+        ) != key
+
+
+def test_training_cache_key_hash_seed():
+    '''
+    The key must not depend on the iteration order of sets,
+    which changes with PYTHONHASHSEED
+    '''
+    import subprocess
+    import sys
+
+    code = '\n'.join([
+        'import sys',
+        'from sklearn.ensemble import RandomForestRegressor',
+        'from aict_tools.cache import training_cache_key',
+        'from test_cache import Config, ModelConfig',
+        'columns = ["width", "length", "size", "delta", "cog_x", "cog_y"]',
+        'model_config = ModelConfig(',
+        '    features=columns, n_signal=None, n_cross_validations=5,',
+        '    model=RandomForestRegressor(n_estimators=10),',
+        '    columns_to_read_train=list(set(columns)),',
+        ')',
+        'print(training_cache_key(',
+        '    "test", Config, model_config, [sys.argv[1]], model_config.columns_to_read_train,',
+        '))',
+    ])
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'test.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group('telescope_events')
+            for column in ('width', 'length', 'size', 'delta', 'cog_x', 'cog_y'):
+                group[column] = np.arange(100.0)
+            f.create_group('array_events')
+
+        tests_dir = os.path.dirname(os.path.abspath(__file__))
+        pythonpath = os.pathsep.join(
+            [tests_dir] + [p for p in os.environ.get('PYTHONPATH', '').split(os.pathsep) if p]
+        )
+
+        keys = set()
+        for seed in ('0', '1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=pythonpath)
+            output = subprocess.check_output([sys.executable, '-c', code, path], env=env)
+            keys.add(output.decode().strip())
+
+    assert len(keys) == 1
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pickle
+from pytest import raises
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import cross_val_predict
+
+
+def test_calibrated_classifier():
+    from aict_tools.calibration import CalibratedClassifier, fit_calibration
+    from aict_tools.apply import predict_separator
+
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(2000, 3)).astype(np.float32)
+    y = (X[:, 0] + rng.normal(0, 1, len(X)) > 0).astype(int)
+
+    model = RandomForestClassifier(n_estimators=10, max_depth=5, random_state=0)
+    scores = cross_val_predict(model, X, y, cv=3, method='predict_proba')[:, 1]
+    model.fit(X, y)
+
+    for method in ('sigmoid', 'isotonic'):
+        calibrated = CalibratedClassifier(model, fit_calibration(scores, y, method))
+
+        proba = calibrated.predict_proba(X)
+        assert proba.shape == (len(X), 2)
+        assert np.allclose(proba.sum(axis=1), 1)
+        assert np.all((proba >= 0) & (proba <= 1))
+
+        # calibration keeps the order of the scores
+        raw = model.predict_proba(X)[:, 1]
+        order = np.argsort(raw, kind='stable')
+        assert np.all(np.diff(proba[order, 1]) >= 0)
+
+        assert set(calibrated.predict(X)) <= set(model.classes_)
+
+        calibrated.n_jobs = 2
+        assert model.n_jobs == 2
+
+        loaded = pickle.loads(pickle.dumps(calibrated))
+        assert np.allclose(loaded.predict_proba(X), proba)
+
+        df = pd.DataFrame(X, columns=['a', 'b', 'c'])
+        assert np.allclose(predict_separator(df, calibrated), proba[:, 1])
+        score, passed, early = predict_separator(df, calibrated, threshold=0.5)
+        assert np.array_equal(passed, proba[:, 1] >= 0.5)
+        assert not early.any()
+
+    with raises(ValueError):
+        fit_calibration(scores, y, 'linear')
@@ -0,0 +1,78 @@
+import numpy as np
+import click
+from pytest import raises
+from sklearn.ensemble import (
+    ExtraTreesClassifier,
+    GradientBoostingRegressor,
+    RandomForestClassifier,
+    RandomForestRegressor,
+)
+from sklearn.model_selection import KFold
+
+
+def test_fit_rows():
+    from aict_tools.cross_validation import fit_rows, fits_rows_by_weight
+
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(2000, 5)).astype(np.float32)
+    y = X[:, 0] + rng.normal(0, 0.1, 2000)
+    label = (y > 0).astype(int)
+    rows = np.sort(rng.choice(len(X), 1500, replace=False))
+
+    models = [
+        (RandomForestRegressor(n_estimators=5, bootstrap=False, max_features=0.5), y),
+        (ExtraTreesClassifier(n_estimators=5), label),
+    ]
+    for model, target in models:
+        assert fits_rows_by_weight(model, X, target, rows)
+        model.random_state = 0
+        a = fit_rows(model.__class__(**model.get_params()), X, target, rows)
+        b = model.__class__(**model.get_params()).fit(X[rows], target[rows])
+        assert np.array_equal(a.predict(X), b.predict(X))
+
+    # bootstrap samples rows of X, so these need a copy
+    assert not fits_rows_by_weight(RandomForestRegressor(), X, y, rows)
+    assert not fits_rows_by_weight(GradientBoostingRegressor(), X, y, rows)
+    assert not fits_rows_by_weight(ExtraTreesClassifier(), X.astype(float), label, rows)
+    model = ExtraTreesClassifier(class_weight='balanced')
+    assert not fits_rows_by_weight(model, X, label, rows)
+
+
+def test_cross_validation():
+    from aict_tools.cross_validation import CrossValidation
+
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(500, 3)).astype(np.float32)
+    y = X[:, 0] + rng.normal(0, 0.1, 500)
+    label = (y > 0).astype(int)
+    folds = list(KFold(n_splits=3, shuffle=True, random_state=0).split(X))
+
+    def run(fold_jobs, fold_ensemble):
+        regressor = RandomForestRegressor(n_estimators=5, n_jobs=2)
+        classifier = RandomForestClassifier(n_estimators=5)
+        cross_validation = CrossValidation(
+            [regressor, classifier], ['r.pkl', 'c.pkl'], 0,
+            fold_jobs=fold_jobs, fold_ensemble=fold_ensemble,
+        )
+        results = list(cross_validation.run(folds, X, y, label))
+        models = cross_validation.final_models(X, y, label)
+        assert regressor.n_jobs == 2
+        assert classifier.n_jobs is None
+        return results, models
+
+    serial, (regressor, classifier) = run(1, False)
+    assert regressor.n_estimators == 5
+    for (fold, test, predictions), (train, fold_test) in zip(serial, folds):
+        assert np.array_equal(test, fold_test)
+        prediction, (proba, label_prediction) = predictions
+        assert len(prediction) == len(proba) == len(label_prediction) == len(test)
+
+    parallel, (regressor, classifier) = run(2, True)
+    assert regressor.n_estimators == classifier.n_estimators == 15
+    assert regressor.n_jobs == 2
+    for (_, _, a), (_, _, b) in zip(serial, parallel):
+        assert np.array_equal(a[0], b[0])
+        assert np.array_equal(a[1][0], b[1][0])
+
+    with raises(click.ClickException):
+        CrossValidation([GradientBoostingRegressor()], ['model.pmml'], 0, fold_ensemble=True)
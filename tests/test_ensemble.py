@@ -0,0 +1,85 @@
+import numpy as np
+from pytest import raises
+from sklearn.ensemble import (
+    GradientBoostingRegressor,
+    RandomForestClassifier,
+    RandomForestRegressor,
+)
+from sklearn.model_selection import KFold
+
+
+def fit_folds(model, X, y, n_folds=3):
+    models = []
+    for train, test in KFold(n_splits=n_folds, shuffle=True, random_state=0).split(X):
+        models.append(model.__class__(**model.get_params()).fit(X[train], y[train]))
+    return models
+
+
+def test_combine_fold_models():
+    from aict_tools.ensemble import combine_fold_models, FoldEnsemble
+    from aict_tools.forest import CompactForest
+
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(600, 3)).astype(np.float32)
+    y = X[:, 0] + rng.normal(0, 0.1, len(X))
+
+    models = fit_folds(RandomForestRegressor(n_estimators=6, random_state=0), X, y)
+    forest = combine_fold_models(models)
+    assert isinstance(forest, RandomForestRegressor)
+    assert len(forest.estimators_) == 18
+    mean = np.mean([m.predict(X) for m in models], axis=0)
+    assert np.allclose(forest.predict(X), mean)
+    assert np.allclose(CompactForest.from_sklearn(forest).predict(X), mean)
+    # the fold models are not changed
+    assert all(len(m.estimators_) == 6 for m in models)
+
+    assert len(combine_fold_models(models, subsample_trees=True).estimators_) == 6
+
+    labels = (y > 0).astype(int)
+    models = fit_folds(RandomForestClassifier(n_estimators=6, random_state=0), X, labels)
+    forest = combine_fold_models(models)
+    mean = np.mean([m.predict_proba(X) for m in models], axis=0)
+    assert np.allclose(forest.predict_proba(X), mean)
+
+    models = fit_folds(GradientBoostingRegressor(n_estimators=5), X, y)
+    ensemble = combine_fold_models(models)
+    assert isinstance(ensemble, FoldEnsemble)
+    assert np.allclose(ensemble.predict(X), np.mean([m.predict(X) for m in models], axis=0))
+
+    # folds that did not see all classes cannot be merged
+    models = fit_folds(RandomForestClassifier(n_estimators=2), X, labels)
+    models[0].fit(X[:10], np.zeros(10, dtype=int))
+    with raises(ValueError):
+        combine_fold_models(models)
+
+
+def test_predict_proba_thresholded():
+    import pandas as pd
+    from aict_tools.ensemble import predict_proba_thresholded
+    from aict_tools.apply import predict_separator
+
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(2000, 5)).astype(np.float32)
+    y = X[:, 0] + 0.5 * X[:, 1]**2 + rng.normal(0, 0.1, len(X))
+
+    for n_jobs in (1, 2):
+        model = RandomForestClassifier(n_estimators=30, n_jobs=n_jobs, random_state=0)
+        model.fit(X[:1000], y[:1000] > 0.5)
+
+        expected = model.predict_proba(X[1000:])[:, 1]
+        for threshold in (0.2, 0.5, 0.8):
+            score, passed, early = predict_proba_thresholded(
+                model, X[1000:], threshold, n_trees_per_step=4,
+            )
+
+            assert np.array_equal(passed, expected >= threshold)
+            assert np.array_equal(np.isnan(score), early)
+            assert np.allclose(score[~early], expected[~early], rtol=0, atol=1e-12)
+            # most events are decided before all trees are evaluated
+            assert early.sum() > len(expected) / 2
+
+    df = pd.DataFrame(X[1000:], columns=list('abcde'))
+    df.iloc[0, 0] = np.nan
+    score, passed, early = predict_separator(df, model, threshold=0.5)
+    assert np.isnan(score[0]) and not passed[0] and not early[0]
+    assert np.array_equal(passed[1:], expected[1:] >= 0.5)
@@ -67,6 +67,68 @@ def test_apply_regression():
         assert result.exit_code == 0
 
 
+def test_apply_pipeline_depth():
+    import h5py
+    import numpy as np
+    from sklearn.ensemble import RandomForestRegressor
+    from aict_tools.configuration import AICTConfig
+    from aict_tools.io import pickle_model
+    from aict_tools.scripts.apply_energy_regressor import main
+
+    config = AICTConfig.from_yaml('examples/config_energy.yaml')
+    rng = np.random.RandomState(0)
+    n_array_events = 1000
+    n_telescopes = rng.randint(1, 4, n_array_events)
+    n_events = n_telescopes.sum()
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'data.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group(config.telescope_events_key)
+            group['run_id'] = np.ones(n_events, dtype=int)
+            group['array_event_id'] = np.repeat(np.arange(n_array_events), n_telescopes)
+            for column in config.energy.columns_to_read_apply:
+                if column not in group:
+                    group[column] = rng.uniform(0, 1, n_events)
+            group['width'][::17] = np.nan
+            group = f.create_group(config.array_events_key)
+            group['run_id'] = np.ones(n_array_events, dtype=int)
+            group['array_event_id'] = np.arange(n_array_events)
+
+        features = config.energy.features
+        model = RandomForestRegressor(n_estimators=10, random_state=0)
+        model.fit(rng.uniform(0, 1, (500, len(features))), rng.uniform(0, 1, 500))
+        model_path = os.path.join(d, 'model.pkl')
+        pickle_model(model, features, model_path, config_hash=config.config_hash)
+
+        results = []
+        # 0 is the serial path
+        for depth in (0, 1, 3):
+            data_path = os.path.join(d, 'data_{}.hdf5'.format(depth))
+            shutil.copy(path, data_path)
+
+            result = CliRunner().invoke(main, [
+                'examples/config_energy.yaml', data_path, model_path,
+                '--yes', '--chunksize', '97', '--pipeline-depth', str(depth),
+            ])
+            if result.exit_code != 0:
+                print(result.output)
+                print_exception(*result.exc_info)
+            assert result.exit_code == 0
+
+            with h5py.File(data_path, 'r') as f:
+                results.append({
+                    'energy': f[config.telescope_events_key]['energy'][:],
+                    'energy_mean': f[config.array_events_key]['energy_mean'][:],
+                    'energy_std': f[config.array_events_key]['energy_std'][:],
+                })
+
+        assert np.count_nonzero(np.isnan(results[0]['energy'])) == len(range(0, n_events, 17))
+        for result in results[1:]:
+            for name, values in results[0].items():
+                assert np.array_equal(values, result[name], equal_nan=True)
+
+
 def test_train_separator():
     from aict_tools.scripts.train_separation_model import main
 
@@ -90,6 +152,36 @@ def test_train_separator():
         assert result.exit_code == 0
 
 
+def test_train_separator_calibrated_forest():
+    import yaml
+    from aict_tools.scripts.train_separation_model import main
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        with open('examples/config_separator.yaml') as f:
+            config = yaml.safe_load(f)
+        config['separator']['calibrate_classifier'] = 'sigmoid'
+        config_path = os.path.join(d, 'config.yaml')
+        with open(config_path, 'w') as f:
+            yaml.safe_dump(config, f)
+
+        runner = CliRunner()
+        result = runner.invoke(
+            main,
+            [
+                config_path,
+                'examples/gamma.hdf5',
+                'examples/proton.hdf5',
+                os.path.join(d, 'test.hdf5'),
+                os.path.join(d, 'test.forest'),
+            ]
+        )
+
+        # rejected before training, nothing is written
+        assert result.exit_code != 0
+        assert 'cannot be stored as .forest' in result.output
+        assert os.listdir(d) == ['config.yaml']
+
+
 def test_apply_separator():
     from aict_tools.scripts.train_separation_model import main as train
     from aict_tools.scripts.apply_separation_model import main as apply_model
@@ -192,6 +284,62 @@ def test_apply_disp():
         assert result.exit_code == 0
 
 
+def test_apply_all():
+    from aict_tools.scripts.train_energy_regressor import main as train_energy
+    from aict_tools.scripts.train_separation_model import main as train_separator
+    from aict_tools.scripts.apply_all import main as apply_all
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        shutil.copy('examples/gamma.hdf5', os.path.join(d, 'gamma.hdf5'))
+
+        runner = CliRunner()
+
+        result = runner.invoke(
+            train_energy,
+            [
+                'examples/full_config.yaml',
+                'examples/gamma.hdf5',
+                os.path.join(d, 'regressor_performance.hdf5'),
+                os.path.join(d, 'regressor.pkl'),
+            ]
+        )
+        if result.exit_code != 0:
+            print(result.output)
+            print_exception(*result.exc_info)
+        assert result.exit_code == 0
+
+        result = runner.invoke(
+            train_separator,
+            [
+                'examples/full_config.yaml',
+                'examples/gamma.hdf5',
+                'examples/proton.hdf5',
+                os.path.join(d, 'separator_performance.hdf5'),
+                os.path.join(d, 'separator.pkl'),
+            ]
+        )
+        if result.exit_code != 0:
+            print(result.output)
+            print_exception(*result.exc_info)
+        assert result.exit_code == 0
+
+        result = runner.invoke(
+            apply_all,
+            [
+                'examples/full_config.yaml',
+                os.path.join(d, 'gamma.hdf5'),
+                '--separator-model', os.path.join(d, 'separator.pkl'),
+                '--energy-model', os.path.join(d, 'regressor.pkl'),
+                '--chunksize', '100',
+                '--yes',
+            ]
+        )
+        if result.exit_code != 0:
+            print(result.output)
+            print_exception(*result.exc_info)
+        assert result.exit_code == 0
+
+
 def test_to_dl3():
     from aict_tools.scripts.train_disp_regressor import main as train_disp
     from aict_tools.scripts.train_energy_regressor import main as train_energy
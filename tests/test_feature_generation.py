@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+
+def test_feature_generation():
+    from aict_tools.configuration import FeatureGenerationConfig
+    from aict_tools.feature_generation import feature_generation
+
+    df = pd.DataFrame({
+        'width': np.random.uniform(0, 1, 100),
+        'length': np.random.uniform(0, 1, 100),
+        'n_pixel': np.random.randint(1, 100, 100),
+    })
+    config = FeatureGenerationConfig(
+        needed_columns=['width', 'length', 'n_pixel'],
+        features={
+            'area': 'width * length * @pi',
+            'area_per_pixel': 'area / n_pixel',
+            'log_length': 'log(length)',
+        }
+    )
+
+    result = feature_generation(df, config)
+    assert 'area' not in df.columns
+
+    area = df.width * df.length * np.pi
+    assert np.allclose(result['area'], area)
+    assert np.allclose(result['area_per_pixel'], area / df.n_pixel)
+    assert np.allclose(result['log_length'], np.log(df.length))
+
+    feature_generation(df, config, inplace=True)
+    assert np.allclose(df['area'], area)
+
+
+def test_feature_generation_pandas_fallback():
+    from aict_tools.configuration import FeatureGenerationConfig
+    from aict_tools.feature_generation import feature_generation
+
+    df = pd.DataFrame({'width': [1.0, 2.0, 3.0], 'length': [3.0, 2.0, 1.0]})
+    config = FeatureGenerationConfig(
+        needed_columns=['width', 'length'],
+        features={'is_round': 'width == length and width > 1'},
+    )
+
+    result = feature_generation(df, config)
+    assert list(result['is_round']) == [False, True, False]
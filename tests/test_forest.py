@@ -0,0 +1,98 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from pytest import raises
+
+
+def make_data(n=2000):
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(n, 5)).astype(np.float32)
+    y = X[:, 0] + 0.5 * X[:, 1]**2 + rng.normal(0, 0.1, n)
+    return X, y
+
+
+def test_compact_regressor():
+    from sklearn.ensemble import RandomForestRegressor, ExtraTreesRegressor
+    from aict_tools.forest import CompactForest
+
+    X, y = make_data()
+    for cls in (RandomForestRegressor, ExtraTreesRegressor):
+        model = cls(n_estimators=20, n_jobs=1, random_state=0)
+        model.fit(X[:1000], y[:1000])
+
+        forest = CompactForest.from_sklearn(model)
+        assert np.array_equal(forest.predict(X[1000:]), model.predict(X[1000:]))
+
+
+def test_compact_classifier():
+    from sklearn.ensemble import RandomForestClassifier
+    from aict_tools.forest import CompactForest
+
+    X, y = make_data()
+    labels = np.where(y > 0.5, 1, -1)
+    model = RandomForestClassifier(n_estimators=20, n_jobs=1, random_state=0)
+    model.fit(X[:1000], labels[:1000])
+
+    forest = CompactForest.from_sklearn(model)
+    assert np.array_equal(forest.predict_proba(X[1000:]), model.predict_proba(X[1000:]))
+    assert np.array_equal(forest.predict(X[1000:]), model.predict(X[1000:]))
+
+
+def test_compact_rejects_other_models():
+    from sklearn.linear_model import LinearRegression
+    from aict_tools.forest import CompactForest
+    from aict_tools.apply import predict_energy
+
+    X, y = make_data()
+    model = LinearRegression().fit(X, y)
+
+    with raises(TypeError):
+        CompactForest.from_sklearn(model)
+
+    df = pd.DataFrame(X, columns=list('abcde'))
+    assert np.allclose(predict_energy(df, model), model.predict(X))
+
+
+def test_compact_forest_file():
+    from sklearn.ensemble import RandomForestClassifier
+    from aict_tools.forest import CompactForest
+    from aict_tools.io import pickle_model, load_model
+
+    X, y = make_data()
+    labels = np.where(y > 0.5, 'gamma', 'proton')
+    model = RandomForestClassifier(n_estimators=20, n_jobs=1, random_state=0)
+    model.fit(X, labels)
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        model_path = os.path.join(d, 'separator.forest')
+        pickle_model(model, ['a', 'b', 'c', 'd', 'e'], model_path, config_hash='test')
+        assert os.path.isfile(os.path.join(d, 'separator.pkl'))
+
+        forest = CompactForest.load(model_path)
+        assert isinstance(forest.value.base, np.memmap)
+        assert np.array_equal(forest.predict_proba(X), model.predict_proba(X))
+
+        loaded = load_model(model_path)
+        assert isinstance(loaded, RandomForestClassifier)
+        assert loaded.feature_names == ['a', 'b', 'c', 'd', 'e']
+        assert loaded.config_hash == 'test'
+        assert np.array_equal(loaded.classes_, model.classes_)
+        assert np.array_equal(loaded.predict_proba(X), model.predict_proba(X))
+        assert np.array_equal(loaded.predict(X), model.predict(X))
+
+
+def test_compact_to_sklearn():
+    from sklearn.ensemble import ExtraTreesRegressor
+    from aict_tools.forest import CompactForest
+
+    X, y = make_data()
+    model = ExtraTreesRegressor(n_estimators=20, n_jobs=1, random_state=0)
+    model.fit(X[:1000], y[:1000])
+
+    rebuilt = CompactForest.from_sklearn(model).to_sklearn()
+    assert isinstance(rebuilt, ExtraTreesRegressor)
+    assert np.array_equal(rebuilt.predict(X[1000:]), model.predict(X[1000:]))
+    for a, b in zip(rebuilt.estimators_, model.estimators_):
+        assert a.tree_.max_depth == b.tree_.max_depth
@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+import h5py
+import tempfile
+import os
+from pytest import raises
+import click
+from click.testing import CliRunner
+
+
+class JoinConfig:
+    run_id_column = 'run_id'
+    array_event_id_column = 'array_event_id'
+
+
+def test_join_array_events():
+    from aict_tools.io import join_keys_array, join_array_events
+
+    array_events = pd.DataFrame({
+        'run_id': np.repeat([3, 1, 2], 4),
+        'array_event_id': np.tile(np.arange(4), 3),
+    })
+    array_events['total_intensity'] = np.arange(len(array_events))
+
+    telescope_events = array_events[['run_id', 'array_event_id']].sample(
+        frac=1, random_state=0
+    ).reset_index(drop=True)
+    telescope_events['intensity'] = np.arange(len(telescope_events))
+
+    keys = join_keys_array(array_events, JoinConfig)
+    order = np.argsort(keys)
+
+    df = join_array_events(
+        telescope_events.copy(),
+        array_events.iloc[order].reset_index(drop=True),
+        keys[order],
+        JoinConfig,
+    )
+    expected = pd.merge(
+        telescope_events, array_events,
+        on=['run_id', 'array_event_id'], how='left',
+    )
+
+    assert np.all(df['intensity'] == telescope_events['intensity'])
+    assert np.all(df['total_intensity'] == expected['total_intensity'])
+
+    telescope_events.loc[0, 'run_id'] = 42
+    with raises(ValueError):
+        join_array_events(
+            telescope_events,
+            array_events.iloc[order].reset_index(drop=True),
+            keys[order],
+            JoinConfig,
+        )
+
+
+def test_column_writer():
+    from aict_tools.io import H5PyColumnWriter
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'test.hdf5')
+        with h5py.File(path, 'w') as f:
+            f.create_group('events')
+
+        with H5PyColumnWriter(path, chunksize=3) as writer:
+            writer.require_column('events', 'gamma', 10)
+            for start in range(0, 10, 3):
+                end = min(10, start + 3)
+                writer.write('events', 'gamma', np.arange(start, end), start, end)
+
+        with h5py.File(path, 'r') as f:
+            assert np.all(f['events/gamma'][:] == np.arange(10))
+
+        with H5PyColumnWriter(path) as writer:
+            writer.require_column('events', 'gamma', 10)
+            assert np.all(writer.file['events/gamma'][:] == np.arange(10))
+
+            writer.write_column('events', 'gamma', np.ones(5))
+
+        with h5py.File(path, 'r') as f:
+            assert np.all(f['events/gamma'][:] == np.ones(5))
+
+        # only the given rows are written, all others of the chunk are nan
+        with H5PyColumnWriter(path) as writer:
+            writer.require_column('events', 'energy', 10)
+            writer.write('events', 'energy', [1.0, 2.0], 2, 6, rows=[3, 5])
+
+        with h5py.File(path, 'r') as f:
+            assert np.array_equal(
+                f['events/energy'][2:6], [np.nan, 1.0, np.nan, 2.0], equal_nan=True,
+            )
+
+
+class ReadConfig(JoinConfig):
+    telescope_events_key = 'telescope_events'
+    array_events_key = 'array_events'
+
+
+def test_read_with_selection_zone_maps():
+    from aict_tools.io import read_telescope_data_chunked, H5PyColumnWriter, append_to_h5py
+    from aict_tools.selection import index_zone_maps, ZoneMaps
+
+    rng = np.random.RandomState(0)
+    n_array_events = 1000
+    n_telescopes = rng.randint(1, 4, n_array_events)
+    n_events = n_telescopes.sum()
+
+    # sorted by intensity, so most blocks can be skipped by the zone maps
+    intensity = np.sort(rng.exponential(100, n_events))
+    width = rng.uniform(0, 1, n_events)
+    width[::11] = np.nan
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'test.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group('telescope_events')
+            group['run_id'] = np.ones(n_events, dtype=int)
+            group['array_event_id'] = np.repeat(np.arange(n_array_events), n_telescopes)
+            group.create_dataset('intensity', data=intensity, chunks=(64, ))
+            group.create_dataset('width', data=width, chunks=(64, ), maxshape=(None, ))
+            group = f.create_group('array_events')
+            group['run_id'] = np.ones(n_array_events, dtype=int)
+            group['array_event_id'] = np.arange(n_array_events)
+            group['total_intensity'] = rng.exponential(100, n_array_events)
+
+        selection = {'intensity': ['>=', 300], 'width': ['<', 0.5]}
+        expected = np.flatnonzero((intensity >= 300) & (width < 0.5))
+
+        def read():
+            return pd.concat([
+                df for df, start, end in read_telescope_data_chunked(
+                    path, ReadConfig, 500, ['width', 'total_intensity'], selection=selection,
+                )
+            ])
+
+        df = read()
+        assert np.array_equal(df.index, expected)
+        assert np.array_equal(df['width'], width[expected])
+
+        zone_maps = index_zone_maps(path, block_size=100)
+        candidates = zone_maps.candidate_rows(selection, 0, n_events)
+        assert np.all(np.isin(expected, candidates))
+        assert len(candidates) < n_events / 2
+
+        df = read()
+        assert np.array_equal(df.index, expected)
+        assert np.array_equal(df['width'], width[expected])
+
+        # a column rewritten with the same length by other tools
+        # is noticed by its fingerprint and evaluated on all rows
+        with h5py.File(path, 'r+') as f:
+            f['telescope_events/intensity'][:] = intensity[::-1]
+            assert 'intensity' not in ZoneMaps.read(f, 'telescope_events').minimum
+            assert 'width' in ZoneMaps.read(f, 'telescope_events').minimum
+        df = read()
+        assert np.array_equal(df.index, np.flatnonzero((intensity[::-1] >= 300) & (width < 0.5)))
+
+        with h5py.File(path, 'r+') as f:
+            f['telescope_events/intensity'][:] = intensity
+        index_zone_maps(path, block_size=100)
+
+        # declining to overwrite a column keeps its zone map
+        @click.command()
+        def overwrite():
+            with H5PyColumnWriter(path, yes=False) as writer:
+                writer.require_column('telescope_events', 'intensity', n_events)
+
+        assert CliRunner().invoke(overwrite, input='n\n').exit_code != 0
+        with h5py.File(path, 'r') as f:
+            assert 'intensity' in ZoneMaps.read(f, 'telescope_events').minimum
+
+        # writing a column removes its zone map
+        with H5PyColumnWriter(path) as writer:
+            writer.require_column('telescope_events', 'intensity', n_events)
+        with h5py.File(path, 'r') as f:
+            assert 'intensity' not in ZoneMaps.read(f, 'telescope_events').minimum
+
+        # as does appending to it
+        with h5py.File(path, 'r+') as f:
+            assert 'zone_maps/telescope_events/width' in f
+            append_to_h5py(f, width[:10], 'telescope_events', 'width')
+            assert 'zone_maps/telescope_events/width' not in f
+
+
+def test_read_telescope_data_sample():
+    from aict_tools.io import read_telescope_data, sample_rows
+
+    rng = np.random.RandomState(0)
+    for n_sample in (10, 900):
+        rows = sample_rows(1000, n_sample, rng)
+        assert len(np.unique(rows)) == n_sample
+        assert np.all(np.diff(rows) > 0)
+
+    n_array_events = 100
+    n_telescopes = rng.randint(1, 4, n_array_events)
+    n_events = n_telescopes.sum()
+
+    with tempfile.TemporaryDirectory(prefix='aict_tools_test_') as d:
+        path = os.path.join(d, 'test.hdf5')
+        with h5py.File(path, 'w') as f:
+            group = f.create_group('telescope_events')
+            group['run_id'] = np.ones(n_events, dtype=int)
+            group['array_event_id'] = np.repeat(np.arange(n_array_events), n_telescopes)
+            group['intensity'] = np.arange(n_events, dtype=float)
+            group = f.create_group('array_events')
+            # array events in a different order than the telescope events
+            order = rng.permutation(n_array_events)
+            group['run_id'] = np.ones(n_array_events, dtype=int)
+            group['array_event_id'] = order
+            group['total_intensity'] = order * 10.0
+
+        np.random.seed(0)
+        df = read_telescope_data(path, ReadConfig, ['intensity', 'total_intensity'], n_sample=50)
+        assert len(df) == 50
+        assert len(np.unique(df['intensity'])) == 50
+        assert np.all(df['total_intensity'] == df['array_event_id'] * 10.0)
+
+        # reproducible from the global seed
+        np.random.seed(0)
+        df2 = read_telescope_data(path, ReadConfig, ['intensity', 'total_intensity'], n_sample=50)
+        assert df.equals(df2)
+
+        with raises(ValueError):
+            read_telescope_data(path, ReadConfig, ['intensity'], n_sample=n_events + 1)
+
+
+def test_check_model_path():
+    from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+    from aict_tools.io import check_model_path
+
+    forest = RandomForestRegressor()
+    boosting = GradientBoostingRegressor()
+
+    for model_path in ('model.pkl', 'model.pmml', 'model.forest'):
+        check_model_path(model_path, forest)
+        check_model_path(model_path, forest, fold_ensemble=True)
+
+    check_model_path('model.pkl', boosting, fold_ensemble=True)
+    check_model_path('model.pmml', boosting)
+    with raises(click.ClickException):
+        check_model_path('model.forest', boosting)
+    with raises(click.ClickException):
+        check_model_path('model.pmml', boosting, fold_ensemble=True)
@@ -1,4 +1,5 @@
 import numpy as np
+from pytest import raises
 from multiprocessing import cpu_count
 
 
@@ -15,3 +16,107 @@ def test_correct_length():
 
     assert len(results) == n_jobs
     assert len(np.concatenate(results)) == N
+
+
+def test_prefetch():
+    from aict_tools.parallel import prefetch
+
+    assert list(prefetch(range(100), depth=2)) == list(range(100))
+
+    def failing():
+        yield 1
+        raise ValueError('Test')
+
+    with raises(ValueError):
+        list(prefetch(failing(), depth=1))
+
+
+def test_background_worker_order():
+    from aict_tools.parallel import BackgroundWorker
+
+    results = []
+    with BackgroundWorker(depth=2) as worker:
+        for i in range(100):
+            worker.submit(results.append, i)
+
+    assert results == list(range(100))
+
+    with raises(ZeroDivisionError):
+        with BackgroundWorker(depth=1) as worker:
+            worker.submit(lambda: 1 / 0)
+
+
+def add_and_multiply(a, b):
+    return {'sum': a + b, 'product': a * b}
+
+
+def test_shared_memory_executor():
+    from aict_tools.parallel import SharedMemoryExecutor
+
+    with SharedMemoryExecutor(n_jobs=2) as executor:
+        # second iteration needs larger shared memory blocks
+        for n in (101, 1001):
+            a = np.random.normal(size=n)
+            b = np.arange(n)
+            result = executor.map(
+                add_and_multiply, [a, b], {'sum': 'f8', 'product': 'f8'}
+            )
+            assert np.all(result['sum'] == a + b)
+            assert np.all(result['product'] == a * b)
+
+        # inputs filled in place are not copied
+        a = executor.shared_input(0, 'f8', 1001)
+        a[:] = np.arange(1001)
+        result = executor.map(add_and_multiply, [a, b], {'sum': 'f8'})
+        assert np.all(result['sum'] == 2 * b)
+        del result
+
+    with raises(ValueError):
+        with SharedMemoryExecutor(n_jobs=2) as executor:
+            executor.map(add_and_multiply, [np.ones(2), np.ones(3)], {'sum': 'f8'})
+
+
+def test_split_n_jobs():
+    from aict_tools.parallel import split_n_jobs
+
+    assert split_n_jobs(8, 2) == [4, 4]
+    assert split_n_jobs(5, 2) == [3, 2]
+    # every part gets at least one thread
+    assert split_n_jobs(1, 2) == [1, 1]
+    assert sum(split_n_jobs(-1, 2)) == max(2, cpu_count())
+
+
+def test_run_concurrently():
+    from aict_tools.parallel import run_concurrently
+
+    assert run_concurrently((np.add, 1, 2), (np.multiply, 3, 4)) == [3, 12]
+
+    with raises(ZeroDivisionError):
+        run_concurrently((np.add, 1, 2), (lambda: 1 / 0, ))
+
+
+def fit_and_predict(model, train, test, X, y):
+    model.fit(X[train], y[train])
+    return model.predict(X[test])
+
+
+def test_run_folds():
+    from functools import partial
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.model_selection import KFold
+    from aict_tools.parallel import run_folds
+
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(500, 3)).astype(np.float32)
+    y = X[:, 0] + rng.normal(0, 0.1, 500)
+    folds = list(KFold(n_splits=4, shuffle=True, random_state=0).split(X))
+
+    model = RandomForestRegressor(n_estimators=5, random_state=0)
+    func = partial(fit_and_predict, model)
+    serial = list(run_folds(func, [X, y], folds))
+    parallel = list(run_folds(func, [X, y], folds, n_fold_jobs=2))
+
+    assert len(parallel) == len(folds)
+    for (train, test), a, b in zip(folds, serial, parallel):
+        assert len(a) == len(test)
+        assert np.array_equal(a, b)
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+
+def random_pointing(n=1000):
+    rng = np.random.RandomState(0)
+    az_pointing = pd.Series(rng.uniform(0, 2 * np.pi, n))
+    alt_pointing = pd.Series(rng.uniform(np.deg2rad(20), np.deg2rad(89), n))
+    focal_length = pd.Series(rng.choice([2.15, 5.6, 16.0, 28.0], n))
+    x = pd.Series(rng.uniform(-1, 1, n))
+    y = pd.Series(rng.uniform(-1, 1, n))
+    return x, y, az_pointing, alt_pointing, focal_length
+
+
+def test_camera_to_horizontal():
+    '''
+    numpy implementation has to agree with the astropy reference to 1e-9 rad
+    '''
+    from aict_tools.preprocessing import camera_to_horizontal, camera_to_horizontal_astropy
+
+    x, y, az_pointing, alt_pointing, focal_length = random_pointing()
+
+    alt, az = camera_to_horizontal(x, y, az_pointing, alt_pointing, focal_length)
+    alt_ref, az_ref = camera_to_horizontal_astropy(
+        x, y, az_pointing, alt_pointing, focal_length
+    )
+
+    assert np.allclose(alt, alt_ref, rtol=0, atol=1e-9)
+    delta_az = (az - az_ref + np.pi) % (2 * np.pi) - np.pi
+    assert np.all(np.abs(delta_az) < 1e-9)
+
+
+def test_horizontal_to_camera():
+    '''
+    numpy implementation has to agree with the astropy reference to 1e-9 m
+    '''
+    from aict_tools.preprocessing import (
+        camera_to_horizontal, horizontal_to_camera, horizontal_to_camera_astropy
+    )
+
+    x, y, az_pointing, alt_pointing, focal_length = random_pointing()
+    alt, az = camera_to_horizontal(x, y, az_pointing, alt_pointing, focal_length)
+
+    x_rec, y_rec = horizontal_to_camera(az, alt, az_pointing, alt_pointing, focal_length)
+    x_ref, y_ref = horizontal_to_camera_astropy(
+        pd.Series(az), pd.Series(alt), az_pointing, alt_pointing, focal_length
+    )
+
+    assert np.allclose(x_rec, x_ref, rtol=0, atol=1e-9)
+    assert np.allclose(y_rec, y_ref, rtol=0, atol=1e-9)
+    assert np.allclose(x_rec, x, rtol=0, atol=1e-9)
+    assert np.allclose(y_rec, y, rtol=0, atol=1e-9)
+
+
+def test_transform_to_horizontal_interpolated():
+    '''
+    interpolation on a time grid has to agree with the exact transformation
+    within the error bound (omega * time_step)**2 / 8
+    '''
+    from astropy.coordinates import SkyCoord, EarthLocation, AltAz, angular_separation
+    import astropy.units as u
+    from aict_tools.preprocessing import (
+        transform_to_horizontal_interpolated, datetime64_to_time
+    )
+
+    location = EarthLocation.from_geodetic(
+        lon=-17.89 * u.deg, lat=28.76 * u.deg, height=2200 * u.m,
+    )
+    crab = SkyCoord(ra=83.63 * u.deg, dec=22.01 * u.deg)
+
+    rng = np.random.RandomState(0)
+    offsets = np.sort(rng.randint(0, 4 * 3600 * 10**9, 1000))
+    # two runs on different nights
+    timestamp = np.concatenate([
+        np.datetime64('2015-11-03T22:00') + offsets.astype('timedelta64[ns]'),
+        np.datetime64('2015-11-04T22:00') + offsets.astype('timedelta64[ns]'),
+    ])
+
+    exact = crab.transform_to(AltAz(location=location, obstime=datetime64_to_time(timestamp)))
+
+    omega = 7.3e-5
+    for time_step in (1, 60):
+        alt, az = transform_to_horizontal_interpolated(
+            crab, timestamp, location, time_step=time_step
+        )
+        separation = angular_separation(az, alt, exact.az.rad, exact.alt.rad)
+        assert np.all(separation < (omega * time_step)**2 / 8 + 1e-12)
+
+
+def test_feature_buffer():
+    '''
+    FeatureBuffer has to give the same result as
+    convert_to_float32 and check_valid_rows
+    '''
+    from aict_tools.preprocessing import FeatureBuffer, convert_to_float32, check_valid_rows
+
+    rng = np.random.RandomState(0)
+    n = 1000
+    df = pd.DataFrame({
+        'a': rng.normal(0, 1e39, n),
+        'b': rng.randint(0, 100, n),
+        'c': rng.normal(size=n),
+    })
+    df.loc[rng.choice(n, 10), 'a'] = np.inf
+    df.loc[rng.choice(n, 10), 'a'] = -np.inf
+    df.loc[rng.choice(n, 10), 'c'] = np.nan
+
+    expected = convert_to_float32(df)
+    expected_valid = check_valid_rows(expected)
+
+    buffer = FeatureBuffer()
+    # second call reuses the buffer for a smaller frame
+    for df_fill, df_expected, mask in (
+        (df, expected, expected_valid),
+        (df.iloc[:100], expected.iloc[:100], expected_valid[:100]),
+    ):
+        X, valid = buffer.fill(df_fill)
+        assert X.dtype == np.float32 and X.flags.c_contiguous
+        assert np.array_equal(valid, mask)
+        assert np.array_equal(X, df_expected.values, equal_nan=True)